@@ -2,8 +2,8 @@
 Продвинутый прогноз с защитой от шума:
 - нормализация цен в RUB
 - фичи: лаги t-1..t-7, скользящие mean/std, тренд, волатильность, месяц, one-hot маркетплейса, дисконт распродаж
-- CatBoost/LightGBM при наличии и достаточном числе точек, иначе тренд+сглаживание
-- мини-валидация на holdout (MAPE), скрываем прогноз при плохом качестве или сильном отклонении
+- глобальная модель (analysis.global_model, обучается офлайн) при достаточном числе точек, иначе тренд+сглаживание
+- модель с плохим MAPE на валидации не используется; прогноз скрываем при сильном отклонении
 """
 
 from __future__ import annotations
@@ -13,8 +13,10 @@ from datetime import timedelta
 
 from django.utils import timezone
 
-from products.currency import to_rub
-from products.models import OfferHistory
+from products.rollups import price_series
+from analysis.features import calc_features, is_available as features_available
+from analysis.global_model import get_global_model
+from analysis.history_store import load_series
 from analysis.models import SaleEvent
 
 MARKETPLACES = ["amazon", "wildberries", "ozon"]
@@ -78,33 +80,28 @@ def _sale_event_discount() -> float:
     return 0.0
 
 
-def _mape(y_true: List[float], y_pred: List[float]) -> float:
-    eps = 1e-6
-    errors = []
-    for t, p in zip(y_true, y_pred):
-        if t == 0:
-            continue
-        errors.append(abs((t - p) / (t + eps)))
-    if not errors:
-        return 1.0
-    return sum(errors) / len(errors)
-
-
 def advanced_predict(query_id: int, category: str, marketplace: str = "") -> Dict[str, float]:
-    history = list(
-        OfferHistory.objects.filter(query_id=query_id)
-        .order_by("collected_at")
-        .values("price", "currency", "marketplace", "collected_at")
-    )
-    if not history or len(history) < MIN_POINTS_ANY:
-        return {}
-
-    normalized = [
-        {"price": to_rub(float(h["price"]), h["currency"]), "marketplace": h["marketplace"], "collected_at": h["collected_at"]}
-        for h in history
-    ]
-    most_recent_mp = normalized[-1].get("marketplace", marketplace)
-    feats = _calc_features(normalized, most_recent_mp)
+    series = load_series(query_id)
+    if series is not None:
+        # колоночное хранилище: рублёвые цены идут в признаки массивом, без dict на точку
+        if len(series) < MIN_POINTS_ANY:
+            return {}
+        code = int(series.mp[-1])
+        most_recent_mp = MARKETPLACES[code] if code < len(MARKETPLACES) else marketplace
+        feats = calc_features(series.rub, most_recent_mp)
+    else:
+        # длинный горизонт читается из дневных баров, а не из всех сырых точек
+        normalized = [
+            {"price": h["rub"], "marketplace": h["marketplace"], "collected_at": h["collected_at"]}
+            for h in price_series(query_id)
+        ]
+        if len(normalized) < MIN_POINTS_ANY:
+            return {}
+        most_recent_mp = normalized[-1].get("marketplace", marketplace)
+        if features_available():
+            feats = calc_features([item["price"] for item in normalized], most_recent_mp)
+        else:
+            feats = _calc_features(normalized, most_recent_mp)
     if not feats:
         return {}
 
@@ -117,46 +114,16 @@ def advanced_predict(query_id: int, category: str, marketplace: str = "") -> Dic
     smoothed = feats["roll_mean"]
     projected = 0.7 * projected + 0.3 * smoothed
 
-    # CatBoost/LightGBM если данных >= MIN_POINTS_MODEL
+    # глобальная модель обучена офлайн (manage.py train_global_model), здесь — только инференс;
+    # модель с плохим качеством на валидации (MAPE) не используется
     if feats["count"] >= MIN_POINTS_MODEL:
-        try:
+        model = get_global_model()
+        if model is not None and model.metrics.get("mape", 1.0) <= MAPE_THRESHOLD:
             try:
-                from catboost import CatBoostRegressor  # type: ignore
-
-                model = CatBoostRegressor(
-                    iterations=60, depth=5, learning_rate=0.1, loss_function="RMSE", verbose=False
-                )
-                X = [[
-                    feats["mean"], feats["trend"], feats["volatility"], feats["count"], feats["month"],
-                    feats["roll_mean"], feats["roll_std"], *feats["lags"], *feats["mp_one_hot"]
-                ]]
-                y = [feats["last"]]
-                # мини-валидация на holdout (20% последних точек, если хватит)
-                holdout_start = max(0, feats["count"] - max(2, feats["count"] // 5))
-                holdout = feats["values"][holdout_start:]
-                train_vals = feats["values"][:holdout_start] or feats["values"]
-                model.fit(X, y)
-                pred_model = float(model.predict(X)[0])
-                if holdout:
-                    hold_pred = [pred_model for _ in holdout]
-                    mape = _mape(holdout, hold_pred)
-                    if mape > MAPE_THRESHOLD:
-                        return {}
-                projected = 0.7 * pred_model + 0.3 * smoothed
-            except ImportError:
-                from lightgbm import LGBMRegressor  # type: ignore
-
-                model = LGBMRegressor(n_estimators=80, learning_rate=0.08, max_depth=4)
-                X = [[
-                    feats["mean"], feats["trend"], feats["volatility"], feats["count"], feats["month"],
-                    feats["roll_mean"], feats["roll_std"], *feats["lags"], *feats["mp_one_hot"]
-                ]]
-                y = [feats["last"]]
-                model.fit(X, y)
-                pred_model = float(model.predict(X)[0])
+                pred_model = model.forecast(feats["values"], most_recent_mp)
                 projected = 0.7 * pred_model + 0.3 * smoothed
-        except Exception:
-            pass
+            except Exception as exc:
+                print(f"Global model inference error: {exc}")
 
     # ограничение по волатильности и минимум 0
     if feats["volatility"] > 0:
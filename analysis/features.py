@@ -0,0 +1,162 @@
+"""
+Векторизованный расчёт признаков для прогнозов.
+
+Ряды хранятся «рваным» пакетом: все цены подряд в одном float64-массиве
+``values`` и границы рядов в ``offsets`` (ряд i — values[offsets[i]:offsets[i + 1]]).
+batch_features считает признаки сразу для тысяч рядов без циклов Python по
+точкам: суммы через cumsum, последние точки и лаги через индексацию по
+границам. Признаки те же, что у advanced_predictor._calc_features и
+PricePredictor._volatility/_linear_trend, — эти функции остаются запасным
+путём без numpy.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from django.utils import timezone
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy необязателен
+    np = None
+
+MARKETPLACES = ["amazon", "wildberries", "ozon"]
+LAGS = 7
+ROLL_WINDOW = 3
+TREND_HORIZON = 7
+# порядок столбцов матрицы для моделей (как X в advanced_predict)
+FEATURE_COLUMNS = (
+    ["mean", "trend", "volatility", "count", "month", "roll_mean", "roll_std"]
+    + [f"lag_{i}" for i in range(1, LAGS + 1)]
+    + [f"mp_{name}" for name in MARKETPLACES]
+)
+
+
+def is_available() -> bool:
+    return np is not None
+
+
+def pack(series: Iterable[Sequence[float]]) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Ragged batch (values, offsets) from an iterable of price sequences."""
+    chunks = [np.asarray(s, dtype=np.float64) for s in series]
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    if chunks:
+        np.cumsum([len(chunk) for chunk in chunks], out=offsets[1:])
+        values = np.concatenate(chunks)
+    else:
+        values = np.zeros(0, dtype=np.float64)
+    return values, offsets
+
+
+def _segment_sum(values: "np.ndarray", starts: "np.ndarray", ends: "np.ndarray") -> "np.ndarray":
+    cumulative = np.concatenate([[0.0], np.cumsum(values)])
+    return cumulative[ends] - cumulative[starts]
+
+
+def batch_features(
+    values: "np.ndarray",
+    offsets: "np.ndarray",
+    marketplaces: Optional[Sequence[str]] = None,
+    month: Optional[int] = None,
+) -> Dict[str, "np.ndarray"]:
+    """
+    Features of every series in the ragged batch, one array element per series.
+    Series must be non-empty. ``lags`` has shape (n, 7), ``mp_one_hot`` (n, 3).
+    ``rel_volatility`` and ``linear_trend`` are the PricePredictor features
+    (std / mean and the 7-step regression shift over the given order).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    starts, ends = offsets[:-1], offsets[1:]
+    counts = ends - starts
+    if (counts < 1).any():
+        raise ValueError("batch_features: empty series in the batch")
+
+    mean = _segment_sum(values, starts, ends) / counts
+    centered = values - np.repeat(mean, counts)
+    # двухпроходная дисперсия: без потери точности на больших ценах
+    std = np.sqrt(_segment_sum(centered * centered, starts, ends) / counts)
+    last = values[ends - 1]
+    trend = np.where(counts > 1, last - values[np.maximum(ends - 2, starts)], 0.0)
+
+    # лаг i — i-я точка с конца, для коротких рядов — первая точка
+    steps = np.arange(1, LAGS + 1)
+    lags = values[np.where(counts[:, None] >= steps, ends[:, None] - steps, starts[:, None])]
+
+    window = np.minimum(counts, ROLL_WINDOW)
+    roll_mean = _segment_sum(values, ends - window, ends) / window
+    roll_sq = np.zeros(len(counts))
+    for k in range(ROLL_WINDOW):
+        point = values[np.maximum(ends - 1 - k, starts)]
+        roll_sq += np.where(k < window, (point - roll_mean) ** 2, 0.0)
+    roll_std = np.sqrt(roll_sq / window)
+
+    safe_mean = np.where(mean == 0, 1.0, mean)
+    rel_volatility = np.where(mean == 0, 0.0, std / safe_mean)
+
+    # регрессия по индексу точки: x центрирован, знаменатель n(n²-1)/12 в закрытой форме
+    positions = np.arange(len(values)) - np.repeat(starts, counts)
+    x_centered = positions - np.repeat((counts - 1) / 2.0, counts)
+    numerator = _segment_sum(x_centered * centered, starts, ends)
+    denominator = counts * (counts * counts - 1) / 12.0
+    slope = numerator / np.where(denominator == 0, 1.0, denominator)
+    linear_trend = np.where(counts >= 3, slope * TREND_HORIZON, 0.0)
+
+    mp_one_hot = np.zeros((len(counts), len(MARKETPLACES)), dtype=np.int64)
+    if marketplaces is not None:
+        codes = {name: i for i, name in enumerate(MARKETPLACES)}
+        for row, name in enumerate(marketplaces):
+            column = codes.get((name or "").lower())
+            if column is not None:
+                mp_one_hot[row, column] = 1
+
+    return {
+        "last": last,
+        "mean": mean,
+        "trend": trend,
+        "volatility": std,
+        "month": np.full(len(counts), month or timezone.now().month, dtype=np.int64),
+        "count": counts,
+        "roll_mean": roll_mean,
+        "roll_std": roll_std,
+        "lags": lags,
+        "mp_one_hot": mp_one_hot,
+        "rel_volatility": rel_volatility,
+        "linear_trend": linear_trend,
+    }
+
+
+def feature_matrix(features: Dict[str, "np.ndarray"]) -> "np.ndarray":
+    """Model input matrix with columns in FEATURE_COLUMNS order."""
+    scalars = [features[name] for name in FEATURE_COLUMNS[:7]]
+    return np.column_stack([*scalars, features["lags"], features["mp_one_hot"]]).astype(np.float64)
+
+
+def calc_features(values: Sequence[float], marketplace: str) -> Dict[str, object]:
+    """Features of one series in the format of advanced_predictor._calc_features."""
+    batch_values, offsets = pack([values])
+    batch = batch_features(batch_values, offsets, [marketplace])
+    feats: Dict[str, object] = {
+        name: float(batch[name][0])
+        for name in ("last", "mean", "trend", "volatility", "roll_mean", "roll_std")
+    }
+    feats["month"] = int(batch["month"][0])
+    feats["count"] = int(batch["count"][0])
+    feats["lags"] = batch["lags"][0].tolist()
+    feats["mp_one_hot"] = batch["mp_one_hot"][0].tolist()
+    feats["values"] = batch_values.tolist()
+    return feats
+
+
+def series_stats(values: Sequence[float]) -> Tuple[float, float]:
+    """(rel_volatility, linear_trend) of one series, as PricePredictor computes them."""
+    batch_values, offsets = pack([values])
+    batch = batch_features(batch_values, offsets)
+    return float(batch["rel_volatility"][0]), float(batch["linear_trend"][0])
+
+
+def features_for(series: List[Sequence[float]], marketplaces: Optional[Sequence[str]] = None):
+    """Convenience wrapper: pack ``series`` and compute their features in one call."""
+    values, offsets = pack(series)
+    return batch_features(values, offsets, marketplaces)
@@ -0,0 +1,368 @@
+"""
+Глобальная модель прогноза, обучаемая офлайн.
+
+manage.py train_global_model собирает обучающую выборку по всем рядам истории:
+для каждого ряда берутся точки отсечения, признаки префикса считаются
+analysis.features, целевая переменная — относительное изменение цены через
+HORIZON_DAYS дней. Признаки нормируются на последнюю цену, так что одна модель
+подходит товарам любой цены. Модель (CatBoost, LightGBM или ридж-регрессия на
+numpy) сохраняется версионированным артефактом в GLOBAL_MODEL["DIR"], а
+current.json указывает на текущую версию.
+
+Воркер загружает артефакт один раз (get_global_model) и перечитывает манифест
+не чаще RELOAD_INTERVAL секунд; в запросе выполняется только инференс.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import pickle
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from products.models import ProductQuery
+from products.rollups import price_series
+from .features import MARKETPLACES, batch_features, pack
+from .history_store import load_series
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy необязателен
+    np = None
+
+# версия раскладки признаков: артефакт другой версии не загружается
+FORMAT_VERSION = 1
+MIN_POINTS = 3
+MIN_SAMPLES = 50
+INPUT_COLUMNS = (
+    ["mean", "trend", "volatility", "log_count", "month", "roll_mean", "roll_std"]
+    + [f"lag_{i}" for i in range(1, 8)]
+    + [f"mp_{name}" for name in MARKETPLACES]
+)
+DEFAULTS = {
+    "HORIZON_DAYS": 30,
+    "RELOAD_INTERVAL": 300,
+}
+
+
+def _config() -> Dict:
+    return {
+        **DEFAULTS,
+        "DIR": Path(settings.BASE_DIR) / "models",
+        **getattr(settings, "GLOBAL_MODEL", {}),
+    }
+
+
+def query_history(query_id: int) -> Tuple["np.ndarray", "np.ndarray", List[str]]:
+    """(unix ts, RUB price, marketplace) columns of a query, the same series advanced_predict sees."""
+    series = load_series(query_id)
+    if series is not None:
+        marketplaces = [MARKETPLACES[code] if code < len(MARKETPLACES) else "" for code in series.mp.tolist()]
+        return np.asarray(series.ts, dtype=np.float64), np.asarray(series.rub, dtype=np.float64), marketplaces
+    points = price_series(query_id)
+    return (
+        np.fromiter((p["collected_at"].timestamp() for p in points), dtype=np.float64, count=len(points)),
+        np.fromiter((p["rub"] for p in points), dtype=np.float64, count=len(points)),
+        [p["marketplace"] for p in points],
+    )
+
+
+def model_inputs(features: Dict[str, "np.ndarray"]) -> "np.ndarray":
+    """Scale-free model matrix (INPUT_COLUMNS): prices relative to the last price."""
+    last = features["last"]
+    scale = np.where(last == 0, 1.0, last)
+    columns = [
+        features["mean"] / scale - 1,
+        features["trend"] / scale,
+        features["volatility"] / scale,
+        np.log1p(features["count"]),
+        features["month"],
+        features["roll_mean"] / scale - 1,
+        features["roll_std"] / scale,
+    ]
+    lags = features["lags"] / scale[:, None] - 1
+    return np.column_stack([*columns, lags, features["mp_one_hot"]]).astype(np.float64)
+
+
+# --- dataset --------------------------------------------------------------
+
+
+def _cut_points(ts: "np.ndarray", horizon: float, limit: int) -> List[Tuple[int, int]]:
+    """(prefix length, target index) pairs, at most ``limit`` spread over the series."""
+    n = len(ts)
+    if n <= MIN_POINTS:
+        return []
+    lengths = np.arange(MIN_POINTS, n)
+    targets = np.searchsorted(ts, ts[lengths - 1] + horizon, side="left")
+    valid = targets < n
+    lengths, targets = lengths[valid], targets[valid]
+    if len(lengths) > limit:
+        picked = np.unique(np.linspace(0, len(lengths) - 1, limit).round().astype(np.int64))
+        lengths, targets = lengths[picked], targets[picked]
+    return list(zip(lengths.tolist(), targets.tolist()))
+
+
+def build_dataset(
+    horizon_days: int,
+    samples_per_series: int = 20,
+    chunk_size: int = 500,
+    on_chunk: Optional[Callable[[Dict[str, int]], None]] = None,
+) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray", "np.ndarray"]:
+    """
+    Training samples from every query's history: model inputs, the relative
+    price change ``horizon_days`` later, the last price and the cut time.
+    Features of a chunk of queries are computed in one batch_features call.
+    """
+    horizon = horizon_days * 86400
+    inputs, targets, lasts, cut_ts = [], [], [], []
+    stats = {"queries": 0, "samples": 0}
+    query_ids = list(ProductQuery.objects.order_by("id").values_list("id", flat=True))
+    for start in range(0, len(query_ids), chunk_size):
+        prefixes, marketplaces, months, chunk_targets, chunk_ts = [], [], [], [], []
+        for query_id in query_ids[start:start + chunk_size]:
+            ts, rub, mps = query_history(query_id)
+            for length, target in _cut_points(ts, horizon, samples_per_series):
+                last = rub[length - 1]
+                if last <= 0:
+                    continue
+                prefixes.append(rub[:length])
+                marketplaces.append(mps[length - 1])
+                cut_at = datetime.fromtimestamp(ts[length - 1], tz=dt_timezone.utc)
+                months.append(timezone.localtime(cut_at).month)
+                chunk_targets.append(rub[target] / last - 1)
+                chunk_ts.append(ts[length - 1])
+        stats["queries"] += len(query_ids[start:start + chunk_size])
+        if prefixes:
+            values, offsets = pack(prefixes)
+            features = batch_features(values, offsets, marketplaces)
+            # месяц точки отсечения, а не сегодняшний
+            features["month"] = np.asarray(months, dtype=np.int64)
+            inputs.append(model_inputs(features))
+            lasts.append(features["last"])
+            targets.append(np.asarray(chunk_targets, dtype=np.float64))
+            cut_ts.append(np.asarray(chunk_ts, dtype=np.float64))
+            stats["samples"] += len(prefixes)
+        if on_chunk:
+            on_chunk(stats)
+    if not inputs:
+        empty = np.zeros(0, dtype=np.float64)
+        return np.zeros((0, len(INPUT_COLUMNS))), empty, empty, empty
+    return np.concatenate(inputs), np.concatenate(targets), np.concatenate(lasts), np.concatenate(cut_ts)
+
+
+# --- models ---------------------------------------------------------------
+
+
+class RidgeModel:
+    """Ridge regression on standardized inputs (numpy only), the fallback backend."""
+
+    def __init__(self, alpha: float = 1.0):
+        self.alpha = alpha
+        self.mean = self.scale = self.coef = None
+        self.intercept = 0.0
+
+    def fit(self, X: "np.ndarray", y: "np.ndarray") -> "RidgeModel":
+        self.mean = X.mean(axis=0)
+        self.scale = np.where(X.std(axis=0) == 0, 1.0, X.std(axis=0))
+        Z = (X - self.mean) / self.scale
+        self.intercept = float(y.mean())
+        gram = Z.T @ Z + self.alpha * np.eye(Z.shape[1])
+        self.coef = np.linalg.solve(gram, Z.T @ (y - self.intercept))
+        return self
+
+    def predict(self, X: "np.ndarray") -> "np.ndarray":
+        return ((np.asarray(X) - self.mean) / self.scale) @ self.coef + self.intercept
+
+
+def _make_model(backend: str):
+    if backend in ("auto", "catboost"):
+        try:
+            from catboost import CatBoostRegressor  # type: ignore
+
+            return "catboost", CatBoostRegressor(
+                iterations=300, depth=6, learning_rate=0.08, loss_function="RMSE", verbose=False
+            )
+        except ImportError:
+            if backend == "catboost":
+                raise
+    if backend in ("auto", "lightgbm"):
+        try:
+            from lightgbm import LGBMRegressor  # type: ignore
+
+            return "lightgbm", LGBMRegressor(n_estimators=300, learning_rate=0.05, max_depth=6, verbose=-1)
+        except ImportError:
+            if backend == "lightgbm":
+                raise
+    return "ridge", RidgeModel()
+
+
+def _price_mape(pred_change: "np.ndarray", true_change: "np.ndarray") -> float:
+    # ошибка в цене: last * (1 + change), last сокращается
+    actual = 1 + true_change
+    mask = actual > 0
+    if not mask.any():
+        return 1.0
+    return float(np.mean(np.abs(pred_change[mask] - true_change[mask]) / actual[mask]))
+
+
+def train(
+    horizon_days: Optional[int] = None,
+    samples_per_series: int = 20,
+    holdout: float = 0.2,
+    backend: str = "auto",
+    on_chunk: Optional[Callable[[Dict[str, int]], None]] = None,
+) -> Dict:
+    """
+    Build the dataset, validate on the latest ``holdout`` share of cut points,
+    refit on everything and return the artifact dict (see save_artifact).
+    """
+    horizon_days = horizon_days or _config()["HORIZON_DAYS"]
+    X, y, _lasts, cut_ts = build_dataset(horizon_days, samples_per_series, on_chunk=on_chunk)
+    if len(y) < MIN_SAMPLES:
+        raise ValueError(f"not enough history: {len(y)} samples, need {MIN_SAMPLES}")
+
+    # валидация по времени: модель не видит будущее относительно holdout
+    order = np.argsort(cut_ts, kind="stable")
+    split = int(len(order) * (1 - holdout))
+    train_idx, valid_idx = order[:split], order[split:]
+    kind, model = _make_model(backend)
+    metrics = {"samples": int(len(y)), "valid_samples": int(len(valid_idx))}
+    if len(valid_idx) and len(train_idx) >= MIN_SAMPLES // 2:
+        model.fit(X[train_idx], y[train_idx])
+        metrics["mape"] = _price_mape(np.asarray(model.predict(X[valid_idx])), y[valid_idx])
+        # наивный прогноз «цена не изменится» для сравнения
+        metrics["naive_mape"] = _price_mape(np.zeros(len(valid_idx)), y[valid_idx])
+    kind, model = _make_model(backend)
+    model.fit(X, y)
+
+    return {
+        "format": FORMAT_VERSION,
+        "version": timezone.now().strftime("%Y%m%d-%H%M%S"),
+        "kind": kind,
+        "horizon_days": horizon_days,
+        "columns": INPUT_COLUMNS,
+        "metrics": metrics,
+        "model": model,
+    }
+
+
+# --- artifacts ------------------------------------------------------------
+
+
+def _manifest_path(directory: Path) -> Path:
+    return directory / "current.json"
+
+
+def save_artifact(artifact: Dict, directory=None, keep: int = 3) -> Path:
+    """Write the artifact, point current.json at it and keep the ``keep`` newest versions."""
+    directory = Path(directory or _config()["DIR"])
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"global_model-{artifact['version']}.pkl"
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as fh:
+        pickle.dump(artifact, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    tmp_manifest = f"{_manifest_path(directory)}.tmp"
+    with open(tmp_manifest, "w", encoding="utf-8") as fh:
+        json.dump(
+            {
+                "version": artifact["version"],
+                "file": path.name,
+                "kind": artifact["kind"],
+                "metrics": artifact["metrics"],
+            },
+            fh,
+            indent=2,
+        )
+    os.replace(tmp_manifest, _manifest_path(directory))
+
+    for old in sorted(directory.glob("global_model-*.pkl"), reverse=True)[max(keep, 1):]:
+        old.unlink()
+    return path
+
+
+class GlobalModel:
+    def __init__(self, artifact: Dict):
+        self.version = artifact["version"]
+        self.kind = artifact["kind"]
+        self.horizon_days = artifact["horizon_days"]
+        self.metrics = artifact.get("metrics", {})
+        self.model = artifact["model"]
+
+    def forecast(self, values: Sequence[float], marketplace: str) -> float:
+        """Price in ``horizon_days`` for one chronological RUB series."""
+        batch_values, offsets = pack([values])
+        features = batch_features(batch_values, offsets, [marketplace])
+        change = float(np.asarray(self.model.predict(model_inputs(features)))[0])
+        return float(features["last"][0]) * (1 + change)
+
+
+class _Loader:
+    """Process-wide holder: loads the current artifact once, rechecks the manifest periodically."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._model: Optional[GlobalModel] = None
+        self._manifest_mtime: Optional[float] = None
+        self._checked_at: Optional[float] = None
+
+    def _fresh(self, interval: float) -> bool:
+        return self._checked_at is not None and time.monotonic() - self._checked_at < interval
+
+    def get(self) -> Optional[GlobalModel]:
+        config = _config()
+        if self._fresh(config["RELOAD_INTERVAL"]):
+            return self._model
+        with self._lock:
+            if self._fresh(config["RELOAD_INTERVAL"]):
+                return self._model
+            self._checked_at = time.monotonic()
+            directory = Path(config["DIR"])
+            try:
+                mtime = _manifest_path(directory).stat().st_mtime
+            except OSError:
+                self._model, self._manifest_mtime = None, None
+                return None
+            if mtime == self._manifest_mtime:
+                return self._model
+            self._manifest_mtime = mtime
+            try:
+                with open(_manifest_path(directory), encoding="utf-8") as fh:
+                    manifest = json.load(fh)
+                with open(directory / manifest["file"], "rb") as fh:
+                    artifact = pickle.load(fh)
+                if artifact.get("format") != FORMAT_VERSION:
+                    print(f"Global model {manifest['version']}: format {artifact.get('format')} is not supported")
+                    self._model = None
+                else:
+                    self._model = GlobalModel(artifact)
+            except Exception as exc:
+                print(f"Global model load error: {exc}")
+                self._model = None
+            return self._model
+
+    def reset(self) -> None:
+        with self._lock:
+            self._model, self._manifest_mtime, self._checked_at = None, None, None
+
+
+_loader = _Loader()
+
+
+def get_global_model() -> Optional[GlobalModel]:
+    """Current global model of this process, or None (no numpy, no artifact, load error)."""
+    if np is None:
+        return None
+    return _loader.get()
+
+
+def reset_global_model() -> None:
+    _loader.reset()
@@ -0,0 +1,312 @@
+"""
+Колоночное хранилище истории цен для аналитики.
+
+manage.py sync_history_store выгружает OfferHistory в файлы по запросам:
+<DIR>/<query_id % 256>/<query_id>/{id,ts,rub,mp,until}.npy — id точки,
+unix-время, цена в рублях (float64), код маркетплейса (uint8) и seen_until
+(unix-время, NaN — нет). Синхронизация инкрементальная: в manifest.json
+хранится последний выгруженный id.
+Читатель открывает файлы через np.load(mmap_mode="r"), так что ряд не
+копируется в память процесса; точки, записанные после последней синхронизации,
+дочитываются из БД, а seen_until недавних точек (их ещё продлевает
+products.pipeline) — обновляется. load() отдаёт тот же ряд, что
+products.rollups.price_series: дневные бары старше RAW_DAYS (из БД, их немного)
+и сырые точки окна с развёрнутыми сериями одной цены. Окно — срез memmap;
+копия появляется, только если в нём есть серии, новые точки или бары.
+numpy — необязательная зависимость: без него (или при
+HISTORY_STORE["ENABLED"] = False) прогнозы читают историю через ORM.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from products.currency import to_rub_at_many
+from products.models import OfferHistory
+from products.pipeline import DEFAULT_HEARTBEAT
+from products.rollups import daily_points, run_step, series_window
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy необязателен
+    np = None
+
+MARKETPLACES = ["amazon", "wildberries", "ozon"]
+MARKETPLACE_CODES = {name: code for code, name in enumerate(MARKETPLACES)}
+UNKNOWN_MARKETPLACE = 255
+COLUMNS = ("id", "ts", "rub", "mp", "until")
+ROW_FIELDS = ("id", "marketplace", "currency", "price", "price_rub_kop", "collected_at", "seen_until")
+
+
+def _config() -> Dict:
+    return {
+        "ENABLED": False,
+        "DIR": Path(settings.BASE_DIR) / "history_store",
+        **getattr(settings, "HISTORY_STORE", {}),
+    }
+
+
+def is_enabled() -> bool:
+    return np is not None and bool(_config()["ENABLED"])
+
+
+class Series(NamedTuple):
+    """Columns of one query's history, oldest first (numpy arrays or memmaps)."""
+
+    id: "np.ndarray"
+    ts: "np.ndarray"
+    rub: "np.ndarray"
+    mp: "np.ndarray"
+    until: "np.ndarray"
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def since(self, timestamp: float) -> "Series":
+        # ts отсортирован, срез — это view без копирования
+        start = int(np.searchsorted(self.ts, timestamp, side="left"))
+        return Series(*(column[start:] for column in self))
+
+    def tail(self, n: int) -> "Series":
+        return Series(*(column[-n:] for column in self)) if n else self
+
+    def expanded(self, step: Optional[float] = None) -> "Series":
+        """
+        Series with every run expanded (see products.rollups.expand_runs): a point
+        is repeated every ``step`` seconds while ``until`` is later, plus once at
+        ``until``. Repeated points keep their id; ``until`` of the result is NaN.
+        Without runs the series itself is returned, no copy is made.
+        """
+        step = float(step or run_step())
+        ts = np.asarray(self.ts, dtype=np.float64)
+        until = np.asarray(self.until, dtype=np.float64)
+        with np.errstate(invalid="ignore"):
+            has_run = until > ts
+        if not has_run.any():
+            return self
+        span = np.where(has_run, until - ts, 0.0)
+        # точки сетки строго раньше until и ещё одна — в самом until
+        extra = np.where(span > 0, np.ceil(span / step), 0).astype(np.int64)
+        index = np.repeat(np.arange(len(ts)), extra + 1)
+        starts = np.cumsum(extra + 1) - (extra + 1)
+        k = np.arange(len(index)) - np.repeat(starts, extra + 1)
+        new_ts = np.where(k == extra[index], np.where(k > 0, until[index], ts[index]), ts[index] + k * step)
+        order = np.argsort(new_ts, kind="stable")
+        index = index[order]
+        return Series(
+            np.asarray(self.id)[index],
+            new_ts[order],
+            np.asarray(self.rub)[index],
+            np.asarray(self.mp)[index],
+            np.full(len(index), np.nan),
+        )
+
+
+def _columns_from_rows(rows: List[dict]) -> Dict[str, "np.ndarray"]:
+    # строки с price_rub_kop уже в рублях; остальные пересчитываются одним вызовом
+    stored = [row["price_rub_kop"] is not None for row in rows]
+    rub = to_rub_at_many(
+        [row["price_rub_kop"] / 100 if ok else row["price"] for row, ok in zip(rows, stored)],
+        ["RUB" if ok else row["currency"] for row, ok in zip(rows, stored)],
+        [row["collected_at"] for row in rows],
+    )
+    return {
+        "id": np.fromiter((row["id"] for row in rows), dtype=np.int64, count=len(rows)),
+        "ts": np.fromiter((row["collected_at"].timestamp() for row in rows), dtype=np.float64, count=len(rows)),
+        "rub": np.asarray(rub, dtype=np.float64),
+        "mp": np.fromiter(
+            (MARKETPLACE_CODES.get(row["marketplace"], UNKNOWN_MARKETPLACE) for row in rows),
+            dtype=np.uint8,
+            count=len(rows),
+        ),
+        "until": _until_column(rows),
+    }
+
+
+def _columns_from_bars(bars: List[dict]) -> Dict[str, "np.ndarray"]:
+    # точки products.rollups.daily_points: цена уже в рублях, серий нет
+    return {
+        "id": np.zeros(len(bars), dtype=np.int64),
+        "ts": np.fromiter((bar["collected_at"].timestamp() for bar in bars), dtype=np.float64, count=len(bars)),
+        "rub": np.fromiter((bar["rub"] for bar in bars), dtype=np.float64, count=len(bars)),
+        "mp": np.fromiter(
+            (MARKETPLACE_CODES.get(bar["marketplace"], UNKNOWN_MARKETPLACE) for bar in bars),
+            dtype=np.uint8,
+            count=len(bars),
+        ),
+        "until": np.full(len(bars), np.nan),
+    }
+
+
+def _until_column(rows: List[dict]) -> "np.ndarray":
+    return np.fromiter(
+        (row["seen_until"].timestamp() if row.get("seen_until") else np.nan for row in rows),
+        dtype=np.float64,
+        count=len(rows),
+    )
+
+
+class HistoryStore:
+    def __init__(self, root=None):
+        self.root = Path(root or _config()["DIR"])
+
+    def _dir(self, query_id: int) -> Path:
+        return self.root / f"{query_id % 256:02x}" / str(query_id)
+
+    # --- manifest --------------------------------------------------------
+
+    def _manifest_path(self) -> Path:
+        return self.root / "manifest.json"
+
+    def last_synced_id(self) -> int:
+        path = self._manifest_path()
+        if not path.exists():
+            return 0
+        with open(path, encoding="utf-8") as fh:
+            return int(json.load(fh).get("last_id", 0))
+
+    def _save_manifest(self, last_id: int) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{self._manifest_path()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump({"last_id": last_id}, fh)
+        os.replace(tmp_path, self._manifest_path())
+
+    # --- write -----------------------------------------------------------
+
+    def clear(self) -> None:
+        if self.root.exists():
+            shutil.rmtree(self.root)
+
+    def append(self, query_id: int, rows: List[dict]) -> None:
+        """Append rows (ordered by id) to the query's column files."""
+        if not rows:
+            return
+        new = _columns_from_rows(rows)
+        current = self.open(query_id)
+        directory = self._dir(query_id)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in COLUMNS:
+            column = new[name]
+            if current is not None:
+                column = np.concatenate([getattr(current, name), column])
+            tmp_path = directory / f"{name}.tmp.npy"
+            np.save(tmp_path, column)
+            os.replace(tmp_path, directory / f"{name}.npy")
+
+    def sync(self, chunk_size: int = 50000, on_chunk=None) -> Dict[str, int]:
+        """Export OfferHistory rows added since the last sync."""
+        last_id = self.last_synced_id()
+        stats = {"rows": 0, "queries": 0}
+        while True:
+            rows = list(
+                OfferHistory.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values("query_id", *ROW_FIELDS)[:chunk_size]
+            )
+            if not rows:
+                break
+            by_query: Dict[int, List[dict]] = {}
+            for row in rows:
+                by_query.setdefault(row["query_id"], []).append(row)
+            for query_id, query_rows in by_query.items():
+                self.append(query_id, query_rows)
+            last_id = rows[-1]["id"]
+            # контрольная точка после каждой пачки
+            self._save_manifest(last_id)
+            stats["rows"] += len(rows)
+            stats["queries"] += len(by_query)
+            if on_chunk:
+                on_chunk(stats)
+        return stats
+
+    # --- read ------------------------------------------------------------
+
+    def open(self, query_id: int) -> Optional[Series]:
+        directory = self._dir(query_id)
+        if not (directory / "ts.npy").exists():
+            return None
+        columns = [np.load(directory / f"{name}.npy", mmap_mode="r") for name in COLUMNS[:-1]]
+        until_path = directory / "until.npy"
+        # выгрузки до появления seen_until: серий нет
+        columns.append(
+            np.load(until_path, mmap_mode="r") if until_path.exists() else np.full(len(columns[1]), np.nan)
+        )
+        # файлы заменяются по одному: при гонке с sync берём общую длину
+        size = min(len(column) for column in columns)
+        return Series(*(column[:size] for column in columns))
+
+    def load(
+        self, query_id: int, raw_days: Optional[int] = None, max_days: Optional[int] = None
+    ) -> Optional[Series]:
+        """
+        Series of ``query_id`` shaped like products.rollups.price_series: daily
+        bars older than ``raw_days`` (``id`` 0), then the raw points of the
+        window from the column files plus points written after the last sync,
+        with runs expanded. Returns None when the query was never exported.
+        """
+        series = self.open(query_id)
+        if series is None:
+            return None
+        raw_since, oldest_day = series_window(raw_days, max_days)
+        last_id = int(series.id[-1]) if len(series) else 0
+        # сырые точки старше окна заменены дневными барами — из файлов берём только срез окна
+        series = series.since(raw_since.timestamp())
+        heartbeat = getattr(settings, "OFFER_HISTORY_HEARTBEAT", DEFAULT_HEARTBEAT)
+        # одним запросом: новые точки и seen_until выгруженных, которые ещё могут продлеваться
+        rows = list(
+            OfferHistory.objects.filter(query_id=query_id)
+            .filter(Q(id__gt=last_id) | Q(collected_at__gte=timezone.now() - timedelta(seconds=heartbeat)))
+            .order_by("id")
+            .values(*ROW_FIELDS)
+        )
+        synced = [row for row in rows if row["id"] <= last_id]
+        tail = [row for row in rows if row["id"] > last_id and row["collected_at"] >= raw_since]
+        if synced and len(series):
+            positions = np.searchsorted(series.id, [row["id"] for row in synced])
+            found = positions < len(series)
+            positions = positions[found]
+            matched = np.asarray(series.id)[positions] == np.asarray([row["id"] for row in synced])[found]
+            fresh_until = _until_column(synced)[found][matched]
+            positions = positions[matched]
+            current = np.asarray(series.until)[positions]
+            # копируем until окна, только если seen_until действительно продлился
+            if not np.array_equal(current, fresh_until, equal_nan=True):
+                until = np.array(series.until, dtype=np.float64)
+                until[positions] = fresh_until
+                series = Series(series.id, series.ts, series.rub, series.mp, until)
+        if tail:
+            new = _columns_from_rows(tail)
+            series = Series(*(np.concatenate([getattr(series, name), new[name]]) for name in COLUMNS))
+        series = series.expanded()
+        bars = daily_points(query_id, raw_since, oldest_day)
+        if bars:
+            head = _columns_from_bars(bars)
+            series = Series(*(np.concatenate([head[name], getattr(series, name)]) for name in COLUMNS))
+        return series
+
+
+_store: Optional[HistoryStore] = None
+
+
+def get_history_store() -> HistoryStore:
+    global _store
+    if _store is None:
+        _store = HistoryStore()
+    return _store
+
+
+def load_series(query_id: int) -> Optional[Series]:
+    """Series from the columnar store, or None if it is disabled or has no file for the query."""
+    if not is_enabled():
+        return None
+    return get_history_store().load(query_id)
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.history_store import HistoryStore, np
+
+
+class Command(BaseCommand):
+    help = (
+        "Выгружает новые точки OfferHistory в колоночное хранилище (analysis.history_store), "
+        "которое прогнозы читают через mmap."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Удалить хранилище и выгрузить всю историю заново.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=50000,
+            help="Сколько точек читать из БД за раз.",
+        )
+
+    def handle(self, *args, **options):
+        if np is None:
+            raise CommandError("Для колоночного хранилища нужен numpy (pip install numpy)")
+        store = HistoryStore()
+        if options["rebuild"]:
+            store.clear()
+        stats = store.sync(
+            chunk_size=options["chunk_size"],
+            on_chunk=lambda s: self.stdout.write(f"... {s['rows']} rows exported"),
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Экспортировано точек: {stats['rows']} (last id {store.last_synced_id()}) в {store.root}"
+            )
+        )
@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.global_model import np, save_artifact, train
+
+
+class Command(BaseCommand):
+    help = (
+        "Обучает одну глобальную модель прогноза по всей истории OfferHistory и сохраняет "
+        "версионированный артефакт (analysis.global_model); воркеры подхватывают его без перезапуска."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--horizon-days",
+            type=int,
+            default=None,
+            help="Горизонт прогноза в днях (по умолчанию GLOBAL_MODEL['HORIZON_DAYS']).",
+        )
+        parser.add_argument(
+            "--samples-per-series",
+            type=int,
+            default=20,
+            help="Сколько точек отсечения брать из одного ряда.",
+        )
+        parser.add_argument(
+            "--holdout",
+            type=float,
+            default=0.2,
+            help="Доля самых поздних точек отсечения для валидации.",
+        )
+        parser.add_argument(
+            "--backend",
+            choices=["auto", "catboost", "lightgbm", "ridge"],
+            default="auto",
+            help="Модель: auto — CatBoost, затем LightGBM, затем ридж-регрессия на numpy.",
+        )
+        parser.add_argument(
+            "--output-dir",
+            default=None,
+            help="Каталог артефактов (по умолчанию GLOBAL_MODEL['DIR']).",
+        )
+        parser.add_argument(
+            "--keep",
+            type=int,
+            default=3,
+            help="Сколько последних версий артефакта хранить.",
+        )
+
+    def handle(self, *args, **options):
+        if np is None:
+            raise CommandError("Для обучения глобальной модели нужен numpy (pip install numpy)")
+        try:
+            artifact = train(
+                horizon_days=options["horizon_days"],
+                samples_per_series=options["samples_per_series"],
+                holdout=options["holdout"],
+                backend=options["backend"],
+                on_chunk=lambda s: self.stdout.write(f"... {s['queries']} queries, {s['samples']} samples"),
+            )
+        except ImportError as exc:
+            raise CommandError(f"Модель {options['backend']} недоступна: {exc}")
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        metrics = artifact["metrics"]
+        if "mape" in metrics:
+            self.stdout.write(
+                f"Validation MAPE {metrics['mape']:.3f} (naive {metrics['naive_mape']:.3f}) "
+                f"on {metrics['valid_samples']} samples"
+            )
+        path = save_artifact(artifact, options["output_dir"], keep=options["keep"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Глобальная модель {artifact['kind']} v{artifact['version']}: "
+                f"{metrics['samples']} samples, горизонт {artifact['horizon_days']} дн. -> {path}"
+            )
+        )
@@ -1,23 +1,26 @@
-import requests
 from django.core.management.base import BaseCommand
 
-from analysis.models import CurrencyRate
+from analysis.models import CurrencyRate, CurrencyRateHistory
+from products.currency import fetch_cbr_snapshot, get_rate_service
 
 
 class Command(BaseCommand):
-    help = "Обновляет курсы валют из ЦБ (latest.js) и сохраняет в БД."
+    help = "Обновляет курсы валют из ЦБ (latest.js): текущий курс и точка в ленте CurrencyRateHistory."
 
     def handle(self, *args, **options):
         try:
-            resp = requests.get("https://www.cbr-xml-daily.ru/latest.js", timeout=8)
-            resp.raise_for_status()
-            data = resp.json()
-            rates = data.get("rates", {})
+            as_of, rates = fetch_cbr_snapshot()
             updated = 0
-            for code, val in rates.items():
-                inv = 1 / float(val)
-                CurrencyRate.objects.update_or_create(code=code, defaults={"rate": inv})
+            for code, rate in rates.items():
+                CurrencyRate.objects.update_or_create(code=code, defaults={"rate": rate})
                 updated += 1
-            self.stdout.write(self.style.SUCCESS(f"Обновлено курсов: {updated}"))
+            # лента только дополняется; повторный запуск за ту же дату ничего не меняет
+            CurrencyRateHistory.objects.bulk_create(
+                [CurrencyRateHistory(code=code, rate=rate, valid_from=as_of) for code, rate in rates.items()],
+                ignore_conflicts=True,
+            )
+            # сразу публикуем новые курсы в общий кэш для всех воркеров
+            get_rate_service().refresh()
+            self.stdout.write(self.style.SUCCESS(f"Обновлено курсов: {updated} (на {as_of:%Y-%m-%d})"))
         except Exception as exc:
             self.stderr.write(self.style.ERROR(f"Не удалось обновить курсы: {exc}"))
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:26
+
+from django.db import migrations, models
+
+
+def seed_timeline(apps, schema_editor):
+    # текущие курсы становятся первыми точками ленты
+    CurrencyRate = apps.get_model("analysis", "CurrencyRate")
+    CurrencyRateHistory = apps.get_model("analysis", "CurrencyRateHistory")
+    CurrencyRateHistory.objects.bulk_create(
+        [
+            CurrencyRateHistory(code=rate.code, rate=rate.rate, valid_from=rate.updated_at)
+            for rate in CurrencyRate.objects.all()
+        ],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrencyRateHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=8)),
+                ('rate', models.DecimalField(decimal_places=6, max_digits=16)),
+                ('valid_from', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['code', 'valid_from'],
+                'constraints': [models.UniqueConstraint(fields=('code', 'valid_from'), name='uniq_currency_rate_point')],
+            },
+        ),
+        migrations.RunPython(seed_timeline, migrations.RunPython.noop),
+    ]
@@ -10,6 +10,24 @@ class CurrencyRate(models.Model):
         return f"{self.code}: {self.rate}"
 
 
+class CurrencyRateHistory(models.Model):
+    """Лента курсов: курс code действует с valid_from до следующей записи."""
+
+    code = models.CharField(max_length=8)
+    rate = models.DecimalField(max_digits=16, decimal_places=6)
+    valid_from = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["code", "valid_from"]
+        constraints = [
+            models.UniqueConstraint(fields=["code", "valid_from"], name="uniq_currency_rate_point")
+        ]
+
+    def __str__(self):
+        return f"{self.code}: {self.rate} с {self.valid_from:%Y-%m-%d}"
+
+
 class SaleEvent(models.Model):
     name = models.CharField(max_length=120)
     start_date = models.DateField()
@@ -1,12 +1,14 @@
 from __future__ import annotations
 
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
-import requests
 from django.utils import timezone
 
-from products.models import OfferHistory
+from products.currency import to_rub
+from products.rollups import price_series
+from .features import is_available as features_available, series_stats
+from .history_store import load_series
 from .seasonal_analyzer import SeasonalAnalyzer
 
 
@@ -22,15 +24,21 @@ class PricePredictor:
         self.alpha = smoothing
         self.base_currency = base_currency
         self.seasonal = SeasonalAnalyzer()
-        self.rate_cache: Dict[str, float] = {"RUB": 1.0}
 
     def predict(self, query_id: int, category: str) -> Dict[str, object]:
-        history = list(
-            OfferHistory.objects.filter(query_id=query_id)
-            .order_by("-collected_at")[:60]
-            .values("price", "currency", "collected_at")
-        )
-        if not history:
+        series = load_series(query_id)
+        if series is not None:
+            # колоночное хранилище: рублёвые цены последних 60 точек, новые первыми — срез массива
+            normalized = series.tail(60).rub[::-1]
+        else:
+            # последние 60 точек: сырые за последние дни, дальше — дневные бары
+            history = list(reversed(price_series(query_id)[-60:]))
+            # рублёвая цена уже посчитана при записи (price_rub_kop)
+            normalized = [
+                h["rub"] if h.get("rub") is not None else self._to_base(float(h["price"]), h["currency"])
+                for h in history
+            ]
+        if not len(normalized):
             return {
                 "current_price": None,
                 "forecast_price": None,
@@ -38,29 +46,25 @@ class PricePredictor:
                 "note": "Недостаточно данных для прогноза",
             }
 
-        normalized = [
-            self._to_base(float(h["price"]), h["currency"]) for h in history
-        ]
-        hist_for_smoothing = [
-            {"price": price, "collected_at": h["collected_at"]}
-            for price, h in zip(normalized, history)
-        ]
-
-        smoothed, last_price = self._exponential_smoothing(hist_for_smoothing)
-        trend_adj = self._linear_trend(hist_for_smoothing)
+        smoothed, last_price = self._exponential_smoothing(normalized)
+        if features_available():
+            volatility, trend_adj = series_stats(normalized)
+        else:
+            hist_for_smoothing = [{"price": price} for price in normalized]
+            volatility = self._volatility(hist_for_smoothing)
+            trend_adj = self._linear_trend(hist_for_smoothing)
         seasonal_discount = self._category_season_discount(category)
         sale_event_discount = self._sale_event_discount()
 
         discount_total = 1 - ((seasonal_discount + sale_event_discount) / 100.0)
         forecast_price = (smoothed + trend_adj) * max(discount_total, 0.5)
 
-        volatility = self._volatility(hist_for_smoothing)
         confidence = 0.5
-        if len(history) >= 10:
+        if len(normalized) >= 10:
             confidence = 0.65
-        if len(history) >= 25:
+        if len(normalized) >= 25:
             confidence = 0.75
-        if volatility < 0.08 and len(history) >= 15:
+        if volatility < 0.08 and len(normalized) >= 15:
             confidence += 0.05
 
         return {
@@ -72,50 +76,25 @@ class PricePredictor:
                 "seasonal": seasonal_discount,
                 "sale_event": sale_event_discount,
             },
-            "points": len(history),
+            "points": len(normalized),
             "volatility": round(volatility, 3),
             "trend": round(trend_adj, 2),
         }
 
     def _exponential_smoothing(
-        self, history: List[Dict]
+        self, prices: Sequence[float]
     ) -> Tuple[float, float]:
-        hist = list(reversed(history))  # chronological
-        smoothed = hist[0]["price"]
+        hist = [float(price) for price in reversed(prices)]  # chronological
+        smoothed = hist[0]
         last = smoothed
-        for item in hist[1:]:
-            price = item["price"]
+        for price in hist[1:]:
             smoothed = self.alpha * price + (1 - self.alpha) * smoothed
             last = price
         return smoothed, last
 
     def _to_base(self, price: float, currency: Optional[str]) -> float:
-        curr = (currency or "").upper()
-        rate = self._get_rate(curr)
-        return price * rate
-
-    def _get_rate(self, currency: str) -> float:
-        if currency in self.rate_cache:
-            return self.rate_cache[currency]
-        if not currency or currency == "RUB":
-            self.rate_cache[currency or "RUB"] = 1.0
-            return 1.0
-        try:
-            resp = requests.get("https://www.cbr-xml-daily.ru/latest.js", timeout=6)
-            if resp.status_code == 200:
-                data = resp.json()
-                rate_val = data.get("rates", {}).get(currency)
-                if rate_val:
-                    # в API база RUB, rates[currency] = currency_per_RUB; нам нужен RUB_per_currency
-                    inv = 1 / float(rate_val)
-                    self.rate_cache[currency] = inv
-                    return inv
-        except Exception:
-            pass
-        # fallback: хранить грубый курс, если запрос не удался
-        fallback = 90.0 if currency == "USD" else 100.0
-        self.rate_cache[currency] = fallback
-        return fallback
+        # курсы берутся из общего сервиса (products.currency), без запросов в сеть
+        return to_rub(price, currency)
 
     def _category_season_discount(self, category: str) -> float:
         """
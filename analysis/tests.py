@@ -1,3 +1,388 @@
-from django.test import TestCase
-
-# Create your tests here.
+"""
+Векторизованные признаки (analysis.features): совпадение с исходными функциями
+и микробенчмарк стоимости на один ряд; прогнозы и колоночное хранилище на
+истории, где стабильная цена записана одной строкой с seen_until.
+
+    python manage.py test analysis
+    FEATURE_BENCH_SERIES=20000 python manage.py test analysis
+"""
+
+import io
+import logging
+import os
+import random
+import tempfile
+import time
+import unittest
+from datetime import timedelta
+from unittest import mock
+from decimal import Decimal
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from analysis import features, global_model, history_store
+from analysis.history_store import np
+from analysis.advanced_predictor import MIN_POINTS_MODEL, _calc_features, advanced_predict
+from analysis.global_model import RidgeModel, get_global_model, reset_global_model, save_artifact
+from analysis.predictor import PricePredictor
+from analysis.models import CurrencyRate
+from products.models import OfferHistory, OfferHistoryDaily, ProductQuery
+from products.rollups import price_series
+
+logger = logging.getLogger(__name__)
+
+BENCH_SERIES = int(os.environ.get("FEATURE_BENCH_SERIES", "2000"))
+BENCH_POINTS = int(os.environ.get("FEATURE_BENCH_POINTS", "60"))
+
+
+def _random_series(rng, count, max_points):
+    # короткие ряды (1-3 точки) проверяют ветки для лагов и окна
+    lengths = [1, 2, 3] + [rng.randint(1, max_points) for _ in range(count - 3)]
+    return [[round(rng.uniform(50, 5000), 2) for _ in range(n)] for n in lengths]
+
+
+@unittest.skipUnless(features.is_available(), "numpy is not installed")
+class FeatureParityTests(SimpleTestCase):
+    def setUp(self):
+        self.rng = random.Random(42)
+        self.series = _random_series(self.rng, 300, 120)
+        self.marketplaces = [self.rng.choice(features.MARKETPLACES + [""]) for _ in self.series]
+
+    def test_matches_calc_features(self):
+        batch = features.features_for(self.series, self.marketplaces)
+        for i, (values, marketplace) in enumerate(zip(self.series, self.marketplaces)):
+            expected = _calc_features([{"price": v} for v in values], marketplace)
+            for name in ("last", "mean", "trend", "volatility", "roll_mean", "roll_std"):
+                self.assertAlmostEqual(float(batch[name][i]), expected[name], places=6, msg=f"{name} of #{i}")
+            self.assertEqual(int(batch["count"][i]), expected["count"])
+            self.assertEqual(int(batch["month"][i]), expected["month"])
+            self.assertEqual(batch["mp_one_hot"][i].tolist(), expected["mp_one_hot"])
+            for got, want in zip(batch["lags"][i].tolist(), expected["lags"]):
+                self.assertAlmostEqual(got, want, places=6)
+
+    def test_single_series_matches_calc_features(self):
+        values = self.series[10]
+        got = features.calc_features(values, "ozon")
+        expected = _calc_features([{"price": v} for v in values], "ozon")
+        self.assertEqual(set(got), set(expected))
+        self.assertEqual(got["values"], expected["values"])
+        self.assertAlmostEqual(got["volatility"], expected["volatility"], places=6)
+
+    def test_matches_price_predictor(self):
+        predictor = PricePredictor()
+        batch = features.features_for(self.series)
+        for i, values in enumerate(self.series):
+            history = [{"price": v} for v in values]
+            self.assertAlmostEqual(
+                float(batch["rel_volatility"][i]), predictor._volatility(history), places=9
+            )
+            self.assertAlmostEqual(
+                float(batch["linear_trend"][i]), predictor._linear_trend(history), places=6
+            )
+
+    def test_feature_matrix_columns(self):
+        batch = features.features_for(self.series[:5], self.marketplaces[:5])
+        matrix = features.feature_matrix(batch)
+        self.assertEqual(matrix.shape, (5, len(features.FEATURE_COLUMNS)))
+        self.assertEqual(matrix[2, features.FEATURE_COLUMNS.index("count")], 3)
+
+    def test_empty_series_rejected(self):
+        with self.assertRaises(ValueError):
+            features.features_for([[1.0], []])
+
+
+@unittest.skipUnless(features.is_available(), "numpy is not installed")
+class FeatureBenchmarkTests(SimpleTestCase):
+    def test_batch_is_cheaper_per_series(self):
+        rng = random.Random(7)
+        series = [[rng.uniform(50, 5000) for _ in range(BENCH_POINTS)] for _ in range(BENCH_SERIES)]
+        predictor = PricePredictor()
+
+        started = time.perf_counter()
+        for values in series:
+            history = [{"price": v} for v in values]
+            _calc_features(history, "ozon")
+            predictor._volatility(history)
+            predictor._linear_trend(history)
+        old_us = (time.perf_counter() - started) / len(series) * 1e6
+
+        started = time.perf_counter()
+        features.features_for(series, ["ozon"] * len(series))
+        new_us = (time.perf_counter() - started) / len(series) * 1e6
+
+        summary = (
+            f"features: {BENCH_SERIES} series x {BENCH_POINTS} points — "
+            f"loops {old_us:.1f} us/series, batch {new_us:.1f} us/series ({old_us / new_us:.1f}x)"
+        )
+        logger.info(summary)
+        self.assertLess(new_us, old_us, summary)
+
+
+def _stable_history(query, hours, marketplace="ozon", price=Decimal("1000")):
+    """One OfferHistory row: the same price seen from ``hours`` ago until now."""
+    now = timezone.now()
+    point = OfferHistory.objects.create(
+        query=query,
+        marketplace=marketplace,
+        title=query.name,
+        price=price,
+        currency="RUB",
+        price_rub_kop=int(price * 100),
+    )
+    point.collected_at = now - timedelta(hours=hours)
+    point.seen_until = now
+    point.save(update_fields=["collected_at", "seen_until"])
+    return point
+
+
+@override_settings(HISTORY_STORE={"ENABLED": False})
+class StableSeriesTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        settings_patch = override_settings(GLOBAL_MODEL={"DIR": tmp.name})
+        settings_patch.enable()
+        self.addCleanup(settings_patch.disable)
+        reset_global_model()
+        self.addCleanup(reset_global_model)
+        self.query = ProductQuery.objects.create(name="kettle")
+        # два дня без смены цены: одна строка, продлённая seen_until
+        _stable_history(self.query, hours=48)
+
+    def test_predictor_counts_expanded_points(self):
+        result = PricePredictor().predict(self.query.id, "")
+        self.assertEqual(result["points"], 25)
+        self.assertEqual(result["current_price"], 1000.0)
+        self.assertEqual(result["confidence"], 0.8)
+
+    def test_advanced_predict_passes_point_gates(self):
+        result = advanced_predict(self.query.id, "", "ozon")
+        self.assertGreaterEqual(result["points"], MIN_POINTS_MODEL)
+        self.assertEqual(result["current_price"], 1000.0)
+        self.assertEqual(result["confidence"], 0.8)
+
+
+@unittest.skipUnless(features.is_available(), "numpy is not installed")
+class HistoryStoreRunTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = history_store.HistoryStore(tmp.name)
+        self.query = ProductQuery.objects.create(name="kettle")
+
+    def test_load_expands_runs_and_refreshes_seen_until(self):
+        point = _stable_history(self.query, hours=10)
+        self.store.sync()
+        self.assertEqual(len(self.store.load(self.query.id)), 6)
+        # после выгрузки pipeline продлил серию ещё на 4 часа
+        OfferHistory.objects.filter(pk=point.pk).update(seen_until=point.seen_until + timedelta(hours=4))
+        series = self.store.load(self.query.id)
+        self.assertEqual(len(series), 8)
+        self.assertEqual(set(series.rub.tolist()), {1000.0})
+        self.assertEqual(list(series.ts), sorted(series.ts))
+        self.assertEqual(series.ts[-1], (point.seen_until + timedelta(hours=4)).timestamp())
+
+
+@unittest.skipUnless(features.is_available(), "numpy is not installed")
+class HistoryStoreTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CurrencyRate.objects.create(code="USD", rate=Decimal("90"))
+        cls.kettle = ProductQuery.objects.create(name="kettle")
+        cls.toaster = ProductQuery.objects.create(name="toaster")
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        self.store = history_store.HistoryStore(self.root)
+
+    def _point(self, query, price, marketplace="ozon", currency="RUB", kopecks=True):
+        return OfferHistory.objects.create(
+            query=query,
+            marketplace=marketplace,
+            title=query.name,
+            price=Decimal(price),
+            currency=currency,
+            price_rub_kop=int(Decimal(price) * 100) if kopecks else None,
+        )
+
+    def test_sync_is_incremental(self):
+        self._point(self.kettle, "100")
+        self._point(self.toaster, "50", marketplace="wildberries")
+        self.assertEqual(self.store.sync(chunk_size=1), {"rows": 2, "queries": 2})
+        self.assertEqual(self.store.sync(), {"rows": 0, "queries": 0})
+        last = self._point(self.kettle, "110", marketplace="amazon")
+        self.assertEqual(self.store.sync()["rows"], 1)
+        self.assertEqual(self.store.last_synced_id(), last.id)
+        series = self.store.open(self.kettle.id)
+        self.assertEqual(series.rub.tolist(), [100.0, 110.0])
+        self.assertEqual(series.mp.tolist(), [2, 0])
+
+    def test_rows_without_kopecks_are_converted(self):
+        self._point(self.kettle, "10", marketplace="amazon", currency="USD", kopecks=False)
+        self.store.sync()
+        self.assertEqual(self.store.open(self.kettle.id).rub.tolist(), [900.0])
+
+    def test_load_adds_points_written_after_sync(self):
+        self._point(self.kettle, "100")
+        self.store.sync()
+        self._point(self.kettle, "105")
+        self.assertEqual(len(self.store.open(self.kettle.id)), 1)
+        series = self.store.load(self.kettle.id)
+        self.assertEqual(series.rub.tolist(), [100.0, 105.0])
+        self.assertIsNone(self.store.load(self.toaster.id))
+
+    def test_raw_points_older_than_the_window_are_cut(self):
+        old = self._point(self.kettle, "100")
+        OfferHistory.objects.filter(pk=old.pk).update(collected_at=timezone.now() - timedelta(days=30))
+        self._point(self.kettle, "105")
+        self.store.sync()
+        series = self.store.load(self.kettle.id, raw_days=7)
+        self.assertEqual((series.rub.tolist(), series.mp.tolist()), ([105.0], [2]))
+
+    def test_window_without_runs_is_a_memmap_view(self):
+        self._point(self.kettle, "100")
+        self._point(self.kettle, "105")
+        self.store.sync()
+        series = self.store.load(self.kettle.id)
+        self.assertEqual(series.rub.tolist(), [100.0, 105.0])
+        self.assertTrue(all(isinstance(column, np.memmap) for column in series))
+
+    def test_matches_price_series(self):
+        now = timezone.now()
+        for days_ago, price in ((40, "90"), (39, "95")):
+            OfferHistoryDaily.objects.create(
+                query=self.kettle, marketplace="ozon", day=timezone.localdate(now - timedelta(days=days_ago)),
+                currency="USD", open=Decimal(price), high=Decimal(price), low=Decimal(price),
+                close=Decimal(price), total=Decimal(price) * 2, count=2,
+                first_at=now - timedelta(days=days_ago), last_at=now - timedelta(days=days_ago),
+            )
+        old = self._point(self.kettle, "80")
+        OfferHistory.objects.filter(pk=old.pk).update(collected_at=now - timedelta(days=30))
+        run = self._point(self.kettle, "10", marketplace="amazon", currency="USD", kopecks=False)
+        OfferHistory.objects.filter(pk=run.pk).update(
+            collected_at=now - timedelta(hours=7), seen_until=now - timedelta(hours=1)
+        )
+        self._point(self.kettle, "100")
+        self.store.sync()
+        self._point(self.kettle, "105", marketplace="wildberries")
+
+        expected = price_series(self.kettle.id)
+        series = self.store.load(self.kettle.id)
+        self.assertEqual(len(series), len(expected))
+        self.assertEqual(series.rub.tolist(), [point["rub"] for point in expected])
+        self.assertEqual(
+            [history_store.MARKETPLACES[code] for code in series.mp.tolist()],
+            [point["marketplace"] for point in expected],
+        )
+        for got, point in zip(series.ts.tolist(), expected):
+            self.assertAlmostEqual(got, point["collected_at"].timestamp(), places=5)
+
+    def test_load_series_respects_the_setting(self):
+        self._point(self.kettle, "100")
+        self.store.sync()
+        with override_settings(HISTORY_STORE={"ENABLED": False, "DIR": self.root}):
+            self.assertIsNone(history_store.load_series(self.kettle.id))
+        with override_settings(HISTORY_STORE={"ENABLED": True, "DIR": self.root}):
+            with mock.patch.object(history_store, "_store", None):
+                self.assertEqual(history_store.load_series(self.kettle.id).rub.tolist(), [100.0])
+
+    def test_command_rebuilds_the_store(self):
+        self._point(self.kettle, "100")
+        with override_settings(HISTORY_STORE={"ENABLED": True, "DIR": self.root}):
+            out = io.StringIO()
+            call_command("sync_history_store", stdout=out)
+            call_command("sync_history_store", "--rebuild", stdout=out)
+        self.assertEqual(self.store.open(self.kettle.id).rub.tolist(), [100.0])
+        self.assertIn("Экспортировано точек: 1", out.getvalue())
+
+
+@unittest.skipUnless(features.is_available(), "numpy is not installed")
+class GlobalModelTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        settings_patch = override_settings(GLOBAL_MODEL={"DIR": self.dir, "RELOAD_INTERVAL": 0})
+        settings_patch.enable()
+        self.addCleanup(settings_patch.disable)
+        reset_global_model()
+        self.addCleanup(reset_global_model)
+
+    def _artifact(self, version, change=0.1, **extra):
+        np = features.np
+        rng = np.random.default_rng(1)
+        X = rng.normal(size=(60, len(global_model.INPUT_COLUMNS)))
+        return {
+            "format": global_model.FORMAT_VERSION,
+            "version": version,
+            "kind": "ridge",
+            "horizon_days": 30,
+            "columns": global_model.INPUT_COLUMNS,
+            "metrics": {"mape": 0.1},
+            "model": RidgeModel().fit(X, np.full(60, change)),
+            **extra,
+        }
+
+    def _bump_manifest(self):
+        manifest = os.path.join(self.dir, "current.json")
+        stat = os.stat(manifest)
+        os.utime(manifest, (stat.st_atime, stat.st_mtime + 10))
+
+    def test_no_artifact_means_no_model(self):
+        self.assertIsNone(get_global_model())
+
+    def test_artifact_is_loaded_once(self):
+        save_artifact(self._artifact("v1"))
+        model = get_global_model()
+        self.assertEqual((model.version, model.kind, model.horizon_days), ("v1", "ridge", 30))
+        with mock.patch("analysis.global_model.pickle.load") as load:
+            self.assertIs(get_global_model(), model)
+        load.assert_not_called()
+        self.assertAlmostEqual(model.forecast([90, 95, 100], "ozon"), 110.0, places=6)
+
+    def test_new_version_is_picked_up(self):
+        save_artifact(self._artifact("v1"))
+        get_global_model()
+        save_artifact(self._artifact("v2", change=-0.2))
+        self._bump_manifest()
+        model = get_global_model()
+        self.assertEqual(model.version, "v2")
+        self.assertAlmostEqual(model.forecast([100], "wildberries"), 80.0, places=6)
+
+    def test_reload_interval_skips_the_manifest_check(self):
+        save_artifact(self._artifact("v1"))
+        with override_settings(GLOBAL_MODEL={"DIR": self.dir, "RELOAD_INTERVAL": 3600}):
+            get_global_model()
+            save_artifact(self._artifact("v2"))
+            self._bump_manifest()
+            self.assertEqual(get_global_model().version, "v1")
+
+    def test_unsupported_format_is_rejected(self):
+        save_artifact(self._artifact("v1", format=global_model.FORMAT_VERSION + 1))
+        with mock.patch("builtins.print"):
+            self.assertIsNone(get_global_model())
+
+    def test_only_newest_versions_are_kept(self):
+        for version in ("v1", "v2", "v3", "v4"):
+            path = save_artifact(self._artifact(version), keep=2)
+        files = sorted(name for name in os.listdir(self.dir) if name.endswith(".pkl"))
+        self.assertEqual(files, ["global_model-v3.pkl", "global_model-v4.pkl"])
+        self.assertEqual(os.path.basename(path), "global_model-v4.pkl")
+
+    def test_train_validates_on_the_latest_cut_points(self):
+        np = features.np
+        rng = np.random.default_rng(2)
+        X = rng.normal(size=(200, len(global_model.INPUT_COLUMNS)))
+        y = X[:, 1] * 0.05
+        dataset = (X, y, np.ones(200), np.arange(200, dtype=np.float64))
+        with mock.patch.object(global_model, "build_dataset", return_value=dataset):
+            artifact = global_model.train(backend="ridge", holdout=0.25)
+        self.assertEqual(artifact["metrics"]["valid_samples"], 50)
+        self.assertLess(artifact["metrics"]["mape"], artifact["metrics"]["naive_mape"])
+        with mock.patch.object(global_model, "build_dataset", return_value=tuple(a[:10] for a in dataset)):
+            with self.assertRaises(ValueError):
+                global_model.train(backend="ridge")
@@ -1,9 +1,11 @@
 import re
 from typing import List, Optional
 
-import requests
 from bs4 import BeautifulSoup
 
+from .http import get_session
+from .retry import RetryPolicy, SearchResult, request_with_fallback
+
 
 class AmazonParser:
     def __init__(self):
@@ -13,13 +15,19 @@ class AmazonParser:
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
             "Referer": "https://www.amazon.com/",
         }
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
+        self.session = get_session()
+        self.retry_policy = RetryPolicy.for_marketplace("amazon")
 
     def search_product(self, product_name: str) -> List[dict]:
+        budget = self.retry_policy.start()
         try:
             search_url = f"https://www.amazon.com/s?k={product_name.replace(' ', '+')}"
-            response = self.session.get(search_url, timeout=12)
+            response = request_with_fallback(
+                self.session, "get", search_url, budget=budget, headers=self.headers
+            )
+            error = self.retry_policy.failure(response)
+            if error:
+                return SearchResult([], elapsed=budget.elapsed, attempts=budget.attempts, error=error)
             soup = BeautifulSoup(response.content, "html.parser")
 
             products = []
@@ -30,10 +38,10 @@ class AmazonParser:
                 if product:
                     products.append(product)
 
-            return products
+            return SearchResult(products, elapsed=budget.elapsed, attempts=budget.attempts)
         except Exception as e:
             print(f"Amazon parser error: {e}")
-            return []
+            return SearchResult([], elapsed=budget.elapsed, attempts=budget.attempts, error=str(e) or type(e).__name__)
 
     def parse_product_item(self, item) -> Optional[dict]:
         try:
@@ -0,0 +1,188 @@
+"""
+TTL-кэш результатов поиска маркетплейсов.
+
+Ключ — маркетплейс + нормализованный запрос (регистр, пробелы, пунктуация,
+транслитерация кириллицы), поэтому "iPhone 15" и "iphone  15 " или "Айфон 15" и
+"айфон-15" не ходят на маркетплейс повторно в пределах TTL. Синонимы не
+распознаются: "айфон 15" становится "aifon 15" и с "iPhone 15" ключ не делит.
+Нормализованный запрос хешируется (sha1), так что ключ безопасен для любого
+бэкенда кэша, в том числе memcached. Бэкенд подключаемый: "memory" (LRU внутри
+процесса) или "django" (любой кэш из CACHES). Настройки — словарь PARSER_CACHE
+в settings.
+"""
+
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+from .retry import SearchResult
+
+DEFAULT_TTL = 15 * 60
+
+_TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e",
+    "ж": "zh", "з": "z", "и": "i", "й": "i", "к": "k", "л": "l", "м": "m",
+    "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+    "ф": "f", "х": "h", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sch", "ъ": "",
+    "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+}
+
+
+def normalize_query(query: str) -> str:
+    """Canonical form of a search query: lower case, latin, single spaces."""
+    text = unicodedata.normalize("NFKC", query or "").lower()
+    text = "".join(_TRANSLIT.get(ch, ch) for ch in text)
+    text = re.sub(r"[^\w]+", " ", text)
+    return " ".join(text.split())
+
+
+class MemoryBackend:
+    """Size-bounded LRU with per-entry expiry, local to the process."""
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: float) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class DjangoCacheBackend:
+    """Stores entries in a Django cache alias, shared between workers if the cache is."""
+
+    def __init__(self, alias: str = "default"):
+        self.alias = alias
+
+    @property
+    def _cache(self):
+        from django.core.cache import caches
+
+        return caches[self.alias]
+
+    def get(self, key: str):
+        return self._cache.get(key)
+
+    def set(self, key: str, value, ttl: float) -> None:
+        self._cache.set(key, value, timeout=ttl)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+class SearchCache:
+    def __init__(self, backend=None, ttl: Optional[Dict[str, float]] = None):
+        config = getattr(settings, "PARSER_CACHE", {})
+        if backend is None:
+            if config.get("BACKEND", "memory") == "django":
+                backend = DjangoCacheBackend(config.get("ALIAS", "default"))
+            else:
+                backend = MemoryBackend(config.get("MAX_ENTRIES", 1000))
+        self.backend = backend
+        self.ttl = {**config.get("TTL", {}), **(ttl or {})}
+        self.default_ttl = config.get("DEFAULT_TTL", DEFAULT_TTL)
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def key(self, marketplace: str, query: str) -> str:
+        # пробелы и юникод в ключе ломают memcached (CacheKeyWarning)
+        digest = hashlib.sha1(normalize_query(query).encode("utf-8")).hexdigest()
+        return f"search:{marketplace}:{digest}"
+
+    def get(self, marketplace: str, query: str) -> Optional[List[dict]]:
+        value = self.backend.get(self.key(marketplace, query))
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, marketplace: str, query: str, offers: List[dict]) -> None:
+        ttl = self.ttl.get(marketplace, self.default_ttl)
+        if ttl > 0:
+            self.backend.set(self.key(marketplace, query), offers, ttl)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+class CachedParser:
+    """Read-through wrapper around a parser's ``search_product``."""
+
+    def __init__(self, parser, marketplace: str, cache: SearchCache):
+        self.parser = parser
+        self.marketplace = marketplace
+        self.cache = cache
+
+    def lookup(self, product_name: str) -> Optional[SearchResult]:
+        """Cached result (``cached=True``) or None; never touches the marketplace."""
+        cached = self.cache.get(self.marketplace, product_name)
+        if cached is None:
+            return None
+        return SearchResult([dict(offer) for offer in cached], cached=True)
+
+    def fetch(self, product_name: str) -> List[dict]:
+        """Query the marketplace and store a non-empty answer."""
+        offers = self.parser.search_product(product_name)
+        # сбои не кэшируем; пустой ответ тоже — «ничего не найдено» быстро устаревает
+        if offers and not getattr(offers, "error", ""):
+            self.cache.set(self.marketplace, product_name, list(offers))
+        return offers
+
+    def search_product(self, product_name: str) -> List[dict]:
+        cached = self.lookup(product_name)
+        if cached is not None:
+            return cached
+        return self.fetch(product_name)
+
+    def __getattr__(self, name):
+        return getattr(self.parser, name)
+
+
+_search_cache: Optional[SearchCache] = None
+_search_cache_lock = threading.Lock()
+
+
+def get_search_cache() -> SearchCache:
+    global _search_cache
+    if _search_cache is None:
+        with _search_cache_lock:
+            if _search_cache is None:
+                _search_cache = SearchCache()
+    return _search_cache
@@ -0,0 +1,100 @@
+"""
+Circuit breaker по маркетплейсам.
+
+closed    — запросы идут как обычно, считаем подряд идущие сбои;
+open      — после FAILURE_THRESHOLD сбоев маркетплейс пропускается сразу,
+            без таймаутов и прокси, на RECOVERY_TIMEOUT секунд;
+half-open — по истечении RECOVERY_TIMEOUT пропускаем один пробный запрос:
+            успех закрывает breaker, сбой снова открывает.
+
+Состояние хранится в кэше CIRCUIT_BREAKER["CACHE_ALIAS"], поэтому при общем
+кэше (файловом, redis, memcached) его видят все воркеры.
+"""
+
+import time
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+DEFAULTS = {
+    "FAILURE_THRESHOLD": 5,
+    "RECOVERY_TIMEOUT": 60,
+    "CACHE_ALIAS": "default",
+}
+
+
+def _config(marketplace: str) -> Dict:
+    config = getattr(settings, "CIRCUIT_BREAKER", {})
+    return {**DEFAULTS, **config, **config.get("MARKETPLACES", {}).get(marketplace, {})}
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: Optional[int] = None,
+        recovery_timeout: Optional[float] = None,
+        cache_alias: Optional[str] = None,
+    ):
+        config = _config(name)
+        self.name = name
+        self.failure_threshold = failure_threshold or config["FAILURE_THRESHOLD"]
+        self.recovery_timeout = recovery_timeout or config["RECOVERY_TIMEOUT"]
+        self.cache_alias = cache_alias or config["CACHE_ALIAS"]
+        self.key = f"circuit:{name}"
+
+    @property
+    def _cache(self):
+        return caches[self.cache_alias]
+
+    def _load(self) -> Dict:
+        return self._cache.get(self.key) or {"state": CLOSED, "failures": 0, "opened_at": 0.0}
+
+    def _save(self, data: Dict) -> None:
+        # держим запись дольше окна восстановления, чтобы не потерять open
+        self._cache.set(self.key, data, timeout=max(self.recovery_timeout * 10, 3600))
+
+    @property
+    def state(self) -> str:
+        data = self._load()
+        if data["state"] == OPEN and time.time() - data["opened_at"] >= self.recovery_timeout:
+            return HALF_OPEN
+        return data["state"]
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN:
+            # пробный запрос пропускает только один воркер: add атомарен в общем кэше
+            return self._cache.add(f"{self.key}:probe", 1, timeout=self.recovery_timeout)
+        return False
+
+    def record_success(self) -> None:
+        data = self._load()
+        if data["state"] != CLOSED or data["failures"]:
+            self._save({"state": CLOSED, "failures": 0, "opened_at": 0.0})
+        self._cache.delete(f"{self.key}:probe")
+
+    def record_failure(self) -> None:
+        data = self._load()
+        failures = data["failures"] + 1
+        if data["state"] != CLOSED or failures >= self.failure_threshold:
+            if data["state"] == CLOSED:
+                print(f"Circuit breaker for {self.name} opened after {failures} failures")
+            self._save({"state": OPEN, "failures": failures, "opened_at": time.time()})
+        else:
+            self._save({"state": CLOSED, "failures": failures, "opened_at": 0.0})
+        self._cache.delete(f"{self.key}:probe")
+
+    def reset(self) -> None:
+        self._cache.delete_many([self.key, f"{self.key}:probe"])
+
+
+def get_breaker(marketplace: str) -> CircuitBreaker:
+    return CircuitBreaker(marketplace)
@@ -0,0 +1,56 @@
+"""
+Общий HTTP-транспорт для парсеров: один requests.Session на процесс
+с keep-alive пулами соединений по хостам, чтобы не платить за TCP/TLS
+на каждом запросе. Размеры пулов задаются в settings:
+PARSER_HTTP_POOL_CONNECTIONS (число хостов) и PARSER_HTTP_POOL_MAXSIZE
+(соединений на хост).
+"""
+
+import threading
+from typing import Optional
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_CONNECTIONS = 16
+DEFAULT_POOL_MAXSIZE = 16
+
+_session: Optional[requests.Session] = None
+_lock = threading.Lock()
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=getattr(
+            settings, "PARSER_HTTP_POOL_CONNECTIONS", DEFAULT_POOL_CONNECTIONS
+        ),
+        pool_maxsize=getattr(settings, "PARSER_HTTP_POOL_MAXSIZE", DEFAULT_POOL_MAXSIZE),
+        max_retries=0,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Process-wide session. Headers are passed per request, so parsers
+    for different marketplaces can share it safely.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def reset_session() -> None:
+    """Drop pooled connections (e.g. after fork or in tests)."""
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
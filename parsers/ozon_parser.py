@@ -3,10 +3,11 @@ import re
 from typing import List, Optional
 
 import os
-import requests
 from bs4 import BeautifulSoup
 
-from .proxy_pool import ProxyPool
+from .http import get_session
+from .proxy_pool import get_proxy_pool
+from .retry import RetryPolicy, SearchResult, request_with_fallback
 
 
 class OzonParser:
@@ -19,25 +20,31 @@ class OzonParser:
         }
         proxy_url = os.environ.get("PROXY_URL")
         self.proxies = {"http": proxy_url, "https": proxy_url} if proxy_url else None
-        self.proxy_pool = ProxyPool()
+        self.session = get_session()
+        self.proxy_pool = get_proxy_pool()
+        self.retry_policy = RetryPolicy.for_marketplace("ozon")
 
     def search_product(self, product_name: str) -> List[dict]:
+        # один бюджет на весь поиск, включая запасной composer-api
+        budget = self.retry_policy.start()
         try:
             search_url = f"https://www.ozon.ru/search/?text={product_name.replace(' ', '+')}"
-            response = self._safe_get(search_url)
+            response = self._safe_get(search_url, budget=budget)
             soup = BeautifulSoup(response.text, "lxml")
 
             products = self._parse_from_state_script(soup)
             if not products:
-                products = self._composer_api_search(product_name)
+                products = self._composer_api_search(product_name, budget=budget)
             if not products:
                 products = self._parse_from_cards(soup)
-            return products[:6]
+            # пусто после заблокированной страницы — это сбой, а не «ничего не найдено»
+            error = "" if products else self.retry_policy.failure(response)
+            return SearchResult(products[:6], elapsed=budget.elapsed, attempts=budget.attempts, error=error)
         except Exception as e:
             print(f"Ozon parser error: {e}")
-            return []
+            return SearchResult([], elapsed=budget.elapsed, attempts=budget.attempts, error=str(e) or type(e).__name__)
 
-    def _composer_api_search(self, product_name: str) -> List[dict]:
+    def _composer_api_search(self, product_name: str, budget=None) -> List[dict]:
         """
         Try internal composer-api endpoint. Often sits behind Cloudflare;
         will return empty on block, but helps when HTML is obfuscated.
@@ -53,7 +60,7 @@ class OzonParser:
             "Origin": "https://www.ozon.ru",
         }
         try:
-            resp = self._safe_post(url, json=payload, headers=headers)
+            resp = self._safe_post(url, budget=budget, json=payload, headers=headers)
             if resp.status_code != 200:
                 return []
             data = resp.json()
@@ -86,43 +93,25 @@ class OzonParser:
             return []
 
     # Proxy-aware wrappers
-    def _safe_get(self, url, **kwargs):
-        return self._request_with_fallback("get", url, **kwargs)
-
-    def _safe_post(self, url, **kwargs):
-        return self._request_with_fallback("post", url, **kwargs)
-
-    def _request_with_fallback(self, method: str, url: str, **kwargs):
-        # Try direct or env proxy first
-        try:
-            resp = requests.request(
-                method, url, headers=self.headers, timeout=12, proxies=self.proxies, **kwargs
-            )
-            if resp.status_code == 200:
-                return resp
-        except Exception:
-            pass
-
-        # Fallback: rotate free proxy
-        for _ in range(5):
-            proxy = self.proxy_pool.get_proxy()
-            if not proxy:
-                break
-            try:
-                resp = requests.request(
-                    method,
-                    url,
-                    headers=self.headers,
-                    timeout=12,
-                    proxies=proxy,
-                    **kwargs,
-                )
-                if resp.status_code == 200:
-                    return resp
-            except Exception:
-                continue
-        # Final attempt without proxy to raise any error
-        return requests.request(method, url, headers=self.headers, timeout=12, **kwargs)
+    def _safe_get(self, url, budget=None, **kwargs):
+        return self._request_with_fallback("get", url, budget=budget, **kwargs)
+
+    def _safe_post(self, url, budget=None, **kwargs):
+        return self._request_with_fallback("post", url, budget=budget, **kwargs)
+
+    def _request_with_fallback(self, method: str, url: str, budget=None, **kwargs):
+        # direct or env proxy first, then rotate free proxies while the budget lasts
+        headers = kwargs.pop("headers", self.headers)
+        return request_with_fallback(
+            self.session,
+            method,
+            url,
+            budget=budget or self.retry_policy.start(),
+            headers=headers,
+            proxies=self.proxies,
+            proxy_pool=self.proxy_pool,
+            **kwargs,
+        )
 
     def _parse_from_state_script(self, soup: BeautifulSoup) -> List[dict]:
         results: List[dict] = []
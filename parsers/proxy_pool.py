@@ -1,40 +1,238 @@
+import json
 import os
 import random
-from typing import List, Optional
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
 
-import requests
+from django.conf import settings
+
+from .http import get_session
+
+PROXY_SOURCE_URL = (
+    "https://api.proxyscrape.com/v2/?request=displayproxies&protocol=http"
+    "&timeout=2000&country=all&ssl=all&anonymity=all"
+)
+DEFAULT_VALIDATE_URL = "http://www.gstatic.com/generate_204"
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
 
 
 class ProxyPool:
     """
-    Very lightweight free-proxy fetcher. It pulls HTTP proxies from proxyscrape.
-    Reliability is low; use only when no paid proxy is available.
+    Free-proxy pool with health scoring. Proxies are pulled from proxyscrape,
+    validated in the background and picked with weights based on their success
+    rate and latency. Proxies that keep failing are evicted, the pool refills
+    itself before it runs dry, and scores are saved to PROXY_POOL_STATE_FILE
+    so a restart does not start from scratch.
+    Reliability is still low; use only when no paid proxy is available.
     """
 
-    def __init__(self):
+    def __init__(self, state_file: Optional[str] = None):
         self.static_proxy = os.environ.get("PROXY_URL")
-        self.pool: List[str] = []
-        if not self.static_proxy:
-            self._refresh_pool()
+        self.state_file = state_file or _setting("PROXY_POOL_STATE_FILE", None)
+        self.max_size = _setting("PROXY_POOL_MAX_SIZE", 30)
+        self.low_watermark = _setting("PROXY_POOL_LOW_WATERMARK", 10)
+        self.max_failures = _setting("PROXY_POOL_MAX_FAILURES", 3)
+        self.validate_url = _setting("PROXY_POOL_VALIDATE_URL", DEFAULT_VALIDATE_URL)
+        self.validate_timeout = _setting("PROXY_POOL_VALIDATE_TIMEOUT", 3.0)
+        self.save_interval = _setting("PROXY_POOL_SAVE_INTERVAL", 30.0)
+        self.cold_wait = _setting("PROXY_POOL_COLD_WAIT", 2.0)
+        # proxy url -> {"ok", "fail", "streak", "latency"}
+        self.stats: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._refill_thread: Optional[threading.Thread] = None
+        # будит get_proxy, ждущий первого живого прокси на холодном старте
+        self._filled = threading.Condition(self._lock)
+        self._refilling = False
+        self._last_save = 0.0
+        self._load_state()
 
-    def _refresh_pool(self) -> None:
+    @property
+    def pool(self) -> List[str]:
+        with self._lock:
+            return list(self.stats)
+
+    # --- selection -------------------------------------------------------
+
+    def get_proxy(self, exclude: Iterable[str] = (), wait: bool = True) -> Optional[dict]:
+        if self.static_proxy:
+            return {"http": self.static_proxy, "https": self.static_proxy}
+        if len(self.stats) < self.low_watermark:
+            self._refill_in_background()
+        if not self.stats and wait:
+            # холодный старт: загрузка идёт в фоне, ждём первый живой прокси не дольше cold_wait
+            with self._filled:
+                self._filled.wait_for(lambda: self.stats or not self._refilling, timeout=self.cold_wait)
+
+        excluded = set(exclude)
+        with self._lock:
+            candidates = [p for p in self.stats if p not in excluded]
+            if not candidates:
+                return None
+            weights = [self._score(self.stats[p]) for p in candidates]
+        proxy = random.choices(candidates, weights=weights, k=1)[0]
+        return {"http": proxy, "https": proxy}
+
+    @staticmethod
+    def _score(stat: Dict[str, float]) -> float:
+        # сглаженная доля успехов, делённая на задержку: быстрые и живые прокси выбираются чаще
+        success_rate = (stat["ok"] + 1) / (stat["ok"] + stat["fail"] + 2)
+        latency = max(stat["latency"], 0.05)
+        return success_rate / latency
+
+    # --- feedback --------------------------------------------------------
+
+    def report(self, proxy: Optional[dict], ok: bool, latency: Optional[float] = None) -> None:
+        """Record the outcome of a request made through ``proxy``."""
+        if not proxy or self.static_proxy:
+            return
+        url = proxy.get("http")
+        with self._lock:
+            stat = self.stats.get(url)
+            if stat is None:
+                return
+            if ok:
+                stat["ok"] += 1
+                stat["streak"] = 0
+                if latency is not None:
+                    stat["latency"] = 0.7 * stat["latency"] + 0.3 * latency
+            else:
+                stat["fail"] += 1
+                stat["streak"] += 1
+                if stat["streak"] >= self.max_failures:
+                    del self.stats[url]
+            size = len(self.stats)
+        if size < self.low_watermark:
+            self._refill_in_background()
+        self._maybe_save()
+
+    # --- refill ----------------------------------------------------------
+
+    def _fetch_candidates(self) -> List[str]:
         try:
-            resp = requests.get(
-                "https://api.proxyscrape.com/v2/?request=displayproxies&protocol=http&timeout=2000&country=all&ssl=all&anonymity=all",
-                timeout=8,
-            )
+            resp = get_session().get(PROXY_SOURCE_URL, timeout=8)
             if resp.status_code == 200:
                 lines = [p.strip() for p in resp.text.splitlines() if p.strip()]
-                self.pool = [f"http://{p}" for p in lines][:30]
+                return [f"http://{p}" for p in lines]
         except Exception as exc:
             print(f"ProxyPool refresh error: {exc}")
+        return []
 
-    def get_proxy(self) -> Optional[dict]:
-        if self.static_proxy:
-            return {"http": self.static_proxy, "https": self.static_proxy}
-        if not self.pool:
-            self._refresh_pool()
-        if not self.pool:
-            return None
-        proxy = random.choice(self.pool)
-        return {"http": proxy, "https": proxy}
+    def _validate(self, proxy: str) -> Optional[float]:
+        started = time.monotonic()
+        try:
+            resp = get_session().get(
+                self.validate_url,
+                proxies={"http": proxy, "https": proxy},
+                timeout=self.validate_timeout,
+            )
+            if resp.status_code < 400:
+                return time.monotonic() - started
+        except Exception:
+            pass
+        return None
+
+    def _refresh_pool(self) -> None:
+        try:
+            self._fill()
+        finally:
+            with self._filled:
+                self._refilling = False
+                self._filled.notify_all()
+
+    def _fill(self) -> None:
+        with self._lock:
+            known = set(self.stats)
+            free_slots = self.max_size - len(known)
+        if free_slots <= 0:
+            return
+        candidates = [p for p in self._fetch_candidates() if p not in known]
+        if not candidates:
+            return
+        random.shuffle(candidates)
+        candidates = candidates[: free_slots * 3]
+        with ThreadPoolExecutor(max_workers=min(16, len(candidates))) as executor:
+            futures = {executor.submit(self._validate, proxy): proxy for proxy in candidates}
+            # прокси попадает в пул сразу после проверки, не дожидаясь остальных
+            for future in as_completed(futures):
+                latency = future.result()
+                with self._filled:
+                    if latency is None or len(self.stats) >= self.max_size:
+                        continue
+                    self.stats.setdefault(
+                        futures[future], {"ok": 1, "fail": 0, "streak": 0, "latency": latency}
+                    )
+                    self._filled.notify_all()
+        self._maybe_save(force=True)
+
+    def _refill_in_background(self) -> None:
+        with self._lock:
+            if self._refill_thread and self._refill_thread.is_alive():
+                return
+            self._refilling = True
+            self._refill_thread = threading.Thread(
+                target=self._refresh_pool, name="proxy-pool-refill", daemon=True
+            )
+            self._refill_thread.start()
+
+    # --- persistence -----------------------------------------------------
+
+    def _load_state(self) -> None:
+        if not self.state_file or not Path(self.state_file).exists():
+            return
+        try:
+            with open(self.state_file, encoding="utf-8") as fh:
+                data = json.load(fh)
+            self.stats = {
+                proxy: {key: float(stat.get(key, 0)) for key in ("ok", "fail", "streak", "latency")}
+                for proxy, stat in data.get("proxies", {}).items()
+            }
+        except Exception as exc:
+            print(f"ProxyPool state load error: {exc}")
+
+    def _maybe_save(self, force: bool = False) -> None:
+        if not self.state_file:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_save < self.save_interval:
+                return
+            self._last_save = now
+            payload = {
+                "saved_at": time.time(),
+                "proxies": {proxy: dict(stat) for proxy, stat in self.stats.items()},
+            }
+        tmp_path = None
+        try:
+            # у каждого потока свой временный файл: записи не перемешиваются
+            directory = os.path.dirname(os.path.abspath(self.state_file))
+            with tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", dir=directory, suffix=".tmp", delete=False
+            ) as fh:
+                tmp_path = fh.name
+                json.dump(payload, fh)
+            os.replace(tmp_path, self.state_file)
+        except Exception as exc:
+            print(f"ProxyPool state save error: {exc}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
+_shared_pool: Optional[ProxyPool] = None
+_shared_lock = threading.Lock()
+
+
+def get_proxy_pool() -> ProxyPool:
+    """Process-wide pool shared by all parser instances."""
+    global _shared_pool
+    if _shared_pool is None:
+        with _shared_lock:
+            if _shared_pool is None:
+                _shared_pool = ProxyPool()
+    return _shared_pool
@@ -0,0 +1,192 @@
+"""
+Политика повторов для парсеров: общий бюджет времени на один поиск,
+ограничение числа попыток, экспоненциальная задержка с jitter и правила
+по статусам (403 / Cloudflare challenge не повторяем по тому же адресу — это
+блок, а не сбой; с пулом прокси пробуем другой прокси, а заблокированный
+получает неудачу в счёт здоровья).
+Настройки — словарь PARSER_RETRY в settings: ключ "default" и
+переопределения по маркетплейсам.
+"""
+
+import random
+import time
+from typing import Dict, Iterable, Optional
+
+from django.conf import settings
+
+CHALLENGE_MARKERS = ("Just a moment", "cf-chl", "challenge-platform", "Attention Required")
+
+
+class SearchResult(list):
+    """List of offers plus the time and number of attempts spent fetching them.
+
+    ``error`` is set when the upstream failed (exception, block, bad status);
+    an empty list without it is a genuine "nothing found".
+    """
+
+    def __init__(
+        self,
+        offers: Iterable = (),
+        elapsed: float = 0.0,
+        attempts: int = 0,
+        cached: bool = False,
+        error: str = "",
+    ):
+        super().__init__(offers)
+        self.elapsed = round(elapsed, 3)
+        self.attempts = attempts
+        self.cached = cached
+        self.error = error
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        total_budget: float = 20.0,
+        max_attempts: int = 5,
+        base_delay: float = 0.25,
+        max_delay: float = 2.0,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 8.0,
+        retry_statuses: Iterable[int] = (429, 500, 502, 503, 504),
+        no_retry_statuses: Iterable[int] = (403,),
+        block_statuses: Iterable[int] = (403, 429),
+    ):
+        self.total_budget = total_budget
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry_statuses = set(retry_statuses)
+        self.no_retry_statuses = set(no_retry_statuses)
+        self.block_statuses = set(block_statuses)
+
+    @classmethod
+    def for_marketplace(cls, marketplace: str) -> "RetryPolicy":
+        config: Dict[str, Dict] = getattr(settings, "PARSER_RETRY", {})
+        return cls(**{**config.get("default", {}), **config.get(marketplace, {})})
+
+    def start(self) -> "RequestBudget":
+        return RequestBudget(self)
+
+    def backoff(self, attempt: int) -> float:
+        # "equal jitter": половина задержки фиксирована, половина случайна
+        delay = min(self.max_delay, self.base_delay * (2 ** max(attempt - 1, 0)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def is_challenge(self, response) -> bool:
+        if response.status_code in self.no_retry_statuses:
+            return True
+        if response.status_code in (429, 503) and "cloudflare" in response.headers.get("Server", "").lower():
+            head = response.text[:4000]
+            return any(marker in head for marker in CHALLENGE_MARKERS)
+        return False
+
+    def is_blocked(self, response) -> bool:
+        """The upstream refused this client address (block status or challenge page)."""
+        return response.status_code in self.block_statuses or self.is_challenge(response)
+
+    def failure(self, response) -> str:
+        """Why a final response is unusable ("" for a 200 answer)."""
+        if self.is_blocked(response):
+            return "blocked"
+        if response.status_code != 200:
+            return f"http {response.status_code}"
+        return ""
+
+    def should_retry(self, response) -> bool:
+        if self.is_challenge(response):
+            return False
+        return response.status_code in self.retry_statuses
+
+
+class RequestBudget:
+    """Time and attempts left for one logical request (one search)."""
+
+    def __init__(self, policy: RetryPolicy):
+        self.policy = policy
+        self.started = time.monotonic()
+        self.attempts = 0
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def remaining(self) -> float:
+        return self.policy.total_budget - self.elapsed
+
+    def can_attempt(self) -> bool:
+        # меньше полсекунды на попытку — уже не успеем получить ответ
+        return self.attempts < self.policy.max_attempts and self.remaining > 0.5
+
+    def timeout(self):
+        remaining = max(self.remaining, 0.1)
+        return (
+            min(self.policy.connect_timeout, remaining),
+            min(self.policy.read_timeout, remaining),
+        )
+
+    def sleep_backoff(self) -> None:
+        delay = min(self.policy.backoff(self.attempts), max(self.remaining - 0.5, 0))
+        if delay > 0:
+            time.sleep(delay)
+
+
+def request_with_fallback(
+    session,
+    method: str,
+    url: str,
+    budget: RequestBudget,
+    headers: Optional[dict] = None,
+    proxies: Optional[dict] = None,
+    proxy_pool=None,
+    **kwargs,
+):
+    """
+    First attempt goes direct (or through ``proxies``), following ones rotate
+    through ``proxy_pool`` while the budget lasts. Only blocked responses and
+    statuses allowed by ``should_retry`` are tried again; a blocked proxy is
+    reported as failed. Returns the first 200 response, otherwise the last
+    response received; raises only if no attempt produced a response at all.
+    """
+    tried = set()
+    last_response = None
+    last_error: Optional[Exception] = None
+    while budget.can_attempt():
+        proxy = proxies
+        if budget.attempts and proxy_pool is not None:
+            # не ждём загрузки списка прокси: она съела бы весь бюджет
+            proxy = proxy_pool.get_proxy(exclude=tried, wait=False) or proxies
+        if budget.attempts and (proxy is proxies):
+            # повтор по тому же маршруту — выдерживаем паузу
+            budget.sleep_backoff()
+        if proxy and proxy is not proxies:
+            tried.add(proxy["http"])
+        budget.attempts += 1
+        started = time.monotonic()
+        try:
+            response = session.request(
+                method, url, headers=headers, timeout=budget.timeout(), proxies=proxy, **kwargs
+            )
+        except Exception as exc:
+            last_error = exc
+            if proxy_pool is not None and proxy is not proxies:
+                proxy_pool.report(proxy, ok=False)
+            continue
+        blocked = budget.policy.is_blocked(response)
+        if proxy_pool is not None and proxy is not proxies:
+            # 403/429/challenge — апстрим режет именно этот прокси
+            proxy_pool.report(proxy, ok=not blocked, latency=time.monotonic() - started)
+        if response.status_code == 200:
+            return response
+        last_response = response
+        if blocked and proxy_pool is not None:
+            # блок привязан к адресу — следующая попытка через другой прокси
+            continue
+        if not budget.policy.should_retry(response):
+            break
+    if last_response is not None:
+        return last_response
+    raise last_error or TimeoutError(f"request budget exhausted for {url}")
@@ -1,3 +1,428 @@
-from django.test import TestCase
-
-# Create your tests here.
+"""
+Тесты parsers: общий HTTP-пул, пул прокси, кэш поиска, политика повторов
+и circuit breaker. Сеть не используется — сессия и ответы подменяются.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+import warnings
+from unittest import mock
+
+from django.core.cache import CacheKeyWarning
+from django.test import SimpleTestCase, override_settings
+
+from parsers import http
+from parsers.cache import CachedParser, DjangoCacheBackend, MemoryBackend, SearchCache, normalize_query
+from parsers.circuit import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from parsers.proxy_pool import ProxyPool
+from parsers.retry import RetryPolicy, SearchResult, request_with_fallback
+from parsers.wildberries_parser import WildberriesParser
+
+
+class SharedSessionTests(SimpleTestCase):
+    def setUp(self):
+        http.reset_session()
+        self.addCleanup(http.reset_session)
+
+    def test_one_session_per_process(self):
+        self.assertIs(http.get_session(), http.get_session())
+
+    @override_settings(PARSER_HTTP_POOL_CONNECTIONS=4, PARSER_HTTP_POOL_MAXSIZE=7)
+    def test_pool_sizes_come_from_settings(self):
+        adapter = http.get_session().get_adapter("https://www.ozon.ru/")
+        self.assertEqual(adapter._pool_connections, 4)
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertEqual(adapter.max_retries.total, 0)
+
+    def test_reset_builds_a_new_session(self):
+        first = http.get_session()
+        http.reset_session()
+        self.assertIsNot(http.get_session(), first)
+
+
+@override_settings(PROXY_POOL_LOW_WATERMARK=2, PROXY_POOL_MAX_FAILURES=2, PROXY_POOL_COLD_WAIT=1.0)
+class ProxyPoolTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {"PROXY_URL": ""})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.state_dir.cleanup)
+        self.state_file = os.path.join(self.state_dir.name, "state.json")
+
+    def _pool(self, latencies):
+        """Pool whose candidates validate with the given latency (None = dead)."""
+        pool = ProxyPool(state_file=self.state_file)
+
+        def validate(proxy):
+            latency = latencies[proxy]
+            time.sleep(latency or 0)
+            return latency
+
+        patchers = [
+            mock.patch.object(pool, "_fetch_candidates", return_value=list(latencies)),
+            mock.patch.object(pool, "_validate", side_effect=validate),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # фоновая загрузка не должна пережить заглушки и уйти в сеть
+        self.addCleanup(self._join_refill, pool)
+        return pool
+
+    def _join_refill(self, pool):
+        if pool._refill_thread:
+            pool._refill_thread.join(5)
+
+    def test_cold_start_returns_first_healthy_proxy(self):
+        pool = self._pool({"http://fast:1": 0.05, "http://slow:1": 0.6, "http://slow:2": 0.6})
+        started = time.monotonic()
+        proxy = pool.get_proxy()
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(proxy, {"http": "http://fast:1", "https": "http://fast:1"})
+        self._join_refill(pool)
+        self.assertEqual(len(pool.pool), 3)
+
+    def test_cold_start_wait_is_bounded(self):
+        pool = self._pool({"http://dead:1": None, "http://dead:2": None})
+        started = time.monotonic()
+        self.assertIsNone(pool.get_proxy())
+        # фоновая загрузка закончилась ничем — ждать полный cold_wait незачем
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_no_wait_does_not_block(self):
+        pool = self._pool({"http://slow:1": 0.3})
+        started = time.monotonic()
+        self.assertIsNone(pool.get_proxy(wait=False))
+        self.assertLess(time.monotonic() - started, 0.1)
+        self._join_refill(pool)
+        self.assertEqual(pool.pool, ["http://slow:1"])
+
+    def test_failing_proxy_is_evicted(self):
+        pool = self._pool({})
+        pool.stats = {
+            "http://a:1": {"ok": 1, "fail": 0, "streak": 0, "latency": 0.1},
+            "http://b:1": {"ok": 1, "fail": 0, "streak": 0, "latency": 0.1},
+            "http://c:1": {"ok": 1, "fail": 0, "streak": 0, "latency": 0.1},
+        }
+        proxy = {"http": "http://a:1"}
+        pool.report(proxy, ok=False)
+        self.assertIn("http://a:1", pool.pool)
+        pool.report(proxy, ok=False)
+        self.assertNotIn("http://a:1", pool.pool)
+        self.assertIsNone(pool.get_proxy(exclude=["http://b:1", "http://c:1"], wait=False))
+
+    def test_fast_reliable_proxies_score_higher(self):
+        good = {"ok": 20, "fail": 0, "streak": 0, "latency": 0.2}
+        slow = {"ok": 20, "fail": 0, "streak": 0, "latency": 2.0}
+        flaky = {"ok": 2, "fail": 18, "streak": 0, "latency": 0.2}
+        self.assertGreater(ProxyPool._score(good), ProxyPool._score(slow))
+        self.assertGreater(ProxyPool._score(good), ProxyPool._score(flaky))
+
+    def test_scores_survive_restart(self):
+        pool = self._pool({"http://a:1": 0.01})
+        pool.get_proxy()
+        self._join_refill(pool)
+        pool.report({"http": "http://a:1"}, ok=True, latency=0.5)
+        pool._maybe_save(force=True)
+        with open(self.state_file, encoding="utf-8") as fh:
+            self.assertIn("http://a:1", json.load(fh)["proxies"])
+        restored = ProxyPool(state_file=self.state_file)
+        self.assertEqual(restored.stats["http://a:1"]["ok"], 2)
+
+    def test_concurrent_saves_keep_the_state_file_whole(self):
+        pool = self._pool({})
+        pool.stats = {f"http://p:{i}": {"ok": 1, "fail": 0, "streak": 0, "latency": 0.1} for i in range(200)}
+        threads = [threading.Thread(target=pool._maybe_save, kwargs={"force": True}) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with open(self.state_file, encoding="utf-8") as fh:
+            self.assertEqual(len(json.load(fh)["proxies"]), 200)
+        self.assertEqual(os.listdir(self.state_dir.name), ["state.json"])
+
+
+class CountingParser:
+    def __init__(self, offers):
+        self.offers = offers
+        self.calls = 0
+        self.timeout = 3
+
+    def search_product(self, product_name):
+        self.calls += 1
+        return SearchResult(list(self.offers), attempts=1)
+
+
+class SearchCacheTests(SimpleTestCase):
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query("  iPhone   15 "), "iphone 15")
+        self.assertEqual(normalize_query("iPhone-15!"), "iphone 15")
+        self.assertEqual(normalize_query("Айфон 15"), normalize_query("айфон-15"))
+        self.assertEqual(normalize_query("айфон 15"), "aifon 15")
+
+    def test_key_is_safe_for_any_cache_backend(self):
+        key = SearchCache(backend=MemoryBackend()).key("ozon", "Пуховик  женский зимний " * 20)
+        self.assertNotIn(" ", key)
+        self.assertLess(len(key), 250)
+        self.assertEqual(key, SearchCache(backend=MemoryBackend()).key("ozon", "пуховик женский зимний " * 20))
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "parser-cache-tests"}})
+    def test_django_backend_emits_no_key_warnings(self):
+        cache = SearchCache(backend=DjangoCacheBackend("default"))
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", CacheKeyWarning)
+            cache.set("wildberries", "детские кроссовки 32 размер", [{"title": "x"}])
+            self.assertEqual(cache.get("wildberries", "Детские  кроссовки 32 размер"), [{"title": "x"}])
+
+    def test_memory_backend_expiry_and_lru(self):
+        backend = MemoryBackend(max_entries=2)
+        backend.set("a", 1, ttl=60)
+        backend.set("b", 2, ttl=60)
+        backend.get("a")
+        backend.set("c", 3, ttl=60)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("a"), 1)
+        backend.set("d", 4, ttl=-1)
+        self.assertIsNone(backend.get("d"))
+
+    def test_cached_parser_reads_through(self):
+        parser = CountingParser([{"title": "phone", "price": 10}])
+        cached = CachedParser(parser, "amazon", SearchCache(backend=MemoryBackend()))
+        first = cached.search_product("Phone")
+        second = cached.search_product(" phone ")
+        self.assertEqual(parser.calls, 1)
+        self.assertFalse(getattr(first, "cached", False))
+        self.assertTrue(second.cached)
+        self.assertEqual(second, first)
+        self.assertEqual(cached.cache.stats()["hits"], 1)
+        # атрибуты парсера доступны через обёртку
+        self.assertEqual(cached.timeout, 3)
+
+    def test_empty_results_are_not_cached(self):
+        parser = CountingParser([])
+        cached = CachedParser(parser, "ozon", SearchCache(backend=MemoryBackend()))
+        cached.search_product("phone")
+        cached.search_product("phone")
+        self.assertEqual(parser.calls, 2)
+
+    def test_zero_ttl_disables_marketplace(self):
+        parser = CountingParser([{"title": "phone"}])
+        cached = CachedParser(parser, "ozon", SearchCache(backend=MemoryBackend(), ttl={"ozon": 0}))
+        cached.search_product("phone")
+        cached.search_product("phone")
+        self.assertEqual(parser.calls, 2)
+
+
+class FakeResponse:
+    def __init__(self, status_code, text="", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeSession:
+    """Returns queued responses (or raises queued exceptions) and records the proxies used."""
+
+    def __init__(self, *outcomes, delay=0.0):
+        self.outcomes = list(outcomes)
+        self.delay = delay
+        self.calls = []
+
+    def request(self, method, url, headers=None, timeout=None, proxies=None, **kwargs):
+        self.calls.append({"proxies": proxies, "timeout": timeout})
+        time.sleep(self.delay)
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome) if isinstance(outcome, int) else outcome
+
+
+class FakeProxyPool:
+    def __init__(self, proxies):
+        self.proxies = proxies
+        self.reports = []
+
+    def get_proxy(self, exclude=(), wait=True):
+        for proxy in self.proxies:
+            if proxy not in exclude:
+                return {"http": proxy, "https": proxy}
+        return None
+
+    def report(self, proxy, ok, latency=None):
+        self.reports.append((proxy["http"], ok))
+
+
+class RetryPolicyTests(SimpleTestCase):
+    def _policy(self, **kwargs):
+        return RetryPolicy(**{"base_delay": 0.01, "max_delay": 0.02, **kwargs})
+
+    def test_retries_transient_errors_until_success(self):
+        session = FakeSession(503, 502, 200)
+        response = request_with_fallback(session, "get", "http://x", self._policy().start())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(session.calls), 3)
+
+    def test_attempts_are_capped(self):
+        session = FakeSession(503)
+        budget = self._policy(max_attempts=3).start()
+        response = request_with_fallback(session, "get", "http://x", budget)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(budget.attempts, 3)
+
+    def test_block_is_not_retried(self):
+        session = FakeSession(403)
+        request_with_fallback(session, "get", "http://x", self._policy().start())
+        self.assertEqual(len(session.calls), 1)
+
+    def test_blocked_proxy_is_reported_and_rotated(self):
+        session = FakeSession(403, 429, 200)
+        pool = FakeProxyPool(["http://p:1", "http://p:2"])
+        response = request_with_fallback(session, "get", "http://x", self._policy().start(), proxy_pool=pool)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(pool.reports, [("http://p:1", False), ("http://p:2", True)])
+
+    def test_challenge_through_proxy_counts_as_failure(self):
+        challenge = FakeResponse(503, "<title>Just a moment...</title>", {"Server": "cloudflare"})
+        session = FakeSession(503, challenge, 404)
+        pool = FakeProxyPool(["http://p:1", "http://p:2"])
+        response = request_with_fallback(session, "get", "http://x", self._policy().start(), proxy_pool=pool)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(pool.reports, [("http://p:1", False), ("http://p:2", True)])
+
+    def test_not_found_does_not_rotate_proxies(self):
+        session = FakeSession(404)
+        pool = FakeProxyPool(["http://p:1", "http://p:2"])
+        budget = self._policy().start()
+        request_with_fallback(session, "get", "http://x", budget, proxy_pool=pool)
+        self.assertEqual((budget.attempts, pool.reports), (1, []))
+
+    def test_failure_describes_unusable_responses(self):
+        policy = self._policy()
+        challenge = FakeResponse(503, "<title>Just a moment...</title>", {"Server": "cloudflare"})
+        self.assertEqual(
+            [policy.failure(r) for r in (FakeResponse(200), FakeResponse(429), challenge, FakeResponse(500))],
+            ["", "blocked", "blocked", "http 500"],
+        )
+
+    def test_cloudflare_challenge_is_not_retried(self):
+        challenge = FakeResponse(503, "<title>Just a moment...</title>", {"Server": "cloudflare"})
+        session = FakeSession(challenge)
+        request_with_fallback(session, "get", "http://x", self._policy().start())
+        self.assertEqual(len(session.calls), 1)
+
+    def test_time_budget_bounds_the_search(self):
+        session = FakeSession(503, delay=0.2)
+        budget = self._policy(total_budget=1.0, max_attempts=50).start()
+        started = time.monotonic()
+        request_with_fallback(session, "get", "http://x", budget)
+        self.assertLess(time.monotonic() - started, 1.0)
+        # таймаут каждой попытки не больше оставшегося бюджета
+        self.assertTrue(all(call["timeout"][1] <= 1.0 for call in session.calls))
+
+    def test_rotates_proxies_and_reports_outcome(self):
+        session = FakeSession(ConnectionError("refused"), ConnectionError("refused"), 200)
+        pool = FakeProxyPool(["http://p:1", "http://p:2"])
+        response = request_with_fallback(session, "get", "http://x", self._policy().start(), proxy_pool=pool)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c["proxies"]["http"] if c["proxies"] else None for c in session.calls],
+                         [None, "http://p:1", "http://p:2"])
+        self.assertEqual(pool.reports, [("http://p:1", False), ("http://p:2", True)])
+
+    def test_raises_when_no_attempt_got_a_response(self):
+        session = FakeSession(ConnectionError("refused"))
+        with self.assertRaises(ConnectionError):
+            request_with_fallback(session, "get", "http://x", self._policy(max_attempts=2).start())
+
+    def test_backoff_grows_and_is_capped(self):
+        policy = RetryPolicy(base_delay=0.25, max_delay=1.0)
+        for _ in range(20):
+            self.assertTrue(0.125 <= policy.backoff(1) <= 0.25)
+            self.assertTrue(0.5 <= policy.backoff(10) <= 1.0)
+
+    @override_settings(PARSER_RETRY={"default": {"total_budget": 9.0}, "ozon": {"max_attempts": 7}})
+    def test_marketplace_overrides(self):
+        policy = RetryPolicy.for_marketplace("ozon")
+        self.assertEqual((policy.total_budget, policy.max_attempts), (9.0, 7))
+        self.assertEqual(RetryPolicy.for_marketplace("amazon").max_attempts, 5)
+
+
+class ParserFailureTests(SimpleTestCase):
+    """Parsers tell a failed search from an empty one via SearchResult.error."""
+
+    def _parser(self, *outcomes):
+        with mock.patch("parsers.wildberries_parser.get_proxy_pool", return_value=None):
+            parser = WildberriesParser()
+        parser.session = FakeSession(*outcomes)
+        parser.retry_policy = RetryPolicy(base_delay=0.01, max_delay=0.02, max_attempts=2)
+        return parser
+
+    def test_block_is_reported_as_error(self):
+        result = self._parser(403).search_product("phone")
+        self.assertEqual((list(result), result.error), ([], "blocked"))
+
+    def test_network_error_is_reported(self):
+        result = self._parser(ConnectionError("refused")).search_product("phone")
+        self.assertEqual((list(result), result.error), ([], "refused"))
+
+    def test_nothing_found_is_not_an_error(self):
+        result = self._parser(FakeResponse(200, '{"data": {"products": []}}')).search_product("phone")
+        self.assertEqual((list(result), result.error), ([], ""))
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "breaker-tests"}},
+    CIRCUIT_BREAKER={"FAILURE_THRESHOLD": 3, "RECOVERY_TIMEOUT": 30, "MARKETPLACES": {"ozon": {"FAILURE_THRESHOLD": 2}}},
+)
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker("amazon")
+        self.breaker.reset()
+
+    def test_opens_after_threshold(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_success_resets_the_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_half_open_lets_one_probe_through(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        with mock.patch("parsers.circuit.time.time", return_value=time.time() + 31):
+            self.assertEqual(self.breaker.state, HALF_OPEN)
+            self.assertTrue(self.breaker.allow_request())
+            self.assertFalse(CircuitBreaker("amazon").allow_request())
+            self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_failed_probe_reopens(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        later = time.time() + 31
+        with mock.patch("parsers.circuit.time.time", return_value=later):
+            self.assertTrue(self.breaker.allow_request())
+            self.breaker.record_failure()
+            self.assertEqual(self.breaker.state, OPEN)
+
+    def test_per_marketplace_threshold(self):
+        ozon = CircuitBreaker("ozon")
+        ozon.reset()
+        ozon.record_failure()
+        ozon.record_failure()
+        self.assertEqual(ozon.state, OPEN)
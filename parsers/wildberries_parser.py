@@ -1,7 +1,8 @@
 from typing import List, Optional
 
-import requests
-from .proxy_pool import ProxyPool
+from .http import get_session
+from .proxy_pool import get_proxy_pool
+from .retry import RetryPolicy, SearchResult, request_with_fallback
 
 
 class WildberriesParser:
@@ -17,9 +18,12 @@ class WildberriesParser:
             "curr": "rub",
             "dest": "-1257786",
         }
-        self.proxy_pool = ProxyPool()
+        self.session = get_session()
+        self.proxy_pool = get_proxy_pool()
+        self.retry_policy = RetryPolicy.for_marketplace("wildberries")
 
     def search_product(self, product_name: str) -> List[dict]:
+        budget = self.retry_policy.start()
         try:
             search_url = "https://search.wb.ru/exactmatch/ru/common/v5/search"
             params = {
@@ -31,8 +35,10 @@ class WildberriesParser:
                 "page": 1,
             }
 
-            response = self._safe_get(search_url, params=params)
-            response.raise_for_status()
+            response = self._safe_get(search_url, budget=budget, params=params)
+            error = self.retry_policy.failure(response)
+            if error:
+                return SearchResult([], elapsed=budget.elapsed, attempts=budget.attempts, error=error)
             data = response.json()
 
             products = []
@@ -41,10 +47,10 @@ class WildberriesParser:
                 if product:
                     products.append(product)
 
-            return products
+            return SearchResult(products, elapsed=budget.elapsed, attempts=budget.attempts)
         except Exception as e:
             print(f"Wildberries parser error: {e}")
-            return []
+            return SearchResult([], elapsed=budget.elapsed, attempts=budget.attempts, error=str(e) or type(e).__name__)
 
     def parse_product_item(self, item) -> Optional[dict]:
         try:
@@ -72,25 +78,14 @@ class WildberriesParser:
             print(f"Error parsing Wildberries item: {e}")
             return None
 
-    def _safe_get(self, url, **kwargs):
-        try:
-            resp = requests.get(url, headers=self.headers, timeout=12, **kwargs)
-            if resp.status_code == 200:
-                return resp
-        except Exception:
-            pass
-
-        # fallback to free proxies
-        for _ in range(5):
-            proxy = self.proxy_pool.get_proxy()
-            if not proxy:
-                break
-            try:
-                resp = requests.get(
-                    url, headers=self.headers, timeout=12, proxies=proxy, **kwargs
-                )
-                if resp.status_code == 200:
-                    return resp
-            except Exception:
-                continue
-        return requests.get(url, headers=self.headers, timeout=12, **kwargs)
+    def _safe_get(self, url, budget=None, **kwargs):
+        # fallback to free proxies в пределах бюджета попыток и времени
+        return request_with_fallback(
+            self.session,
+            "get",
+            url,
+            budget=budget or self.retry_policy.start(),
+            headers=self.headers,
+            proxy_pool=self.proxy_pool,
+            **kwargs,
+        )
@@ -3,6 +3,11 @@ ASGI config for pricetracker project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve the project through it (e.g. ``uvicorn pricetracker.asgi:application``)
+to get the streaming search page: ``search_results_stream`` is an async view
+whose server-sent events are flushed as each marketplace answers. Under WSGI
+the same response is buffered until the slowest marketplace finishes.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
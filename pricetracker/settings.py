@@ -59,6 +59,18 @@ DATABASES = {
     }
 }
 
+# "shared" — общий для всех воркеров на хосте кэш (circuit breaker, блокировки);
+# в кластере замените на redis/memcached
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / '.cache',
+    },
+}
+
 LANGUAGE_CODE = 'ru-ru'
 TIME_ZONE = 'Europe/Moscow'
 USE_I18N = True
@@ -75,3 +87,146 @@ LOGIN_URL = 'login'
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Параллельный опрос маркетплейсов (products.services)
+PARSER_MAX_WORKERS = 16
+MARKETPLACE_TIMEOUTS = {
+    "amazon": 15.0,
+    "wildberries": 10.0,
+    "ozon": 20.0,
+}
+MARKETPLACE_TOTAL_TIMEOUT = 25.0
+
+# Общий HTTP-пул парсеров (parsers.http)
+PARSER_HTTP_POOL_CONNECTIONS = 16
+PARSER_HTTP_POOL_MAXSIZE = 16
+
+# Пул бесплатных прокси (parsers.proxy_pool)
+PROXY_POOL_STATE_FILE = BASE_DIR / 'proxy_pool_state.json'
+PROXY_POOL_MAX_SIZE = 30
+PROXY_POOL_LOW_WATERMARK = 10
+PROXY_POOL_MAX_FAILURES = 3
+# сколько get_proxy ждёт первый живой прокси на холодном старте (загрузка идёт в фоне), секунды
+PROXY_POOL_COLD_WAIT = 2.0
+
+# Кэш результатов поиска (parsers.cache); BACKEND: "memory" или "django"
+PARSER_CACHE = {
+    "ENABLED": True,
+    "BACKEND": "memory",
+    "ALIAS": "default",
+    "MAX_ENTRIES": 1000,
+    "DEFAULT_TTL": 15 * 60,
+    "TTL": {
+        "amazon": 30 * 60,
+        "wildberries": 10 * 60,
+        "ozon": 15 * 60,
+    },
+}
+
+# Политика повторов парсеров (parsers.retry): бюджет времени на один поиск
+PARSER_RETRY = {
+    "default": {
+        "total_budget": 15.0,
+        "max_attempts": 4,
+        "base_delay": 0.25,
+        "max_delay": 2.0,
+        "connect_timeout": 3.05,
+        "read_timeout": 8.0,
+    },
+    "wildberries": {"total_budget": 8.0},
+    "ozon": {"total_budget": 18.0, "max_attempts": 5},
+}
+
+# Circuit breaker по маркетплейсам (parsers.circuit)
+CIRCUIT_BREAKER = {
+    "FAILURE_THRESHOLD": 5,
+    "RECOVERY_TIMEOUT": 60,
+    "CACHE_ALIAS": "shared",
+    "MARKETPLACES": {
+        "ozon": {"FAILURE_THRESHOLD": 3, "RECOVERY_TIMEOUT": 120},
+    },
+}
+
+# Схлопывание одинаковых одновременных поисков (products.singleflight)
+SINGLE_FLIGHT = {
+    "CACHE_ALIAS": "shared",
+    "LOCK_TIMEOUT": 60,
+    "WAIT_TIMEOUT": 45,
+}
+
+# Свежесть офферов в search_results (stale-while-revalidate), секунды
+OFFER_FRESHNESS_TTL = {
+    "default": 3600,
+    "amazon": 3 * 3600,
+    "wildberries": 30 * 60,
+    "ozon": 3600,
+}
+OFFER_COLD_DEADLINE = 8.0
+OFFER_BACKGROUND_REFRESH = True
+OFFER_BACKGROUND_WORKERS = 4
+
+# Холодный поиск отдаёт страницу сразу, а офферы — потоком SSE.
+# Включать только при запуске через ASGI (uvicorn pricetracker.asgi:application):
+# runserver и WSGI буферизуют StreamingHttpResponse до ответа самого медленного маркетплейса.
+SEARCH_STREAMING = False
+
+# Адаптивное расписание обновления цен (products.scheduler), секунды
+REFRESH_SCHEDULE = {
+    "MIN_INTERVAL": 15 * 60,
+    "BASE_INTERVAL": 2 * 3600,
+    "MAX_INTERVAL": 24 * 3600,
+    "VOLATILITY_WINDOW_DAYS": 7,
+}
+
+# Запись офферов (products.pipeline): "incremental" — обновление на месте,
+# история только при смене цены или раз в OFFER_HISTORY_HEARTBEAT секунд; "replace" — как раньше
+OFFER_REFRESH_MODE = "incremental"
+OFFER_HISTORY_HEARTBEAT = 24 * 3600
+# размер пачки bulk_create/bulk_update при записи офферов и истории
+OFFER_WRITE_BATCH_SIZE = 500
+
+# Очередь заданий обновления (products.jobs, manage.py run_refresh_worker), секунды
+REFRESH_JOBS = {
+    "LEASE": 300,
+    "HEARTBEAT": 60,
+    "MAX_ATTEMPTS": 5,
+    "RETRY_BASE_DELAY": 60,
+    "RETRY_MAX_DELAY": 3600,
+}
+
+# Файл контрольных точек refresh_prices --resume (products.refresh.Checkpoint)
+REFRESH_CHECKPOINT_FILE = BASE_DIR / 'refresh_checkpoint.json'
+# Сколько последних ключей запуска refresh_prices помнить для переиспользования дубликатов
+REFRESH_SEEN_MAX_KEYS = 50_000
+
+# Дневные агрегаты истории (products.rollups, manage.py compact_history):
+# сырые точки хранятся RETENTION_DAYS дней; прогнозы читают сырые точки за RAW_DAYS,
+# дальше — дневные бары, но не старше MAX_DAYS; серия одной цены (collected_at..seen_until)
+# читается как точки через каждые RUN_STEP секунд
+HISTORY_ROLLUPS = {
+    "RETENTION_DAYS": 90,
+    "RAW_DAYS": 14,
+    "MAX_DAYS": 365,
+    "RUN_STEP": 2 * 3600,
+}
+
+# Колоночное хранилище истории для прогнозов (analysis.history_store, manage.py sync_history_store);
+# нужен numpy. Выключено — прогнозы читают историю через ORM
+HISTORY_STORE = {
+    "ENABLED": False,
+    "DIR": BASE_DIR / 'history_store',
+}
+
+# Курсы валют (products.currency.RateService): TTL локального и общего кэша, секунды
+CURRENCY_RATES = {
+    "TTL": 3600,
+    "CACHE_ALIAS": "shared",
+}
+
+# Глобальная модель прогноза (analysis.global_model, manage.py train_global_model): артефакты в DIR,
+# воркер загружает текущую версию один раз и проверяет current.json не чаще RELOAD_INTERVAL секунд
+GLOBAL_MODEL = {
+    "DIR": BASE_DIR / 'models',
+    "HORIZON_DAYS": 30,
+    "RELOAD_INTERVAL": 300,
+}
@@ -17,5 +17,6 @@ urlpatterns = [
     path("products/", include("products.urls")),
     path("search/", product_views.product_search, name="product_search"),
     path("results/", product_views.search_results, name="search_results"),
+    path("results/stream/", product_views.search_results_stream, name="search_results_stream"),
     path("notifications/", include(notification_urls)),
 ]
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import ProductQuery, Offer, PriceAlert
+from .models import ProductQuery, Offer, PriceAlert, RefreshJob
 
 
 @admin.register(ProductQuery)
@@ -12,7 +12,7 @@ class ProductQueryAdmin(admin.ModelAdmin):
 
 @admin.register(Offer)
 class OfferAdmin(admin.ModelAdmin):
-    list_display = ("title", "marketplace", "price", "currency", "rating", "parsed_at")
+    list_display = ("title", "marketplace", "price", "currency", "price_rub", "rating", "parsed_at")
     list_filter = ("marketplace", "parsed_at")
     search_fields = ("title",)
 
@@ -21,3 +21,10 @@ class OfferAdmin(admin.ModelAdmin):
 class PriceAlertAdmin(admin.ModelAdmin):
     list_display = ("query", "target_price", "is_active", "created_at")
     list_filter = ("is_active", "created_at")
+
+
+@admin.register(RefreshJob)
+class RefreshJobAdmin(admin.ModelAdmin):
+    list_display = ("query", "status", "attempts", "run_after", "locked_by", "locked_until")
+    list_filter = ("status",)
+    search_fields = ("query__name", "last_error")
@@ -1,47 +1,312 @@
+"""
+Курсы валют к рублю.
+
+RateService — один источник курсов для сайта, команд и аналитики. Курс
+ищется в локальном словаре процесса (с TTL), затем в общем кэше (алиас
+CURRENCY_RATES["CACHE_ALIAS"], общий для воркеров), затем в CurrencyRate.
+Просроченный курс отдаётся сразу, а обновляется в фоне из CurrencyRate;
+в сеть (ЦБ) ходит только фоновое обновление, если курса нет и в БД, —
+запрос пользователя никогда не ждёт внешний API. Пока курса нет нигде,
+get_rate отдаёт запасной FALLBACK, но known_rate — None: такой курс не
+записывается в price_rub_kop, эти строки дозаполнит backfill_rub_prices.
+
+Для пересчёта истории по курсу на дату служит лента CurrencyRateHistory:
+RateIndex держит её в памяти как отсортированные массивы (valid_from, rate),
+и курс на любой момент находится бинарным поиском. to_rub_at_many пересчитывает
+ряд целиком с одной загрузкой индекса на валюту.
+"""
+
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
 import requests
-from typing import Dict, Optional
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from analysis.models import CurrencyRate, CurrencyRateHistory
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy необязателен
+    np = None
+
+CBR_URL = "https://www.cbr-xml-daily.ru/latest.js"
+DEFAULTS = {
+    "TTL": 3600,
+    "CACHE_ALIAS": "default",
+    # пока настоящего курса нет нигде, а фоновая загрузка не закончилась
+    "FALLBACK": {"USD": 90.0},
+    "DEFAULT_FALLBACK": 100.0,
+    "FALLBACK_TTL": 60,
+}
+
+
+def _config() -> Dict:
+    return {**DEFAULTS, **getattr(settings, "CURRENCY_RATES", {})}
+
+
+def fetch_cbr_snapshot() -> Tuple[datetime, Dict[str, float]]:
+    """Date of the CBR daily feed and RUB per unit of each currency."""
+    resp = requests.get(CBR_URL, timeout=8)
+    resp.raise_for_status()
+    data = resp.json()
+    as_of = parse_datetime(str(data.get("date", ""))) or timezone.now()
+    if timezone.is_naive(as_of):
+        as_of = timezone.make_aware(as_of)
+    # в API база RUB, rates[code] = code per RUB; нам нужен RUB per code
+    return as_of, {code: 1 / float(val) for code, val in data.get("rates", {}).items() if val}
+
+
+def fetch_cbr_rates() -> Dict[str, float]:
+    return fetch_cbr_snapshot()[1]
+
+
+class RateIndex:
+    """Sorted timeline of one currency; ``rate_at`` is a binary search over valid_from."""
+
+    def __init__(self, timestamps: Sequence[float], rates: Sequence[float], default: float):
+        self.timestamps = list(timestamps)
+        self.rates = list(rates)
+        self.default = default
+        if np is not None:
+            self._ts_array = np.asarray(self.timestamps, dtype=np.float64)
+            self._rate_array = np.asarray(self.rates, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def rate_at(self, when) -> float:
+        if not self.timestamps:
+            return self.default
+        ts = when.timestamp() if isinstance(when, datetime) else float(when)
+        # до первой точки ленты действует самый ранний известный курс
+        return self.rates[max(bisect_right(self.timestamps, ts) - 1, 0)]
+
+    def rates_at(self, timestamps: Sequence[float]):
+        """Rates for many unix timestamps (numpy searchsorted when available)."""
+        if not self.timestamps:
+            return [self.default] * len(timestamps)
+        if np is not None:
+            positions = np.searchsorted(self._ts_array, np.asarray(timestamps, dtype=np.float64), side="right")
+            return self._rate_array[np.clip(positions - 1, 0, None)]
+        return [self.rate_at(ts) for ts in timestamps]
+
+
+class RateService:
+    def __init__(self):
+        self._local: Dict[str, Tuple[float, float]] = {}
+        # коды, для которых в _local лежит запасной курс, а не настоящий
+        self._fallback: set = set()
+        self._indexes: Dict[str, Tuple[RateIndex, float]] = {}
+        self._lock = threading.Lock()
+        self._refresh_thread: Optional[threading.Thread] = None
+
+    @property
+    def _cache(self):
+        return caches[_config()["CACHE_ALIAS"]]
+
+    @staticmethod
+    def _key(code: str) -> str:
+        return f"currency:rate:{code}"
 
-from analysis.models import CurrencyRate
+    def _remember(self, rates: Dict[str, float], ttl: float, fallback: bool = False) -> None:
+        expires = time.monotonic() + ttl
+        with self._lock:
+            for code, rate in rates.items():
+                self._local[code] = (rate, expires)
+                if fallback:
+                    self._fallback.add(code)
+                else:
+                    self._fallback.discard(code)
 
-_RATE_CACHE: Dict[str, float] = {"RUB": 1.0}
+    def get_rate(self, currency: Optional[str]) -> float:
+        return self._lookup(currency)[0]
+
+    def known_rate(self, currency: Optional[str]) -> Optional[float]:
+        """Like get_rate, but None while only the hard-coded fallback is available."""
+        rate, fallback = self._lookup(currency)
+        return None if fallback else rate
+
+    def _lookup(self, currency: Optional[str]) -> Tuple[float, bool]:
+        code = (currency or "RUB").upper()
+        if code == "RUB":
+            return 1.0, False
+        entry = self._local.get(code)
+        if entry is not None:
+            if entry[1] < time.monotonic():
+                self.refresh_in_background()
+            return entry[0], code in self._fallback
+
+        config = _config()
+        rate = self._cache.get(self._key(code))
+        if rate is None:
+            db_rate = (
+                CurrencyRate.objects.filter(code=code)
+                .order_by("-updated_at")
+                .values_list("rate", flat=True)
+                .first()
+            )
+            if db_rate is not None:
+                rate = float(db_rate)
+                self._cache.set(self._key(code), rate, timeout=config["TTL"])
+        if rate is None:
+            # курса нет ни в кэше, ни в БД: сеть — только в фоне
+            self.refresh_in_background()
+            rate = config["FALLBACK"].get(code, config["DEFAULT_FALLBACK"])
+            self._remember({code: rate}, config["FALLBACK_TTL"], fallback=True)
+            return rate, True
+        self._remember({code: rate}, config["TTL"])
+        return rate, False
+
+    def refresh(self) -> Dict[str, float]:
+        """Reload all rates from CurrencyRate (or the CBR feed if the table is empty)."""
+        config = _config()
+        rates = {code: float(rate) for code, rate in CurrencyRate.objects.values_list("code", "rate")}
+        if not rates:
+            try:
+                rates = fetch_cbr_rates()
+                for code, rate in rates.items():
+                    CurrencyRate.objects.update_or_create(code=code, defaults={"rate": rate})
+            except Exception as exc:
+                print(f"Currency rates refresh error: {exc}")
+                return {}
+        self._cache.set_many({self._key(code): rate for code, rate in rates.items()}, timeout=config["TTL"])
+        # лента могла пополниться — индексы перечитаются при следующем обращении
+        self._cache.delete_many([f"currency:timeline:{code}" for code in rates])
+        with self._lock:
+            self._indexes.clear()
+        self._remember(rates, config["TTL"])
+        return rates
+
+    def refresh_in_background(self) -> None:
+        def task():
+            try:
+                self.refresh()
+            except Exception as exc:
+                print(f"Currency rates refresh error: {exc}")
+            finally:
+                connection.close()
+
+        with self._lock:
+            if self._refresh_thread and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=task, name="currency-rates", daemon=True)
+            self._refresh_thread.start()
+
+    def index(self, currency: Optional[str]) -> RateIndex:
+        """Timeline of ``currency`` loaded once per TTL (shared cache, then CurrencyRateHistory)."""
+        code = (currency or "RUB").upper()
+        if code == "RUB":
+            return RateIndex([], [], 1.0)
+        entry = self._indexes.get(code)
+        if entry is not None and entry[1] >= time.monotonic():
+            return entry[0]
+        config = _config()
+        key = f"currency:timeline:{code}"
+        points = self._cache.get(key)
+        if points is None:
+            points = [
+                (valid_from.timestamp(), float(rate))
+                for valid_from, rate in CurrencyRateHistory.objects.filter(code=code)
+                .order_by("valid_from")
+                .values_list("valid_from", "rate")
+            ]
+            self._cache.set(key, points, timeout=config["TTL"])
+        index = RateIndex([p[0] for p in points], [p[1] for p in points], self.get_rate(code))
+        with self._lock:
+            self._indexes[code] = (index, time.monotonic() + config["TTL"])
+        return index
+
+    def clear(self) -> None:
+        with self._lock:
+            self._local.clear()
+            self._fallback.clear()
+            self._indexes.clear()
+
+
+_service: Optional[RateService] = None
+_service_lock = threading.Lock()
+
+
+def get_rate_service() -> RateService:
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = RateService()
+    return _service
 
 
 def get_rate(currency: str) -> float:
-    curr = (currency or "").upper()
-    if curr in _RATE_CACHE:
-        return _RATE_CACHE[curr]
-    if curr == "RUB" or curr == "":
-        _RATE_CACHE[curr or "RUB"] = 1.0
-        return 1.0
-    # try DB
-    try:
-        db_rate = CurrencyRate.objects.filter(code=curr).order_by("-updated_at").first()
-        if db_rate:
-            _RATE_CACHE[curr] = float(db_rate.rate)
-            return float(db_rate.rate)
-    except Exception:
-        pass
-    # fallback to API and save (если нет записи — для первой инициализации)
-    try:
-        resp = requests.get("https://www.cbr-xml-daily.ru/latest.js", timeout=6)
-        if resp.status_code == 200:
-            data = resp.json()
-            rate_val = data.get("rates", {}).get(curr)
-            if rate_val:
-                inv = 1 / float(rate_val)  # RUB per currency
-                _RATE_CACHE[curr] = inv
-                try:
-                    CurrencyRate.objects.update_or_create(code=curr, defaults={"rate": inv})
-                except Exception:
-                    pass
-                return inv
-    except Exception:
-        pass
-    fallback = 90.0 if curr == "USD" else 100.0
-    _RATE_CACHE[curr] = fallback
-    return fallback
+    return get_rate_service().get_rate(currency)
 
 
 def to_rub(price: float, currency: Optional[str]) -> float:
     rate = get_rate(currency or "RUB")
     return price * rate
+
+
+def to_rub_many(prices: Iterable, currencies: Iterable[Optional[str]]):
+    """
+    Convert many prices at once: one rate lookup per distinct currency.
+    Returns a float64 numpy array when numpy is installed, a list otherwise.
+    """
+    currencies = [(c or "RUB").upper() for c in currencies]
+    if np is not None:
+        codes, inverse = np.unique(np.array(currencies, dtype=object), return_inverse=True)
+        rates = np.array([get_rate(code) for code in codes], dtype=np.float64)
+        return np.asarray([float(p) for p in prices], dtype=np.float64) * rates[inverse]
+    rates = {code: get_rate(code) for code in set(currencies)}
+    return [float(p) * rates[code] for p, code in zip(prices, currencies)]
+
+
+def rate_at(currency: Optional[str], when) -> float:
+    """Rate that was in effect at ``when`` (datetime or unix timestamp)."""
+    return get_rate_service().index(currency).rate_at(when)
+
+
+def to_rub_at_many(prices: Iterable, currencies: Iterable[Optional[str]], moments: Iterable):
+    """
+    Like to_rub_many, but each price is converted at the rate in effect at its
+    moment (datetime or unix timestamp): one index load per currency, then a
+    binary search per point.
+    """
+    prices = [float(p) for p in prices]
+    currencies = [(c or "RUB").upper() for c in currencies]
+    timestamps = [m.timestamp() if isinstance(m, datetime) else float(m) for m in moments]
+    positions: Dict[str, List[int]] = {}
+    for i, code in enumerate(currencies):
+        positions.setdefault(code, []).append(i)
+    service = get_rate_service()
+    rates = [1.0] * len(prices)
+    for code, idx in positions.items():
+        if code == "RUB":
+            continue
+        for i, rate in zip(idx, service.index(code).rates_at([timestamps[i] for i in idx])):
+            rates[i] = float(rate)
+    if np is not None:
+        return np.asarray(prices, dtype=np.float64) * np.asarray(rates, dtype=np.float64)
+    return [p * r for p, r in zip(prices, rates)]
+
+
+RATE_PRECISION = Decimal("0.000001")
+
+
+def to_rub_kopecks(price: Decimal, currency: Optional[str]) -> Tuple[Optional[int], Optional[Decimal]]:
+    """
+    Canonical RUB amount in kopecks and the rate used, as stored on Offer/OfferHistory.
+    (None, None) while the currency has only a fallback rate: the row is left for backfill_rub_prices.
+    """
+    known = get_rate_service().known_rate(currency or "RUB")
+    if known is None:
+        return None, None
+    rate = Decimal(str(known)).quantize(RATE_PRECISION)
+    kopecks = (Decimal(price) * rate * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP)
+    return int(kopecks), rate
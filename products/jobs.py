@@ -0,0 +1,172 @@
+"""
+Очередь заданий на обновление цен в БД (RefreshJob) для нескольких воркеров.
+
+На каждый ProductQuery — одна строка RefreshJob. Воркер захватывает
+просроченные задания (query.next_refresh_at наступил, бэкофф истёк) на время
+аренды (lease) и продлевает её heartbeat'ом, пока парсит. Задание с истёкшей
+арендой (воркер умер) снова доступно другим. Захват:
+- PostgreSQL: SELECT ... FOR UPDATE SKIP LOCKED, воркеры не ждут друг друга;
+- SQLite и прочие: UPDATE ... WHERE <всё ещё свободно> по одному заданию
+  (compare-and-set, SQLite сериализует запись), проигравший просто берёт следующее.
+После ошибки задание откладывается с экспоненциальным бэкоффом, после
+MAX_ATTEMPTS неудач переходит в статус dead.
+"""
+
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import ProductQuery, RefreshJob
+
+DEFAULTS = {
+    "LEASE": 300,
+    "HEARTBEAT": 60,
+    "MAX_ATTEMPTS": 5,
+    "RETRY_BASE_DELAY": 60,
+    "RETRY_MAX_DELAY": 3600,
+}
+
+
+def _config() -> Dict:
+    return {**DEFAULTS, **getattr(settings, "REFRESH_JOBS", {})}
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def sync_jobs() -> int:
+    """Create missing RefreshJob rows (one per ProductQuery)."""
+    missing = ProductQuery.objects.filter(refresh_job__isnull=True).values_list("id", flat=True)
+    jobs = [RefreshJob(query_id=query_id) for query_id in missing.iterator()]
+    # ignore_conflicts: другой воркер мог создать те же задания
+    RefreshJob.objects.bulk_create(jobs, batch_size=500, ignore_conflicts=True)
+    return len(jobs)
+
+
+def requeue_dead() -> int:
+    return RefreshJob.objects.filter(status=RefreshJob.DEAD).update(
+        status=RefreshJob.PENDING, attempts=0, run_after=None, last_error=""
+    )
+
+
+def _claimable(now: datetime) -> Q:
+    due = Q(query__next_refresh_at__isnull=True) | Q(query__next_refresh_at__lte=now)
+    ready = Q(run_after__isnull=True) | Q(run_after__lte=now)
+    pending = Q(status=RefreshJob.PENDING) & due & ready
+    # аренда истекла — воркер, который держал задание, пропал
+    abandoned = Q(status=RefreshJob.RUNNING, locked_until__lt=now)
+    return pending | abandoned
+
+
+def _candidates(now: datetime):
+    return RefreshJob.objects.filter(_claimable(now)).order_by(
+        F("query__next_refresh_at").asc(nulls_first=True), "id"
+    )
+
+
+def claim_jobs(worker_id: str, limit: int, lease: Optional[float] = None) -> List[RefreshJob]:
+    """Lease up to ``limit`` due jobs to ``worker_id``; returns them with ``query`` loaded."""
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=lease or _config()["LEASE"])
+    claim = {
+        "status": RefreshJob.RUNNING,
+        "locked_by": worker_id,
+        "locked_until": lease_until,
+        "heartbeat_at": now,
+        "attempts": F("attempts") + 1,
+    }
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(
+                _candidates(now)
+                .select_for_update(skip_locked=True, of=("self",))
+                .values_list("id", flat=True)[:limit]
+            )
+            RefreshJob.objects.filter(pk__in=ids).update(**claim)
+    else:
+        ids = []
+        # берём с запасом: часть кандидатов может перехватить другой воркер
+        for job_id in _candidates(now).values_list("id", flat=True)[: limit * 2]:
+            if RefreshJob.objects.filter(_claimable(now), pk=job_id).update(**claim):
+                ids.append(job_id)
+                if len(ids) >= limit:
+                    break
+    return list(RefreshJob.objects.select_related("query").filter(pk__in=ids, locked_by=worker_id))
+
+
+def heartbeat(worker_id: str, job_ids: Iterable[int], lease: Optional[float] = None) -> int:
+    now = timezone.now()
+    return RefreshJob.objects.filter(
+        pk__in=list(job_ids), status=RefreshJob.RUNNING, locked_by=worker_id
+    ).update(
+        heartbeat_at=now, locked_until=now + timedelta(seconds=lease or _config()["LEASE"])
+    )
+
+
+def complete_jobs(worker_id: str, job_ids: Iterable[int]) -> int:
+    # задание возвращается в очередь; следующий срок — query.next_refresh_at
+    return RefreshJob.objects.filter(pk__in=list(job_ids), locked_by=worker_id).update(
+        status=RefreshJob.PENDING,
+        attempts=0,
+        run_after=None,
+        last_error="",
+        locked_by="",
+        locked_until=None,
+    )
+
+
+def retry_delay(attempts: int) -> float:
+    config = _config()
+    return min(config["RETRY_BASE_DELAY"] * 2 ** max(attempts - 1, 0), config["RETRY_MAX_DELAY"])
+
+
+def fail_jobs(worker_id: str, jobs: Iterable[RefreshJob], error: str) -> None:
+    now = timezone.now()
+    max_attempts = _config()["MAX_ATTEMPTS"]
+    for job in jobs:
+        # job.attempts уже учитывает текущую попытку (claim_jobs)
+        attempts = job.attempts
+        dead = attempts >= max_attempts
+        RefreshJob.objects.filter(pk=job.pk, locked_by=worker_id).update(
+            status=RefreshJob.DEAD if dead else RefreshJob.PENDING,
+            run_after=None if dead else now + timedelta(seconds=retry_delay(attempts)),
+            last_error=error[:2000],
+            locked_by="",
+            locked_until=None,
+        )
+
+
+class Heartbeat:
+    """Background thread that keeps extending the lease of jobs being processed."""
+
+    def __init__(self, worker_id: str, job_ids: List[int], lease: Optional[float] = None):
+        config = _config()
+        self.worker_id = worker_id
+        self.job_ids = job_ids
+        self.lease = lease or config["LEASE"]
+        self.interval = min(config["HEARTBEAT"], self.lease / 3)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="refresh-heartbeat", daemon=True)
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                heartbeat(self.worker_id, self.job_ids, self.lease)
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
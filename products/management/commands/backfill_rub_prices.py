@@ -0,0 +1,69 @@
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db.models import BigIntegerField, F, Value
+from django.db.models.functions import Cast, Round
+
+from products.currency import RATE_PRECISION, get_rate_service
+from products.models import Offer, OfferHistory
+
+
+class Command(BaseCommand):
+    help = (
+        "Заполняет price_rub_kop и rub_rate у Offer и OfferHistory, записанных до появления "
+        "рублёвой колонки, по курсу из ленты CurrencyRateHistory на момент записи."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            help="Сколько строк обновлять одним UPDATE (по диапазону id).",
+        )
+
+    def handle(self, *args, **options):
+        for model, time_field in ((Offer, "parsed_at"), (OfferHistory, "collected_at")):
+            updated = self._backfill(model, time_field, options["chunk_size"])
+            self.stdout.write(f"{model.__name__}: {updated} rows backfilled")
+        self.stdout.write(self.style.SUCCESS("RUB prices backfilled"))
+
+    def _segments(self, currency):
+        """(start, end, rate) intervals of the currency timeline; None means open end."""
+        service = get_rate_service()
+        index = service.index(currency)
+        if not len(index):
+            rate = service.known_rate(currency)
+            # курса пока нет нигде — строки остаются NULL до следующего запуска
+            return [(None, None, rate)] if rate is not None else []
+        bounds = [datetime.fromtimestamp(ts, tz=dt_timezone.utc) for ts in index.timestamps]
+        # до первой точки действует самый ранний курс (как в RateIndex.rate_at)
+        starts = [None] + bounds[1:]
+        ends = bounds[1:] + [None]
+        return list(zip(starts, ends, index.rates))
+
+    def _backfill(self, model, time_field, chunk_size):
+        pending = model.objects.filter(price_rub_kop__isnull=True)
+        updated = 0
+        # без order_by() в DISTINCT попали бы поля Meta.ordering — по валюте на каждую строку
+        for currency in pending.order_by().values_list("currency", flat=True).distinct():
+            for start, end, rate in self._segments(currency):
+                rate = Decimal(str(rate)).quantize(RATE_PRECISION)
+                rows = pending.filter(currency=currency)
+                if start is not None:
+                    rows = rows.filter(**{f"{time_field}__gte": start})
+                if end is not None:
+                    rows = rows.filter(**{f"{time_field}__lt": end})
+                last_id = 0
+                while True:
+                    # один UPDATE на диапазон id: пересчёт в SQL, без загрузки строк
+                    ids = list(rows.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:chunk_size])
+                    if not ids:
+                        break
+                    updated += rows.filter(id__gte=ids[0], id__lte=ids[-1]).update(
+                        price_rub_kop=Cast(Round(F("price") * Value(rate) * 100), BigIntegerField()),
+                        rub_rate=rate,
+                    )
+                    last_id = ids[-1]
+        return updated
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from products.rollups import compact_history
+
+
+class Command(BaseCommand):
+    help = (
+        "Сворачивает сырые точки OfferHistory старше срока хранения в дневные бары "
+        "OfferHistoryDaily и удаляет их."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retention-days",
+            type=int,
+            default=None,
+            help="Сколько дней хранить сырые точки (по умолчанию HISTORY_ROLLUPS['RETENTION_DAYS']).",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Сколько точек сворачивать и удалять одной транзакцией.",
+        )
+        parser.add_argument(
+            "--backfill",
+            action="store_true",
+            help="Сначала построить недостающие бары по всей истории до сегодняшнего дня, ничего не удаляя "
+            "(один раз после включения агрегатов).",
+        )
+
+    def handle(self, *args, **options):
+        if options["backfill"]:
+            stats = compact_history(0, options["chunk_size"], delete=False)
+            self.stdout.write(f"Backfilled {stats['bars']} daily bars from {stats['points']} history points")
+        stats = compact_history(options["retention_days"], options["chunk_size"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Compacted {stats['points']} history points into {stats['bars']} new daily bars"
+            )
+        )
@@ -1,55 +1,115 @@
-from django.core.management.base import BaseCommand
-from django.utils import timezone
-from decimal import Decimal
+import time
+import zlib
 
-from products.models import ProductQuery, Offer, OfferHistory
-from products.services import fetch_offers_from_marketplaces
-from products.currency import to_rub
+from django.core.management.base import BaseCommand, CommandError
+
+from parsers.cache import get_search_cache
+from products.pipeline import WriteStats
+from products.refresh import Checkpoint, SeenKeys, group_queries, iter_query_chunks, refresh_groups
+from products.services import set_parser_concurrency
 
 
 class Command(BaseCommand):
     help = "Refresh prices for all product queries (used for cron/auto-refresh)"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Сколько запросов обновлять параллельно.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=None,
+            help="Максимум одновременных обращений к маркетплейсам (по умолчанию PARSER_MAX_WORKERS).",
+        )
+        parser.add_argument(
+            "--shard",
+            default=None,
+            help="Обновить только часть запросов: i/n берёт группы запросов с crc32(ключ) %% n == i.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=20,
+            help="Сколько обновлённых групп запросов записывать в БД одной транзакцией.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Сколько запросов читать из БД за раз; после каждого куска сохраняется контрольная точка.",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Продолжить с последней контрольной точки прошлого (прерванного) запуска.",
+        )
+
     def handle(self, *args, **options):
-        queries = ProductQuery.objects.all()
-        for q in queries:
-            raw_offers = fetch_offers_from_marketplaces(
-                product_name=q.name, marketplaces=["amazon", "wildberries", "ozon"]
+        if options["concurrency"]:
+            set_parser_concurrency(options["concurrency"])
+        index, total = self._shard(options["shard"])
+        checkpoint = Checkpoint(f"refresh_prices:{index}/{total}")
+        after_id = 0
+        # ключи, уже обработанные за запуск: дубликаты из следующих кусков не парсятся заново
+        seen = SeenKeys()
+        if options["resume"]:
+            after_id = checkpoint.load() or 0
+            seen = checkpoint.load_seen()
+            if after_id:
+                self.stdout.write(f"Resuming after query id {after_id}")
+        else:
+            # журнал ключей прошлого прерванного запуска к новому не относится
+            checkpoint.clear()
+
+        started = time.monotonic()
+        totals = {"queries": 0, "groups": 0, "reused": 0, "refreshed": 0}
+        write_stats = WriteStats()
+        for chunk in iter_query_chunks(after_id=after_id, chunk_size=options["chunk_size"]):
+            # шардируем по ключу, чтобы дубликаты не попали на разные хосты
+            groups = {
+                key: group
+                for key, group in group_queries(chunk).items()
+                if zlib.crc32(key.encode("utf-8")) % total == index
+            }
+            stats = refresh_groups(
+                groups,
+                workers=options["workers"],
+                batch_size=options["batch_size"],
+                on_error=self.stderr.write,
+                write_stats=write_stats,
+                seen=seen,
             )
-            if not raw_offers:
-                continue
-            q.offers.all().delete()
-            offers_to_create = []
-            for raw in raw_offers:
-                if raw.get("price") in (None, "", 0):
-                    continue
-                marketplace = raw.get("marketplace", "amazon")
-                raw_price = float(raw.get("price", 0))
-                if marketplace == "amazon":
-                    price = raw_price
-                    currency = "USD"
-                else:
-                    price = to_rub(raw_price, raw.get("currency", "RUB"))
-                    currency = "RUB"
-                offers_to_create.append(
-                    Offer(
-                        query=q,
-                        marketplace=marketplace,
-                        title=raw.get("title", q.name),
-                        price=Decimal(str(price)) if price else 0,
-                        currency=currency,
-                        rating=raw.get("rating"),
-                        url=raw.get("url", ""),
-                        image_url=raw.get("image_url", ""),
-                    )
-                )
-            Offer.objects.bulk_create(offers_to_create)
-            for offer in offers_to_create:
-                OfferHistory.objects.create(
-                    query=q,
-                    marketplace=offer.marketplace,
-                    title=offer.title,
-                    price=offer.price,
-                    currency=offer.currency,
-                )
+            for key in totals:
+                totals[key] += stats[key]
+            checkpoint.save(chunk[-1].id, seen.drain())
+        checkpoint.clear()
+
+        cache_stats = get_search_cache().stats()
+        self.stdout.write(
+            f"Search cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+            f"(hit rate {cache_stats['hit_rate']})"
+        )
+        elapsed = time.monotonic() - started
+        rate = totals["queries"] / elapsed if elapsed else 0.0
+        self.stdout.write(
+            f"Processed {totals['queries']} queries as {totals['groups']} unique searches "
+            f"({totals['reused']} duplicate groups reused, {totals['refreshed']} queries updated) "
+            f"in {elapsed:.1f}s: {rate:.2f} queries/sec"
+        )
+        self.stdout.write(f"DB writes: {write_stats}")
         self.stdout.write(self.style.SUCCESS("Prices refreshed"))
+
+    def _shard(self, shard):
+        index, total = 0, 1
+        if shard:
+            try:
+                index, total = (int(part) for part in shard.split("/"))
+            except ValueError:
+                raise CommandError("--shard must look like i/n, e.g. 0/4")
+            if total < 1 or not 0 <= index < total:
+                raise CommandError("--shard index must be in [0, n)")
+        return index, total
@@ -0,0 +1,97 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from products.jobs import (
+    Heartbeat,
+    claim_jobs,
+    complete_jobs,
+    default_worker_id,
+    fail_jobs,
+    requeue_dead,
+    sync_jobs,
+)
+from products.refresh import group_queries, refresh_groups
+from products.scheduler import reschedule
+
+
+class Command(BaseCommand):
+    help = (
+        "Воркер очереди RefreshJob: забирает просроченные запросы с арендой и обновляет цены. "
+        "Можно запускать сколько угодно процессов на разных узлах."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--worker-id", default=None, help="Имя воркера (по умолчанию host:pid).")
+        parser.add_argument(
+            "--batch",
+            type=int,
+            default=20,
+            help="Сколько заданий захватывать за один раз.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Сколько запросов обновлять параллельно.",
+        )
+        parser.add_argument(
+            "--lease",
+            type=int,
+            default=None,
+            help="Срок аренды задания в секундах (по умолчанию REFRESH_JOBS['LEASE']).",
+        )
+        parser.add_argument(
+            "--idle-sleep",
+            type=int,
+            default=30,
+            help="Пауза, когда заданий нет.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Выйти, когда просроченных заданий не останется.",
+        )
+        parser.add_argument(
+            "--requeue-dead",
+            action="store_true",
+            help="Вернуть в очередь задания в статусе dead перед стартом.",
+        )
+
+    def handle(self, *args, **options):
+        worker_id = options["worker_id"] or default_worker_id()
+        if options["requeue_dead"]:
+            self.stdout.write(f"Requeued {requeue_dead()} dead jobs")
+        self.stdout.write(self.style.SUCCESS(f"Refresh worker {worker_id} started"))
+        while True:
+            # новые ProductQuery получают задания здесь; дубли отсекает уникальный индекс
+            sync_jobs()
+            jobs = claim_jobs(worker_id, options["batch"], options["lease"])
+            if not jobs:
+                if options["once"]:
+                    break
+                time.sleep(options["idle_sleep"])
+                continue
+            self._process(worker_id, jobs, options)
+
+    def _process(self, worker_id, jobs, options):
+        queries = [job.query for job in jobs]
+        try:
+            with Heartbeat(worker_id, [job.id for job in jobs], options["lease"]):
+                stats = refresh_groups(
+                    group_queries(queries), workers=options["workers"], on_error=self.stderr.write
+                )
+        except Exception as exc:
+            self.stderr.write(self.style.ERROR(f"Ошибка обновления: {exc}"))
+            fail_jobs(worker_id, jobs, str(exc))
+            return
+        failed = set(stats["failed"])
+        done = [job for job in jobs if job.query_id not in failed]
+        reschedule([job.query for job in done])
+        complete_jobs(worker_id, [job.id for job in done])
+        if failed:
+            fail_jobs(worker_id, [job for job in jobs if job.query_id in failed], "fetch failed")
+        self.stdout.write(
+            f"[{worker_id}] {len(done)}/{len(jobs)} jobs done in {stats['elapsed']:.1f}s; "
+            f"DB writes: {stats['write']}"
+        )
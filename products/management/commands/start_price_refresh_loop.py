@@ -1,28 +1,70 @@
 import time
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from django.core.management import call_command
+
+from products.refresh import group_queries, refresh_groups
+from products.scheduler import RefreshQueue, next_due_at, reschedule
 
 
 class Command(BaseCommand):
-    help = "Запускает цикл автообновления цен (вместо cron). Останавливайте вручную (Ctrl+C)."
+    help = (
+        "Запускает непрерывное автообновление цен по адаптивному расписанию (вместо cron). "
+        "Останавливайте вручную (Ctrl+C)."
+    )
 
     def add_arguments(self, parser):
         parser.add_argument(
             "--interval",
             type=int,
-            default=7200,
-            help="Интервал в секундах между обновлениями (по умолчанию 2 часа).",
+            default=None,
+            help="Базовый интервал обновления в секундах (по умолчанию REFRESH_SCHEDULE['BASE_INTERVAL']). "
+            "Волатильные запросы, запросы с оповещениями и недавно открытые обновляются чаще.",
+        )
+        parser.add_argument(
+            "--batch",
+            type=int,
+            default=20,
+            help="Сколько запросов брать из очереди за один проход.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Сколько запросов обновлять параллельно.",
+        )
+        parser.add_argument(
+            "--idle-sleep",
+            type=int,
+            default=60,
+            help="Максимальная пауза, когда в очереди нет просроченных запросов.",
         )
 
     def handle(self, *args, **options):
         interval = options["interval"]
-        self.stdout.write(self.style.SUCCESS(f"Старт автообновления каждые {interval} секунд"))
+        queue = RefreshQueue()
+        self.stdout.write(self.style.SUCCESS("Старт адаптивного автообновления цен"))
         while True:
+            if not len(queue):
+                queue.refill()
+            batch = queue.pop_many(options["batch"])
+            if not batch:
+                due = next_due_at()
+                pause = options["idle_sleep"]
+                if due:
+                    pause = min(pause, max((due - timezone.now()).total_seconds(), 1))
+                time.sleep(pause)
+                continue
             start = timezone.now()
-            self.stdout.write(self.style.NOTICE(f"[{start}] refresh_prices..."))
+            self.stdout.write(self.style.NOTICE(f"[{start}] refresh {len(batch)} due queries..."))
             try:
-                call_command("refresh_prices")
+                stats = refresh_groups(
+                    group_queries(batch), workers=options["workers"], on_error=self.stderr.write
+                )
+                self.stdout.write(
+                    f"Updated {stats['refreshed']}/{stats['queries']} queries in {stats['elapsed']:.1f}s; "
+                    f"DB writes: {stats['write']}"
+                )
             except Exception as exc:
-                self.stderr.write(self.style.ERROR(f"Ошибка refresh_prices: {exc}"))
-            time.sleep(interval)
+                self.stderr.write(self.style.ERROR(f"Ошибка обновления: {exc}"))
+            # следующий срок назначаем и после сбоя, чтобы запрос не крутился в цикле
+            reschedule(batch, base_interval=interval)
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_productquery_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offerhistory',
+            name='seen_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='offerhistory',
+            name='url',
+            field=models.URLField(blank=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0005_refreshjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='offer',
+            index=models.Index(fields=['query', 'marketplace', 'parsed_at'], name='products_of_query_i_98ca48_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='offerhistory',
+            index=models.Index(fields=['query', 'marketplace', 'collected_at'], name='products_of_query_i_6b0c96_idx'),
+        ),
+    ]
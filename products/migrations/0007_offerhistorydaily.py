@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0006_trend_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OfferHistoryDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('marketplace', models.CharField(max_length=32)),
+                ('day', models.DateField()),
+                ('currency', models.CharField(default='USD', max_length=10)),
+                ('open', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('high', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('low', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('close', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('total', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('first_at', models.DateTimeField()),
+                ('last_at', models.DateTimeField()),
+                ('query', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_history', to='products.productquery')),
+            ],
+            options={
+                'ordering': ['day'],
+                'constraints': [models.UniqueConstraint(fields=('query', 'marketplace', 'day'), name='uniq_daily_history')],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0007_offerhistorydaily'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='offer',
+            options={'ordering': [models.OrderBy(models.F('price_rub_kop'), nulls_last=True), 'price']},
+        ),
+        migrations.AddField(
+            model_name='offer',
+            name='price_rub_kop',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='offer',
+            name='rub_rate',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='offerhistory',
+            name='price_rub_kop',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='offerhistory',
+            name='rub_rate',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=16, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:03
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0008_rub_price'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='offer',
+            options={'ordering': ['price']},
+        ),
+    ]
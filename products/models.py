@@ -1,3 +1,5 @@
+from decimal import Decimal
+
 from django.db import models
 from django.contrib.auth import get_user_model
 
@@ -20,6 +22,10 @@ class ProductQuery(models.Model):
         help_text="Comma-separated marketplaces to query",
         default="amazon,wildberries,ozon",
     )
+    # планировщик обновлений (products.scheduler)
+    next_refresh_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_refreshed_at = models.DateTimeField(null=True, blank=True)
+    last_viewed_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self) -> str:
         return f"{self.name} ({self.category or 'без категории'})"
@@ -43,9 +49,23 @@ class Offer(models.Model):
     url = models.URLField(blank=True)
     image_url = models.URLField(blank=True)
     parsed_at = models.DateTimeField(auto_now_add=True)
+    # цена в рублях (копейки) и применённый курс; заполняются при записи (products.pipeline)
+    price_rub_kop = models.BigIntegerField(null=True, blank=True, db_index=True)
+    rub_rate = models.DecimalField(max_digits=16, decimal_places=6, null=True, blank=True)
+
+    # выдача «сначала дешёвые» сравнивает рубли, а не USD с RUB вперемешку
+    CHEAPEST_FIRST = [models.F("price_rub_kop").asc(nulls_last=True), "price"]
 
     class Meta:
         ordering = ["price"]
+        indexes = [
+            # офферы запроса по маркетплейсу и свежести (pipeline, stale_marketplaces, product_list)
+            models.Index(fields=["query", "marketplace", "parsed_at"]),
+        ]
+
+    @property
+    def price_rub(self):
+        return Decimal(self.price_rub_kop) / 100 if self.price_rub_kop is not None else None
 
     def __str__(self) -> str:
         return f"{self.title} - {self.marketplace}"
@@ -71,10 +91,83 @@ class OfferHistory(models.Model):
     title = models.CharField(max_length=255)
     price = models.DecimalField(max_digits=12, decimal_places=2)
     currency = models.CharField(max_length=10, default="USD")
+    url = models.URLField(blank=True)
     collected_at = models.DateTimeField(auto_now_add=True)
+    price_rub_kop = models.BigIntegerField(null=True, blank=True)
+    rub_rate = models.DecimalField(max_digits=16, decimal_places=6, null=True, blank=True)
+    # цена не менялась с collected_at до seen_until (см. products.pipeline)
+    seen_until = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ["-collected_at"]
+        indexes = [
+            # предыдущая цена оффера (product_list) и ряды для прогнозов
+            models.Index(fields=["query", "marketplace", "collected_at"]),
+        ]
 
     def __str__(self) -> str:
         return f"{self.title} {self.price} {self.currency} ({self.marketplace})"
+
+
+class RefreshJob(models.Model):
+    """Задание на обновление цен запроса для воркеров run_refresh_worker (products.jobs)."""
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DEAD = "dead"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DEAD, "Dead"),
+    ]
+
+    query = models.OneToOneField(
+        ProductQuery, related_name="refresh_job", on_delete=models.CASCADE
+    )
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    # не раньше этого времени (бэкофф после ошибки); срок обновления — query.next_refresh_at
+    run_after = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    locked_by = models.CharField(max_length=128, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"])]
+
+    def __str__(self) -> str:
+        return f"Refresh {self.query.name} ({self.status})"
+
+
+class OfferHistoryDaily(models.Model):
+    """Дневные OHLC-агрегаты OfferHistory (products.rollups); сырые точки старше retention удаляются."""
+
+    query = models.ForeignKey(
+        ProductQuery, related_name="daily_history", on_delete=models.CASCADE
+    )
+    marketplace = models.CharField(max_length=32)
+    day = models.DateField()
+    currency = models.CharField(max_length=10, default="USD")
+    open = models.DecimalField(max_digits=12, decimal_places=2)
+    high = models.DecimalField(max_digits=12, decimal_places=2)
+    low = models.DecimalField(max_digits=12, decimal_places=2)
+    close = models.DecimalField(max_digits=12, decimal_places=2)
+    total = models.DecimalField(max_digits=16, decimal_places=2)
+    count = models.PositiveIntegerField(default=0)
+    first_at = models.DateTimeField()
+    last_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ["day"]
+        constraints = [
+            models.UniqueConstraint(fields=["query", "marketplace", "day"], name="uniq_daily_history")
+        ]
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else self.close
+
+    def __str__(self) -> str:
+        return f"{self.query_id} {self.marketplace} {self.day}: {self.close} {self.currency}"
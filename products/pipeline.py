@@ -0,0 +1,265 @@
+"""
+Запись распарсенных офферов в БД — общая для search_results и refresh_prices.
+
+В режиме "incremental" (OFFER_REFRESH_MODE) офферы сопоставляются по
+(query, marketplace, url — или title, если url пуст) и обновляются на месте.
+Новая точка OfferHistory пишется только при смене цены или когда с последней
+точки прошло OFFER_HISTORY_HEARTBEAT секунд; иначе у последней точки
+продлевается seen_until ("цена не менялась до"), так что ряд остаётся полным.
+Режим "replace" — прежнее поведение: удалить и создать заново, история на каждый оффер.
+
+Все записи идут через bulk_create/bulk_update пачками по OFFER_WRITE_BATCH_SIZE
+внутри одной транзакции: upsert_offers — на один запрос, persist_offers — на
+пачку запросов (refresh_prices). WriteStats считает строки и rows/sec.
+Каждое наблюдение попадает и в дневные бары (products.rollups).
+"""
+
+import time
+from datetime import timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .currency import to_rub_kopecks, to_rub_many
+from .models import Offer, OfferHistory, ProductQuery
+from .rollups import record_observations
+
+DEFAULT_HEARTBEAT = 24 * 3600
+DEFAULT_BATCH_SIZE = 500
+CENT = Decimal("0.01")
+
+
+def _batch_size() -> int:
+    return getattr(settings, "OFFER_WRITE_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+
+
+class WriteStats:
+    """Counters of one or several writes; ``rows`` is every inserted/updated/deleted row."""
+
+    def __init__(self):
+        self.queries = 0
+        self.offers_created = 0
+        self.offers_updated = 0
+        self.offers_deleted = 0
+        self.history_created = 0
+        self.history_extended = 0
+        self.elapsed = 0.0
+
+    @property
+    def rows(self) -> int:
+        return (
+            self.offers_created
+            + self.offers_updated
+            + self.offers_deleted
+            + self.history_created
+            + self.history_extended
+        )
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "queries": self.queries,
+            "offers_created": self.offers_created,
+            "offers_updated": self.offers_updated,
+            "offers_deleted": self.offers_deleted,
+            "history_created": self.history_created,
+            "history_extended": self.history_extended,
+            "rows": self.rows,
+            "elapsed": self.elapsed,
+            "rows_per_sec": self.rows_per_sec,
+        }
+
+    def __str__(self) -> str:
+        return f"{self.rows} rows for {self.queries} queries in {self.elapsed:.2f}s ({self.rows_per_sec:.0f} rows/sec)"
+
+
+def prepare_offers(raw_offers: List[dict], default_title: str) -> List[dict]:
+    """Validate parser dicts and convert prices the way the site stores them."""
+    valid = [raw for raw in raw_offers if raw.get("price") not in (None, "", 0)]
+    # один пересчёт на всю пачку: курс ищется по разу на валюту
+    rub_prices = to_rub_many(
+        [float(raw.get("price", 0)) for raw in valid], [raw.get("currency", "RUB") for raw in valid]
+    )
+    items = []
+    for raw, rub_price in zip(valid, rub_prices):
+        marketplace = raw.get("marketplace", "amazon")
+        if marketplace == "amazon":
+            price = float(raw.get("price", 0))
+            currency = "USD"
+        else:
+            price = float(rub_price)
+            currency = "RUB"
+        price = Decimal(str(price)).quantize(CENT) if price else Decimal(0)
+        price_rub_kop, rub_rate = to_rub_kopecks(price, currency)
+        items.append(
+            {
+                "marketplace": marketplace,
+                "title": (raw.get("title") or default_title)[:255],
+                "price": price,
+                "currency": currency,
+                "price_rub_kop": price_rub_kop,
+                "rub_rate": rub_rate,
+                "rating": raw.get("rating"),
+                "url": raw.get("url", "") or "",
+                "image_url": raw.get("image_url", "") or "",
+            }
+        )
+    return items
+
+
+def offer_key(marketplace: str, url: str, title: str) -> Tuple[str, str]:
+    return marketplace, url or title
+
+
+def _replace(query: ProductQuery, items: List[dict], stats: WriteStats) -> List[Offer]:
+    deleted, _ = query.offers.filter(marketplace__in={item["marketplace"] for item in items}).delete()
+    offers = Offer.objects.bulk_create(
+        [Offer(query=query, **item) for item in items], batch_size=_batch_size()
+    )
+    OfferHistory.objects.bulk_create(
+        [
+            OfferHistory(
+                query=query,
+                marketplace=offer.marketplace,
+                title=offer.title,
+                price=offer.price,
+                currency=offer.currency,
+                price_rub_kop=offer.price_rub_kop,
+                rub_rate=offer.rub_rate,
+                url=offer.url,
+            )
+            for offer in offers
+        ],
+        batch_size=_batch_size(),
+    )
+    record_observations(query, items, timezone.now())
+    stats.offers_deleted += deleted
+    stats.offers_created += len(offers)
+    stats.history_created += len(offers)
+    return offers
+
+
+def upsert_offers(
+    query: ProductQuery,
+    raw_offers: List[dict],
+    default_title: str = "",
+    stats: Optional[WriteStats] = None,
+) -> List[Offer]:
+    """
+    Store ``raw_offers`` for ``query`` in one transaction. Only marketplaces
+    present in ``raw_offers`` are touched; offers of other marketplaces stay as they are.
+    """
+    stats = stats if stats is not None else WriteStats()
+    started = time.monotonic()
+    with transaction.atomic():
+        offers = _upsert(query, raw_offers, default_title, stats)
+    stats.queries += 1
+    stats.elapsed += time.monotonic() - started
+    return offers
+
+
+def persist_offers(
+    batch: Iterable[Tuple[ProductQuery, List[dict]]], stats: Optional[WriteStats] = None
+) -> WriteStats:
+    """Write offers of several queries in a single transaction (used by refresh_prices)."""
+    stats = stats if stats is not None else WriteStats()
+    started = time.monotonic()
+    with transaction.atomic():
+        for query, raw_offers in batch:
+            _upsert(query, raw_offers, "", stats)
+            stats.queries += 1
+    stats.elapsed += time.monotonic() - started
+    return stats
+
+
+def _upsert(query: ProductQuery, raw_offers: List[dict], default_title: str, stats: WriteStats) -> List[Offer]:
+    items: Dict[Tuple[str, str], dict] = {}
+    for item in prepare_offers(raw_offers, default_title or query.name):
+        items.setdefault(offer_key(item["marketplace"], item["url"], item["title"]), item)
+    if not items:
+        return []
+    if getattr(settings, "OFFER_REFRESH_MODE", "incremental") == "replace":
+        return _replace(query, list(items.values()), stats)
+
+    now = timezone.now()
+    marketplaces = {key[0] for key in items}
+    existing = {
+        offer_key(o.marketplace, o.url, o.title): o
+        for o in query.offers.filter(marketplace__in=marketplaces)
+    }
+
+    to_create, to_update = [], []
+    for key, item in items.items():
+        offer = existing.pop(key, None)
+        if offer is None:
+            to_create.append(Offer(query=query, **item))
+            continue
+        for field, value in item.items():
+            setattr(offer, field, value)
+        offer.parsed_at = now
+        to_update.append(offer)
+    # офферы, которые маркетплейс больше не отдаёт
+    if existing:
+        deleted, _ = Offer.objects.filter(pk__in=[o.pk for o in existing.values()]).delete()
+        stats.offers_deleted += deleted
+    if to_update:
+        Offer.objects.bulk_update(
+            to_update,
+            ["title", "price", "currency", "price_rub_kop", "rub_rate", "rating", "image_url", "parsed_at"],
+            batch_size=_batch_size(),
+        )
+    Offer.objects.bulk_create(to_create, batch_size=_batch_size())
+    stats.offers_updated += len(to_update)
+    stats.offers_created += len(to_create)
+
+    _append_history(query, list(items.values()), now, stats)
+    return to_update + to_create
+
+
+def _append_history(query: ProductQuery, items: List[dict], now, stats: WriteStats) -> None:
+    heartbeat = timedelta(
+        seconds=getattr(settings, "OFFER_HISTORY_HEARTBEAT", DEFAULT_HEARTBEAT)
+    )
+    # точки старше heartbeat не важны: для них всё равно пишется новая
+    recent = OfferHistory.objects.filter(
+        query=query,
+        marketplace__in={item["marketplace"] for item in items},
+        collected_at__gte=now - heartbeat,
+    ).order_by("-collected_at")
+    last_points = {}
+    for point in recent:
+        last_points.setdefault(offer_key(point.marketplace, point.url, point.title), point)
+
+    to_create, to_extend = [], []
+    for item in items:
+        last = last_points.get(offer_key(item["marketplace"], item["url"], item["title"]))
+        if last is not None and last.price == item["price"] and last.currency == item["currency"]:
+            last.seen_until = now
+            to_extend.append(last)
+            continue
+        to_create.append(
+            OfferHistory(
+                query=query,
+                marketplace=item["marketplace"],
+                title=item["title"],
+                price=item["price"],
+                currency=item["currency"],
+                price_rub_kop=item["price_rub_kop"],
+                rub_rate=item["rub_rate"],
+                url=item["url"],
+                seen_until=now,
+            )
+        )
+    if to_extend:
+        OfferHistory.objects.bulk_update(to_extend, ["seen_until"], batch_size=_batch_size())
+    OfferHistory.objects.bulk_create(to_create, batch_size=_batch_size())
+    # дневные бары считают каждое наблюдение, в том числе без смены цены
+    record_observations(query, items, now)
+    stats.history_extended += len(to_extend)
+    stats.history_created += len(to_create)
@@ -0,0 +1,249 @@
+"""
+Обновление цен для набора ProductQuery: запросы группируются по
+нормализованному названию, каждая группа парсится один раз (параллельно),
+результат раздаётся всем запросам группы и пишется в БД пачками
+через products.pipeline.
+Используется командами refresh_prices и start_price_refresh_loop.
+refresh_prices идёт по запросам кусками по id (iter_query_chunks) и после
+каждого куска сохраняет Checkpoint, чтобы после падения продолжить с места.
+Дубликаты из разных кусков не парсятся повторно: ключи, уже обработанные
+за запуск, держатся в ограниченном SeenKeys, а их офферы берутся из БД.
+Checkpoint дописывает в журнал только новые ключи каждого куска.
+"""
+
+import json
+import os
+import re
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from django.db import connections
+
+from parsers.cache import normalize_query
+from .models import Offer, ProductQuery
+from .pipeline import WriteStats, persist_offers
+from .services import fetch_offers_from_marketplaces
+
+MARKETPLACES = ["amazon", "wildberries", "ozon"]
+
+
+def group_queries(queries: Iterable[ProductQuery]) -> Dict[str, List[ProductQuery]]:
+    """Group ProductQuery rows by normalized name ("iPhone 15" == "iphone 15 ")."""
+    groups: Dict[str, List[ProductQuery]] = defaultdict(list)
+    for q in queries:
+        groups[normalize_query(q.name)].append(q)
+    return groups
+
+
+def iter_query_chunks(
+    queryset=None, after_id: int = 0, chunk_size: int = 500
+) -> Iterator[List[ProductQuery]]:
+    """
+    Yield ``queryset`` in chunks ordered by id using keyset pagination
+    (``id > last_id``), so memory stays bounded by ``chunk_size``.
+    """
+    queryset = queryset if queryset is not None else ProductQuery.objects.only("id", "name")
+    last_id = after_id
+    while True:
+        chunk = list(
+            queryset.filter(id__gt=last_id).order_by("id")[:chunk_size].iterator(chunk_size=chunk_size)
+        )
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+
+
+class SeenKeys(OrderedDict):
+    """
+    Normalized keys handled earlier in a run -> id of the query that got the
+    offers (None — fetch failed or found nothing).
+
+    Holds at most ``maxsize`` most recent keys: an evicted duplicate is simply
+    fetched again (usually a search-cache hit). Keys added since the last
+    ``drain()`` are what Checkpoint appends to its journal.
+    """
+
+    def __init__(self, maxsize: Optional[int] = None):
+        super().__init__()
+        self.maxsize = maxsize or getattr(settings, "REFRESH_SEEN_MAX_KEYS", 50_000)
+        self._new: List[Tuple[str, Optional[int]]] = []
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        self._new.append((key, value))
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+    def drain(self) -> List[Tuple[str, Optional[int]]]:
+        # ключ успешной группы пишется дважды (None, затем id) — в журнал идёт последнее значение
+        new, self._new = dict(self._new), []
+        return list(new.items())
+
+
+class Checkpoint:
+    """
+    Last processed ProductQuery id per run name, kept in a small JSON file,
+    plus an append-only journal of the run's seen keys next to it.
+    """
+
+    def __init__(self, name: str, path=None):
+        self.name = name
+        self.path = Path(path or getattr(settings, "REFRESH_CHECKPOINT_FILE", "refresh_checkpoint.json"))
+        safe_name = re.sub(r"[^\w.-]+", "_", name)
+        self.seen_path = self.path.with_name(f"{self.path.name}.{safe_name}.seen")
+
+    def _read_all(self) -> Dict[str, dict]:
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as fh:
+                return json.load(fh)
+        except Exception as exc:
+            print(f"Refresh checkpoint load error: {exc}")
+            return {}
+
+    def _write_all(self, data: Dict[str, dict]) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(data, fh)
+        os.replace(tmp_path, self.path)
+
+    def load(self) -> Optional[int]:
+        entry = self._read_all().get(self.name)
+        return entry["last_id"] if entry else None
+
+    def load_seen(self, maxsize: Optional[int] = None) -> SeenKeys:
+        """Keys already handled by the interrupted run (the most recent ``maxsize``)."""
+        seen = SeenKeys(maxsize)
+        if self.seen_path.exists():
+            with open(self.seen_path, encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        key, query_id = json.loads(line)
+                    except ValueError:
+                        # оборванная последняя строка после падения
+                        continue
+                    seen[key] = query_id
+        seen.drain()
+        return seen
+
+    def save(self, last_id: int, new_seen: Iterable[Tuple[str, Optional[int]]] = ()) -> None:
+        """Record progress; ``new_seen`` — keys handled since the previous save."""
+        # журнал дописывается раньше last_id: после падения ключи могут опережать его, но не отставать
+        lines = [json.dumps([key, query_id]) + "\n" for key, query_id in new_seen]
+        if lines:
+            with open(self.seen_path, "a", encoding="utf-8") as fh:
+                fh.writelines(lines)
+        data = self._read_all()
+        data[self.name] = {"last_id": last_id, "saved_at": time.time()}
+        self._write_all(data)
+
+    def clear(self) -> None:
+        data = self._read_all()
+        if data.pop(self.name, None) is not None:
+            self._write_all(data)
+        if self.seen_path.exists():
+            self.seen_path.unlink()
+
+
+def _fetch(q: ProductQuery) -> List[dict]:
+    try:
+        return fetch_offers_from_marketplaces(product_name=q.name, marketplaces=MARKETPLACES)
+    finally:
+        # рабочие потоки не должны держать соединения с БД
+        connections.close_all()
+
+
+def stored_offers(query_id: int) -> List[dict]:
+    """Offers already stored for a query, as parser dicts (to hand them to its duplicates)."""
+    return list(
+        Offer.objects.filter(query_id=query_id).values(
+            "marketplace", "title", "price", "currency", "rating", "url", "image_url"
+        )
+    )
+
+
+def write_batch(batch, stats: WriteStats) -> int:
+    # офферы группы раздаются всем её запросам; вся пачка — одна транзакция
+    before = stats.queries
+    persist_offers(((q, raw_offers) for group, raw_offers in batch for q in group), stats)
+    return stats.queries - before
+
+
+def refresh_groups(
+    groups: Dict[str, List[ProductQuery]],
+    workers: int = 4,
+    batch_size: int = 20,
+    on_error=print,
+    write_stats: Optional[WriteStats] = None,
+    seen: Optional[SeenKeys] = None,
+) -> Dict[str, object]:
+    """
+    Fetch every group once and write its offers to all of its queries.
+
+    ``seen`` maps keys handled earlier in the same run to the id of the query
+    that got the offers (see SeenKeys). Groups with such keys are not fetched
+    again but copy the stored offers; new keys are added to ``seen``.
+    A group with no offers at all counts as failed.
+    """
+    started = time.monotonic()
+    batch = []
+    refreshed = 0
+    failed: List[int] = []
+    write_stats = write_stats if write_stats is not None else WriteStats()
+    reused = {}
+    if seen is not None:
+        reused = {key: queries for key, queries in groups.items() if key in seen}
+        for key, queries in reused.items():
+            raw_offers = stored_offers(seen[key]) if seen[key] else []
+            if raw_offers:
+                batch.append((queries, raw_offers))
+            else:
+                failed.extend(q.id for q in queries)
+    fresh = {key: queries for key, queries in groups.items() if key not in reused}
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="refresh") as executor:
+        # один запрос к маркетплейсам на канонический ключ, а не на каждую строку ProductQuery
+        futures = {
+            executor.submit(_fetch, queries[0]): (key, queries) for key, queries in fresh.items()
+        }
+        for future in as_completed(futures):
+            key, queries = futures[future]
+            if seen is not None:
+                seen[key] = None
+            try:
+                raw_offers = future.result()
+            except Exception as exc:
+                on_error(f"{queries[0].name}: {exc}")
+                failed.extend(q.id for q in queries)
+                continue
+            if not raw_offers:
+                # все маркетплейсы упали или ничего не нашли — для очереди это неудача, а не "done"
+                on_error(f"{queries[0].name}: no offers from any marketplace")
+                failed.extend(q.id for q in queries)
+                continue
+            if seen is not None:
+                seen[key] = queries[0].id
+            batch.append((queries, raw_offers))
+            if len(batch) >= batch_size:
+                refreshed += write_batch(batch, write_stats)
+                batch = []
+    if batch:
+        refreshed += write_batch(batch, write_stats)
+    return {
+        "queries": sum(len(queries) for queries in groups.values()),
+        "groups": len(fresh),
+        # группы, чьи офферы взяты у дубликата из прошлых кусков
+        "reused": len(reused),
+        "refreshed": refreshed,
+        # id запросов, у которых упал парсинг или не пришло ни одного оффера (для повторов в products.jobs)
+        "failed": failed,
+        "elapsed": time.monotonic() - started,
+        "write": write_stats,
+    }
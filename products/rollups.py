@@ -0,0 +1,258 @@
+"""
+Дневные OHLC-агрегаты истории цен (OfferHistoryDaily).
+
+record_observations вызывается из products.pipeline при каждой записи офферов
+и обновляет бар текущего дня на месте. compact_history сворачивает сырые
+точки старше RETENTION_DAYS (если их дни ещё не свёрнуты — например, история
+до появления агрегатов) и удаляет их. price_series отдаёт ряд для прогнозов:
+сырые точки за последние RAW_DAYS дней и дневные бары до MAX_DAYS назад,
+так что объём чтения не растёт с возрастом данных. Сырая точка с seen_until —
+это серия наблюдений одной цены: expand_runs разворачивает её обратно в точки
+с шагом RUN_STEP секунд (≈ интервал обновления) и точку в seen_until, чтобы
+стабильная цена не превращалась в одну-две точки для прогнозов.
+"""
+
+from datetime import date, datetime, time as dt_time, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .currency import to_rub_at_many
+from .models import OfferHistory, OfferHistoryDaily, ProductQuery
+
+DEFAULTS = {
+    "RETENTION_DAYS": 90,
+    "RAW_DAYS": 14,
+    "MAX_DAYS": 365,
+    "RUN_STEP": 2 * 3600,
+}
+BAR_FIELDS = ["open", "high", "low", "close", "total", "count", "first_at", "last_at"]
+CENT = Decimal("0.01")
+
+
+def _config() -> Dict:
+    return {**DEFAULTS, **getattr(settings, "HISTORY_ROLLUPS", {})}
+
+
+def max_days() -> int:
+    """How far back forecasts look at history."""
+    return _config()["MAX_DAYS"]
+
+
+def run_step() -> float:
+    """Spacing (seconds) of the points a [collected_at, seen_until] run expands into."""
+    return float(_config()["RUN_STEP"])
+
+
+def expand_runs(points: List[dict], step: Optional[float] = None) -> List[dict]:
+    """
+    Chronological points with every run expanded: a point with ``seen_until``
+    later than ``collected_at`` is followed by copies every ``step`` seconds
+    and one at ``seen_until`` (the last time the same price was seen).
+    """
+    step = timedelta(seconds=step or run_step())
+    expanded = []
+    for point in points:
+        until = point.pop("seen_until", None)
+        expanded.append(point)
+        if until is None or until <= point["collected_at"]:
+            continue
+        at = point["collected_at"] + step
+        while at < until:
+            expanded.append({**point, "collected_at": at})
+            at += step
+        expanded.append({**point, "collected_at": until})
+    # серии разных маркетплейсов перекрываются
+    expanded.sort(key=lambda p: p["collected_at"])
+    return expanded
+
+
+def _day_start(day) -> datetime:
+    return timezone.make_aware(datetime.combine(day, dt_time.min))
+
+
+def _new_bar(query_id: int, marketplace: str, day, currency: str, price: Decimal, at) -> OfferHistoryDaily:
+    return OfferHistoryDaily(
+        query_id=query_id,
+        marketplace=marketplace,
+        day=day,
+        currency=currency,
+        open=price,
+        high=price,
+        low=price,
+        close=price,
+        total=Decimal(0),
+        count=0,
+        first_at=at,
+        last_at=at,
+    )
+
+
+def _add(bar: OfferHistoryDaily, price: Decimal, at) -> None:
+    if at < bar.first_at:
+        bar.open, bar.first_at = price, at
+    if at >= bar.last_at:
+        bar.close, bar.last_at = price, at
+    bar.high = max(bar.high, price)
+    bar.low = min(bar.low, price)
+    bar.total += price
+    bar.count += 1
+
+
+def _merge(bar: OfferHistoryDaily, other: OfferHistoryDaily) -> None:
+    if other.first_at < bar.first_at:
+        bar.open, bar.first_at = other.open, other.first_at
+    if other.last_at >= bar.last_at:
+        bar.close, bar.last_at = other.close, other.last_at
+    bar.high = max(bar.high, other.high)
+    bar.low = min(bar.low, other.low)
+    bar.total += other.total
+    bar.count += other.count
+
+
+def record_observations(query: ProductQuery, items: List[dict], now) -> None:
+    """Add prices observed at ``now`` to today's bars (one bar per marketplace)."""
+    day = timezone.localdate(now)
+    existing = {
+        bar.marketplace: bar
+        for bar in OfferHistoryDaily.objects.filter(
+            query=query, day=day, marketplace__in={item["marketplace"] for item in items}
+        )
+    }
+    to_create: Dict[str, OfferHistoryDaily] = {}
+    for item in items:
+        marketplace = item["marketplace"]
+        bar = existing.get(marketplace) or to_create.get(marketplace)
+        if bar is None:
+            bar = _new_bar(query.id, marketplace, day, item["currency"], item["price"], now)
+            to_create[marketplace] = bar
+        if item["currency"] != bar.currency:
+            continue
+        _add(bar, item["price"], now)
+    if existing:
+        OfferHistoryDaily.objects.bulk_update(list(existing.values()), BAR_FIELDS)
+    OfferHistoryDaily.objects.bulk_create(list(to_create.values()))
+
+
+def compact_history(
+    retention_days: Optional[int] = None, chunk_size: int = 5000, delete: bool = True
+) -> Dict[str, int]:
+    """
+    Roll up raw OfferHistory points older than ``retention_days`` and delete them.
+    Days that already have a bar were counted by record_observations and are
+    only deleted; bars created here are merged across chunks. With
+    ``delete=False`` only missing bars are built (backfill of old history).
+    """
+    retention = retention_days if retention_days is not None else _config()["RETENTION_DAYS"]
+    # режем по границе дня, чтобы не сворачивать неполный день
+    cutoff = _day_start(timezone.localdate(timezone.now() - timedelta(days=retention)))
+    created: set = set()
+    stats = {"points": 0, "bars": 0}
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            points = list(
+                OfferHistory.objects.filter(collected_at__lt=cutoff, id__gt=last_id)
+                .order_by("id")
+                .values("id", "query_id", "marketplace", "currency", "price", "collected_at")[:chunk_size]
+            )
+            if not points:
+                break
+            last_id = points[-1]["id"]
+            bars: Dict[Tuple[int, str, object], OfferHistoryDaily] = {}
+            for p in sorted(points, key=lambda p: p["collected_at"]):
+                key = (p["query_id"], p["marketplace"], timezone.localdate(p["collected_at"]))
+                bar = bars.get(key)
+                if bar is None:
+                    bar = bars[key] = _new_bar(*key, p["currency"], p["price"], p["collected_at"])
+                if p["currency"] == bar.currency:
+                    _add(bar, p["price"], p["collected_at"])
+            stored = {
+                (bar.query_id, bar.marketplace, bar.day): bar
+                for bar in OfferHistoryDaily.objects.filter(
+                    query_id__in={key[0] for key in bars},
+                    day__in={key[2] for key in bars},
+                )
+            }
+            to_create, to_update = [], []
+            for key, bar in bars.items():
+                if key not in stored:
+                    to_create.append(bar)
+                    created.add(key)
+                elif key in created:
+                    # день разрезан между пачками этого же прогона
+                    _merge(stored[key], bar)
+                    to_update.append(stored[key])
+            OfferHistoryDaily.objects.bulk_create(to_create, batch_size=500)
+            OfferHistoryDaily.objects.bulk_update(to_update, BAR_FIELDS, batch_size=500)
+            if delete:
+                OfferHistory.objects.filter(pk__in=[p["id"] for p in points]).delete()
+            stats["points"] += len(points)
+            stats["bars"] += len(to_create)
+    return stats
+
+
+def series_window(raw_days: Optional[int] = None, max_days: Optional[int] = None) -> Tuple[datetime, date]:
+    """(start of the raw points, oldest bar day) of price_series."""
+    config = _config()
+    today = timezone.localdate()
+    raw_since = _day_start(today - timedelta(days=raw_days if raw_days is not None else config["RAW_DAYS"]))
+    oldest_day = today - timedelta(days=max_days if max_days is not None else config["MAX_DAYS"])
+    return raw_since, oldest_day
+
+
+def daily_points(query_id: int, raw_since: datetime, oldest_day: date) -> List[dict]:
+    """Bars from ``oldest_day`` up to ``raw_since`` as series points (mean price of the day)."""
+    bars = list(
+        OfferHistoryDaily.objects.filter(
+            query_id=query_id, day__gte=oldest_day, day__lt=timezone.localdate(raw_since)
+        ).order_by("day", "marketplace")
+    )
+    prices = [(bar.total / bar.count).quantize(CENT) if bar.count else bar.close for bar in bars]
+    return [
+        {
+            "price": price,
+            "currency": bar.currency,
+            "rub": float(rub),
+            "marketplace": bar.marketplace,
+            "collected_at": bar.last_at,
+        }
+        for bar, price, rub in zip(
+            bars,
+            prices,
+            # курс на день бара, а не сегодняшний
+            to_rub_at_many(prices, [bar.currency for bar in bars], [bar.last_at for bar in bars]),
+        )
+    ]
+
+
+def price_series(query_id: int, raw_days: Optional[int] = None, max_days: Optional[int] = None) -> List[dict]:
+    """
+    Chronological price series: one point per marketplace and day (mean of the
+    day) older than ``raw_days``, raw OfferHistory points after that with their
+    runs expanded (expand_runs). Each point has ``rub`` — the price in RUB as
+    float (stored kopecks for raw points).
+    """
+    raw_since, oldest_day = series_window(raw_days, max_days)
+    series = daily_points(query_id, raw_since, oldest_day)
+    points = list(
+        OfferHistory.objects.filter(query_id=query_id, collected_at__gte=raw_since)
+        .order_by("collected_at")
+        .values("price", "currency", "price_rub_kop", "marketplace", "collected_at", "seen_until")
+    )
+    # строки до бэкфилла (backfill_rub_prices) пересчитываем по курсу на момент точки
+    missing = [p for p in points if p["price_rub_kop"] is None]
+    converted = to_rub_at_many(
+        [p["price"] for p in missing], [p["currency"] for p in missing], [p["collected_at"] for p in missing]
+    )
+    for point, rub in zip(missing, converted):
+        point["rub"] = float(rub)
+    for point in points:
+        kopecks = point.pop("price_rub_kop")
+        if kopecks is not None:
+            point["rub"] = kopecks / 100
+    series.extend(expand_runs(points))
+    return series
@@ -0,0 +1,150 @@
+"""
+Адаптивное расписание обновления цен.
+
+Каждому ProductQuery назначается next_refresh_at. Интервал считается от
+базового (REFRESH_SCHEDULE["BASE_INTERVAL"]) и сокращается для волатильных
+цен (по OfferHistory за последние дни), запросов с активными PriceAlert и
+недавно просмотренных; для запросов, которые давно никто не открывал,
+интервал растёт. Очередь RefreshQueue отдаёт просроченные запросы в порядке
+срока обновления.
+"""
+
+import heapq
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db.models import Avg, F, Q, StdDev
+from django.utils import timezone
+
+from .models import OfferHistory, PriceAlert, ProductQuery
+
+DEFAULTS = {
+    "MIN_INTERVAL": 15 * 60,
+    "BASE_INTERVAL": 2 * 3600,
+    "MAX_INTERVAL": 24 * 3600,
+    "VOLATILITY_WINDOW_DAYS": 7,
+}
+
+
+def _config() -> Dict:
+    return {**DEFAULTS, **getattr(settings, "REFRESH_SCHEDULE", {})}
+
+
+def volatility_by_query(query_ids: List[int], since: datetime) -> Dict[int, float]:
+    """Max coefficient of variation of price across marketplaces, per query."""
+    rows = (
+        OfferHistory.objects.filter(query_id__in=query_ids, collected_at__gte=since)
+        .values("query_id", "marketplace")
+        .annotate(avg=Avg("price"), std=StdDev("price"))
+    )
+    result: Dict[int, float] = {}
+    for row in rows:
+        if not row["avg"]:
+            continue
+        cv = float(row["std"] or 0) / float(row["avg"])
+        result[row["query_id"]] = max(result.get(row["query_id"], 0.0), cv)
+    return result
+
+
+def compute_interval(
+    volatility: float,
+    has_alert: bool,
+    last_viewed_at: Optional[datetime],
+    now: datetime,
+    base_interval: Optional[float] = None,
+) -> float:
+    config = _config()
+    interval = float(base_interval or config["BASE_INTERVAL"])
+    if volatility >= 0.05:
+        interval *= 0.25
+    elif volatility >= 0.01:
+        interval *= 0.5
+    elif volatility < 0.002:
+        interval *= 2
+    if has_alert:
+        interval *= 0.5
+    if last_viewed_at is None or now - last_viewed_at > timedelta(days=30):
+        interval *= 4
+    elif now - last_viewed_at < timedelta(days=1):
+        interval *= 0.5
+    return min(max(interval, config["MIN_INTERVAL"]), config["MAX_INTERVAL"])
+
+
+def reschedule(
+    queries: Iterable[ProductQuery], base_interval: Optional[float] = None, refreshed: bool = True
+) -> None:
+    """Set next_refresh_at for ``queries`` (and last_refreshed_at if they were just refreshed)."""
+    queries = list(queries)
+    if not queries:
+        return
+    now = timezone.now()
+    ids = [q.id for q in queries]
+    window = timedelta(days=_config()["VOLATILITY_WINDOW_DAYS"])
+    volatility = volatility_by_query(ids, now - window)
+    with_alerts = set(
+        PriceAlert.objects.filter(query_id__in=ids, is_active=True).values_list("query_id", flat=True)
+    )
+    for q in queries:
+        interval = compute_interval(
+            volatility.get(q.id, 0.0),
+            q.id in with_alerts,
+            q.last_viewed_at or q.created_at,
+            now,
+            base_interval,
+        )
+        q.next_refresh_at = now + timedelta(seconds=interval)
+        if refreshed:
+            q.last_refreshed_at = now
+    fields = ["next_refresh_at", "last_refreshed_at"] if refreshed else ["next_refresh_at"]
+    ProductQuery.objects.bulk_update(queries, fields, batch_size=500)
+
+
+def due_queries(now: Optional[datetime] = None):
+    now = now or timezone.now()
+    return ProductQuery.objects.filter(
+        Q(next_refresh_at__isnull=True) | Q(next_refresh_at__lte=now)
+    ).order_by(F("next_refresh_at").asc(nulls_first=True), "id")
+
+
+def next_due_at() -> Optional[datetime]:
+    return (
+        ProductQuery.objects.filter(next_refresh_at__isnull=False)
+        .order_by("next_refresh_at")
+        .values_list("next_refresh_at", flat=True)
+        .first()
+    )
+
+
+class RefreshQueue:
+    """
+    In-memory priority queue of due queries, refilled from the DB. Earlier
+    next_refresh_at goes first; never-scheduled queries go before everything.
+    """
+
+    def __init__(self, prefetch: int = 500):
+        self.prefetch = prefetch
+        self._heap: List[tuple] = []
+        self._queued: set = set()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def refill(self) -> int:
+        added = 0
+        for q in due_queries()[: self.prefetch]:
+            if q.id in self._queued:
+                continue
+            due = q.next_refresh_at.timestamp() if q.next_refresh_at else 0.0
+            heapq.heappush(self._heap, (due, q.id, q))
+            self._queued.add(q.id)
+            added += 1
+        return added
+
+    def pop_many(self, limit: int) -> List[ProductQuery]:
+        items = []
+        while self._heap and len(items) < limit:
+            _, query_id, q = heapq.heappop(self._heap)
+            self._queued.discard(query_id)
+            items.append(q)
+        return items
@@ -1,10 +1,21 @@
 from __future__ import annotations
 
-from typing import Dict, List
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, List, Optional
 
 from random import randint
 
+from django.conf import settings
+from django.db import connections
+from django.db.models import Max
+from django.utils import timezone
+
 from parsers.amazon_parser import AmazonParser
+from parsers.cache import CachedParser, get_search_cache
+from parsers.circuit import OPEN, get_breaker
 from parsers.wildberries_parser import WildberriesParser
 from parsers.ozon_parser import OzonParser
 
@@ -15,21 +26,276 @@ PARSER_REGISTRY = {
     "ozon": OzonParser,
 }
 
+# Дедлайны по умолчанию (секунды); переопределяются MARKETPLACE_TIMEOUTS / MARKETPLACE_TOTAL_TIMEOUT
+DEFAULT_MARKETPLACE_TIMEOUT = 20.0
+DEFAULT_TOTAL_TIMEOUT = 30.0
+
+# Парсеры синхронные (requests), поэтому event loop запускает их в общем пуле потоков.
+# Пул не является default executor, так что asyncio.run не ждёт зависшие запросы после дедлайна.
+_EXECUTOR = ThreadPoolExecutor(
+    max_workers=getattr(settings, "PARSER_MAX_WORKERS", 16), thread_name_prefix="parser"
+)
+
+
+def set_parser_concurrency(max_workers: int) -> None:
+    """Resize the parser thread pool, i.e. the cap on upstream calls in flight."""
+    global _EXECUTOR
+    previous, _EXECUTOR = _EXECUTOR, ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="parser"
+    )
+    previous.shutdown(wait=False)
+
+
+_parsers: Dict[str, object] = {}
+_parsers_lock = threading.Lock()
+
+
+def get_parser(marketplace: str):
+    """
+    Экземпляры парсеров живут весь процесс: они используют общий HTTP-пул
+    и общий ProxyPool, поэтому создавать их на каждый запрос незачем.
+    Если включён PARSER_CACHE, парсер обёрнут в read-through кэш поиска.
+    """
+    parser = _parsers.get(marketplace)
+    if parser is None:
+        with _parsers_lock:
+            parser = _parsers.get(marketplace)
+            if parser is None:
+                parser = PARSER_REGISTRY[marketplace]()
+                if getattr(settings, "PARSER_CACHE", {}).get("ENABLED", True):
+                    parser = CachedParser(parser, marketplace, get_search_cache())
+                _parsers[marketplace] = parser
+    return parser
+
+
+def _marketplace_timeout(marketplace: str, timeouts: Optional[Dict[str, float]]) -> float:
+    configured = {
+        **getattr(settings, "MARKETPLACE_TIMEOUTS", {}),
+        **(timeouts or {}),
+    }
+    return float(configured.get(marketplace, DEFAULT_MARKETPLACE_TIMEOUT))
+
+
+def _marketplace_result(marketplace: str, status: str, offers=None, elapsed: float = 0.0) -> Dict:
+    return {
+        "marketplace": marketplace,
+        "offers": offers or [],
+        "status": status,
+        "elapsed": round(elapsed, 3),
+        # время и попытки внутри парсера (бюджет RetryPolicy)
+        "upstream_elapsed": getattr(offers, "elapsed", None),
+        "attempts": getattr(offers, "attempts", None),
+        "cached": getattr(offers, "cached", False),
+    }
+
+
+async def _fetch_marketplace(
+    marketplace: str, product_name: str, timeout: float
+) -> Dict:
+    parser = get_parser(marketplace)
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    # ответ из кэша поиска не зависит от состояния маркетплейса: отдаём его и при открытом breaker
+    lookup = getattr(parser, "lookup", None)
+    if lookup is not None:
+        cached = await loop.run_in_executor(_EXECUTOR, lookup, product_name)
+        if cached is not None:
+            return _marketplace_result(marketplace, "ok", cached, time.monotonic() - started)
+    breaker = get_breaker(marketplace)
+    if not breaker.allow_request():
+        # маркетплейс недавно стабильно падал — не тратим на него время
+        return _marketplace_result(marketplace, "degraded")
+    fetch = getattr(parser, "fetch", parser.search_product)
+    try:
+        offers = await asyncio.wait_for(
+            loop.run_in_executor(_EXECUTOR, fetch, product_name),
+            timeout=timeout,
+        )
+        # парсеры глушат исключения и помечают сбой в SearchResult.error
+        status = "error" if getattr(offers, "error", "") else "ok"
+    except asyncio.TimeoutError:
+        print(f"{marketplace} parser timed out after {timeout}s")
+        offers, status = [], "timeout"
+    except Exception as exc:
+        print(f"{marketplace} parser failed: {exc}")
+        offers, status = [], "error"
+    # breaker считает только настоящие обращения к маркетплейсу, не попадания в кэш;
+    # пустой ответ без ошибки — честное «ничего не найдено», а не сбой
+    if not getattr(offers, "cached", False):
+        if status == "ok":
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+    return _marketplace_result(marketplace, status, offers, time.monotonic() - started)
+
+
+async def iter_marketplace_results(
+    product_name: str,
+    marketplaces: List[str],
+    timeouts: Optional[Dict[str, float]] = None,
+    total_timeout: Optional[float] = None,
+) -> AsyncIterator[Dict]:
+    """
+    Опрашивает все маркетплейсы одновременно и отдаёт результат каждого по мере
+    готовности. У каждого маркетплейса свой дедлайн, у всего вызова — общий;
+    не уложившиеся в общий дедлайн отдаются в конце со статусом "timeout" и сбоем
+    для circuit breaker не считаются.
+    Маркетплейсы с открытым circuit breaker пропускаются сразу (status "degraded"),
+    если ответа нет в кэше поиска.
+    Результат: {"marketplace", "offers", "status", "elapsed", "upstream_elapsed",
+    "attempts", "cached"}.
+    """
+    if total_timeout is None:
+        total_timeout = getattr(settings, "MARKETPLACE_TOTAL_TIMEOUT", DEFAULT_TOTAL_TIMEOUT)
+    started = time.monotonic()
+    deadline = started + total_timeout
+    tasks = {
+        asyncio.create_task(
+            _fetch_marketplace(
+                marketplace, product_name, _marketplace_timeout(marketplace, timeouts)
+            )
+        ): marketplace
+        for marketplace in dict.fromkeys(marketplaces)
+        if marketplace in PARSER_REGISTRY
+    }
+    pending = set(tasks)
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(
+                pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+        missed, pending = pending, set()
+        for task in missed:
+            task.cancel()
+            marketplace = tasks[task]
+            # общий дедлайн задаёт вызывающий (например, OFFER_COLD_DEADLINE короче бюджета
+            # повторов Ozon): медленный, но живой маркетплейс не должен открывать breaker
+            print(f"{marketplace} parser missed the global deadline ({total_timeout}s)")
+            yield _marketplace_result(marketplace, "timeout", elapsed=time.monotonic() - started)
+    finally:
+        # потребитель закрыл генератор раньше времени
+        for task in pending:
+            task.cancel()
+
+
+async def fetch_marketplace_results(
+    product_name: str,
+    marketplaces: List[str],
+    timeouts: Optional[Dict[str, float]] = None,
+    total_timeout: Optional[float] = None,
+) -> Dict[str, Dict]:
+    """Same as iter_marketplace_results, collected into marketplace -> result."""
+    results = {
+        result["marketplace"]: result
+        async for result in iter_marketplace_results(
+            product_name, marketplaces, timeouts, total_timeout
+        )
+    }
+    return {m: results[m] for m in dict.fromkeys(marketplaces) if m in results}
+
+
+def run_sync(coro):
+    """
+    Выполняет корутину из синхронного кода. Если в текущем потоке уже крутится
+    event loop (async-представление), запускаем её в отдельном потоке.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    box: Dict[str, object] = {}
+
+    def runner():
+        try:
+            box["result"] = asyncio.run(coro)
+        except BaseException as exc:
+            box["error"] = exc
+
+    thread = threading.Thread(target=runner, name="fetch-offers")
+    thread.start()
+    thread.join()
+    if "error" in box:
+        raise box["error"]
+    return box["result"]
+
+
+def fetch_marketplace_report(
+    product_name: str,
+    marketplaces: List[str],
+    timeouts: Optional[Dict[str, float]] = None,
+    total_timeout: Optional[float] = None,
+) -> Dict[str, Dict]:
+    return run_sync(
+        fetch_marketplace_results(product_name, marketplaces, timeouts, total_timeout)
+    )
+
 
 def fetch_offers_from_marketplaces(
-    product_name: str, marketplaces: List[str]
+    product_name: str,
+    marketplaces: List[str],
+    timeouts: Optional[Dict[str, float]] = None,
+    total_timeout: Optional[float] = None,
 ) -> List[Dict]:
+    results = fetch_marketplace_report(product_name, marketplaces, timeouts, total_timeout)
     offers: List[Dict] = []
-    for marketplace in marketplaces:
-        parser_cls = PARSER_REGISTRY.get(marketplace)
-        if not parser_cls:
-            continue
-        parser = parser_cls()
+    for result in results.values():
+        offers.extend(result["offers"])
+    return offers
+
+
+DEFAULT_OFFER_TTL = 3600
+
+_BACKGROUND = ThreadPoolExecutor(
+    max_workers=getattr(settings, "OFFER_BACKGROUND_WORKERS", 4),
+    thread_name_prefix="offers-refresh",
+)
+
+
+def offer_ttl(marketplace: str) -> float:
+    ttls = getattr(settings, "OFFER_FRESHNESS_TTL", {})
+    return float(ttls.get(marketplace, ttls.get("default", DEFAULT_OFFER_TTL)))
+
+
+def stale_marketplaces(query, marketplaces: List[str]) -> List[str]:
+    """Marketplaces whose newest stored offer for ``query`` is older than its TTL (or missing)."""
+    latest = dict(
+        query.offers.values_list("marketplace").annotate(latest=Max("parsed_at"))
+    )
+    now = timezone.now()
+    return [
+        marketplace
+        for marketplace in marketplaces
+        if marketplace not in latest
+        or (now - latest[marketplace]).total_seconds() > offer_ttl(marketplace)
+    ]
+
+
+def open_breakers(marketplaces: List[str]) -> List[str]:
+    return [m for m in marketplaces if get_breaker(m).state == OPEN]
+
+
+def run_in_background(fn, *args) -> None:
+    """
+    Фоновое обновление (stale-while-revalidate). У потока своё соединение с БД,
+    поэтому закрываем его по завершении задачи.
+    """
+    if not getattr(settings, "OFFER_BACKGROUND_REFRESH", True):
+        return
+
+    def task():
         try:
-            offers.extend(parser.search_product(product_name))
+            fn(*args)
         except Exception as exc:
-            print(f"{marketplace} parser failed: {exc}")
-    return offers
+            print(f"Background refresh failed: {exc}")
+        finally:
+            connections.close_all()
+
+    _BACKGROUND.submit(task)
 
 
 def generate_demo_offers(product_name: str) -> List[Dict]:
@@ -0,0 +1,113 @@
+"""
+Single-flight: одинаковые одновременные операции выполняются один раз.
+
+Внутри процесса первый вызов с данным ключом становится лидером, остальные
+ждут его результата на threading.Event. Между процессами лидер держит
+блокировку в общем кэше (cache.add атомарен), а ведомые опрашивают её и
+забирают опубликованный результат. Результат должен быть picklable и небольшим
+(например, id записей), потому что он проходит через кэш.
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    def __init__(
+        self,
+        cache_alias: Optional[str] = None,
+        lock_timeout: float = 60,
+        wait_timeout: float = 45,
+        poll_interval: float = 0.2,
+        result_ttl: float = 30,
+    ):
+        config = getattr(settings, "SINGLE_FLIGHT", {})
+        self.cache_alias = cache_alias or config.get("CACHE_ALIAS", "default")
+        self.lock_timeout = config.get("LOCK_TIMEOUT", lock_timeout)
+        self.wait_timeout = config.get("WAIT_TIMEOUT", wait_timeout)
+        self.poll_interval = config.get("POLL_INTERVAL", poll_interval)
+        self.result_ttl = config.get("RESULT_TTL", result_ttl)
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def _cache(self):
+        return caches[self.cache_alias]
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if not leader:
+            if not call.event.wait(self.wait_timeout):
+                return fn()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._do_shared(key, fn)
+            return call.result
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            call.event.set()
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def _do_shared(self, key: str, fn: Callable[[], Any]) -> Any:
+        digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+        lock_key = f"singleflight:lock:{digest}"
+        result_key = f"singleflight:result:{digest}"
+        cache = self._cache
+        token = uuid.uuid4().hex
+        if cache.add(lock_key, token, timeout=self.lock_timeout):
+            cache.delete(result_key)
+            try:
+                result = fn()
+                cache.set(result_key, result, timeout=self.result_ttl)
+                return result
+            finally:
+                if cache.get(lock_key) == token:
+                    cache.delete(lock_key)
+
+        # тот же ключ уже обрабатывает другой процесс — ждём его результата
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            if cache.get(lock_key) is None:
+                result = cache.get(result_key)
+                if result is not None:
+                    return result
+                break
+        # лидер упал или не уложился — выполняем сами
+        return fn()
+
+
+_single_flight: Optional[SingleFlight] = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight()
+    return _single_flight
@@ -1,3 +1,1458 @@
-from django.test import TestCase
-
-# Create your tests here.
+"""
+Тесты products: бюджеты SQL-запросов и латентности для вьюх (ViewBudgetTests)
+и модульные тесты опроса маркетплейсов, записи офферов и обновления цен.
+
+Бюджеты SQL-запросов и латентности для вьюх.
+
+Данные сидятся пачками (bulk_create), парсеры заменены заглушками, так что
+сеть не нужна. Объём задаётся переменной PERF_SCALE: 1 (по умолчанию, CI) —
+сотни запросов и десятки тысяч строк истории; PERF_SCALE=50 — тысячи
+запросов и около миллиона строк истории.
+
+Каждая вьюха проверяется на число SQL-запросов (QUERY_BUDGETS, не зависит от
+объёма данных) и на p95 латентности относительно perf_baseline.json:
+тест падает, если p95 вырос больше чем в (1 + PERF_TOLERANCE) раз плюс
+PERF_SLACK_MS. PERF_UPDATE_BASELINE=1 перезаписывает базовую линию
+текущими p50/p95.
+
+    python manage.py test products
+    PERF_SCALE=50 PERF_UPDATE_BASELINE=1 python manage.py test products
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from pathlib import Path
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from analysis.models import CurrencyRate, CurrencyRateHistory
+from parsers.cache import CachedParser, MemoryBackend, SearchCache
+from parsers.circuit import OPEN, get_breaker
+from parsers.retry import SearchResult
+from products import currency, jobs, pipeline, refresh, rollups, scheduler, services
+from products.management.commands import backfill_rub_prices
+from products.singleflight import SingleFlight
+from products.currency import get_rate, rate_at
+from products.models import (
+    Offer,
+    OfferHistory,
+    OfferHistoryDaily,
+    PriceAlert,
+    ProductQuery,
+    RefreshJob,
+)
+
+PERF_SCALE = float(os.environ.get("PERF_SCALE", "1"))
+PERF_TOLERANCE = float(os.environ.get("PERF_TOLERANCE", "1.0"))
+PERF_SLACK_MS = float(os.environ.get("PERF_SLACK_MS", "25"))
+PERF_ITERATIONS = int(os.environ.get("PERF_ITERATIONS", "15"))
+PERF_UPDATE_BASELINE = os.environ.get("PERF_UPDATE_BASELINE") == "1"
+BASELINE_FILE = Path(__file__).with_name("perf_baseline.json")
+
+MARKETPLACES = ["amazon", "wildberries", "ozon"]
+USER_QUERIES = max(int(100 * PERF_SCALE), 60)
+OTHER_QUERIES = int(20 * PERF_SCALE)
+HISTORY_PER_OFFER = 60
+
+# максимум SQL-запросов на один вызов вьюхи; не должен расти вместе с данными
+QUERY_BUDGETS = {
+    "home_view": 4,
+    "product_list": 3,
+    "profile_view": 4,
+    "search_results": 11,
+    "search_results_cold": 23,
+    "create_price_alert": 4,
+}
+
+_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "perf-default"},
+    "shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "perf-shared"},
+}
+
+
+class StubParser:
+    """Parser stand-in: deterministic offers, no network."""
+
+    def __init__(self, marketplace):
+        self.marketplace = marketplace
+
+    def search_product(self, product_name):
+        currency = "USD" if self.marketplace == "amazon" else "RUB"
+        base = 20 if currency == "USD" else 1500
+        return SearchResult(
+            [
+                {
+                    "title": f"{product_name} {i}",
+                    "price": base + i,
+                    "currency": currency,
+                    "rating": 4.5,
+                    "marketplace": self.marketplace,
+                    "url": f"https://{self.marketplace}.example/{product_name}/{i}",
+                }
+                for i in range(5)
+            ]
+        )
+
+
+def _base_price(n, marketplace):
+    return 20 + n % 50 if marketplace == "amazon" else 1500 + n % 700
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+@override_settings(
+    CACHES=_CACHES,
+    OFFER_BACKGROUND_REFRESH=False,
+    SEARCH_STREAMING=False,
+    PARSER_CACHE={"ENABLED": False},
+)
+class ViewBudgetTests(TestCase):
+    results = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        cls.user = User.objects.create_user(username="perf", password="perf-pass")
+        other = User.objects.create_user(username="other", password="perf-pass")
+        CurrencyRate.objects.create(code="USD", rate=Decimal("90"))
+        now = timezone.now()
+        queries = ProductQuery.objects.bulk_create(
+            [
+                ProductQuery(
+                    name=f"product {i}",
+                    category="electronics",
+                    created_by=cls.user if i < USER_QUERIES else other,
+                    next_refresh_at=now + timedelta(hours=1),
+                )
+                for i in range(USER_QUERIES + OTHER_QUERIES)
+            ],
+            batch_size=1000,
+        )
+        offers = []
+        for n, q in enumerate(queries):
+            for marketplace in MARKETPLACES:
+                offers.append(
+                    Offer(
+                        query=q,
+                        marketplace=marketplace,
+                        title=q.name,
+                        price=_base_price(n, marketplace),
+                        currency="USD" if marketplace == "amazon" else "RUB",
+                        url=f"https://{marketplace}.example/{q.id}",
+                    )
+                )
+        Offer.objects.bulk_create(offers, batch_size=5000)
+        # по точке в день на каждый оффер; collected_at — auto_now_add, поэтому подменяем now
+        for day in range(HISTORY_PER_OFFER, 0, -1):
+            history = [
+                OfferHistory(
+                    query=offer.query,
+                    marketplace=offer.marketplace,
+                    title=offer.title,
+                    price=offer.price + (day * 7) % 11,
+                    currency=offer.currency,
+                    url=offer.url,
+                )
+                for offer in offers
+            ]
+            with mock.patch("django.utils.timezone.now", return_value=now - timedelta(days=day)):
+                OfferHistory.objects.bulk_create(history, batch_size=5000)
+        cls.query = queries[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if PERF_UPDATE_BASELINE and cls.results:
+            baseline = cls._load_baseline()
+            baseline.update(cls.results)
+            with open(BASELINE_FILE, "w", encoding="utf-8") as fh:
+                json.dump(baseline, fh, indent=2, sort_keys=True)
+                fh.write("\n")
+
+    @staticmethod
+    def _load_baseline():
+        if not BASELINE_FILE.exists():
+            return {}
+        with open(BASELINE_FILE, encoding="utf-8") as fh:
+            return json.load(fh)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        # курс и лента курсов кэшируются в процессе; прогреваем, чтобы не считать эти запросы
+        get_rate("USD")
+        rate_at("USD", timezone.now())
+        patcher = mock.patch("products.services.get_parser", side_effect=StubParser)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _measure(self, name, request):
+        """Check the query budget of one call, then time PERF_ITERATIONS calls."""
+        with CaptureQueriesContext(connection) as ctx:
+            response = request()
+        # следующий запрос клиента очищает connection.queries, поэтому копируем сразу
+        captured = list(ctx.captured_queries)
+        self.assertLess(response.status_code, 400)
+        self.assertLessEqual(
+            len(captured),
+            QUERY_BUDGETS[name],
+            f"{name}: {len(captured)} queries, budget {QUERY_BUDGETS[name]}\n"
+            + "\n".join(q["sql"] for q in captured),
+        )
+
+        samples = []
+        for _ in range(PERF_ITERATIONS):
+            started = time.perf_counter()
+            request()
+            samples.append((time.perf_counter() - started) * 1000)
+        result = {
+            "queries": len(captured),
+            "p50_ms": round(statistics.median(samples), 2),
+            "p95_ms": round(_percentile(samples, 95), 2),
+            "scale": PERF_SCALE,
+        }
+        type(self).results[name] = result
+
+        baseline = self._load_baseline().get(name)
+        if PERF_UPDATE_BASELINE or not baseline or baseline.get("scale") != PERF_SCALE:
+            return
+        limit = baseline["p95_ms"] * (1 + PERF_TOLERANCE) + PERF_SLACK_MS
+        self.assertLessEqual(
+            result["p95_ms"],
+            limit,
+            f"{name}: p95 {result['p95_ms']}ms, baseline {baseline['p95_ms']}ms (limit {limit:.1f}ms)",
+        )
+
+    def test_home_view(self):
+        self._measure("home_view", lambda: self.client.get(reverse("home")))
+
+    def test_product_list(self):
+        self._measure("product_list", lambda: self.client.get(reverse("product_list")))
+
+    def test_profile_view(self):
+        self._measure("profile_view", lambda: self.client.get(reverse("profile")))
+
+    def test_search_results(self):
+        # свежие офферы: ответ из БД, без обращения к парсерам
+        url = reverse("search_results") + f"?q={self.query.name}&category=electronics"
+        self._measure("search_results", lambda: self.client.get(url))
+
+    def test_search_results_cold(self):
+        # новый запрос каждый раз: парсинг заглушками и запись офферов/истории
+        counter = iter(range(10**6))
+        self._measure(
+            "search_results_cold",
+            lambda: self.client.get(
+                reverse("search_results") + f"?q=new+item+{next(counter)}&category=electronics"
+            ),
+        )
+
+    def test_create_price_alert(self):
+        self._measure(
+            "create_price_alert",
+            lambda: self.client.post(
+                reverse("create_price_alert"),
+                {"query_id": self.query.id, "target_price": "1000"},
+            ),
+        )
+        self.assertTrue(PriceAlert.objects.filter(query=self.query).exists())
+
+
+class SleepyParser:
+    """Parser stand-in that answers after ``delay`` seconds."""
+
+    def __init__(self, marketplace, delay=0.0, offers=None, error=None, failure=""):
+        self.marketplace = marketplace
+        self.delay = delay
+        self.offers = offers if offers is not None else [{"title": marketplace, "price": 1, "marketplace": marketplace}]
+        self.error = error
+        self.failure = failure
+        self.calls = 0
+
+    def search_product(self, product_name):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        if self.failure:
+            return SearchResult([], elapsed=self.delay, attempts=1, error=self.failure)
+        return SearchResult(list(self.offers), elapsed=self.delay, attempts=1)
+
+
+@override_settings(CACHES=_CACHES)
+class MarketplaceFanOutTests(SimpleTestCase):
+    def setUp(self):
+        caches["shared"].clear()
+        self.parsers = {}
+
+    def _use(self, **parsers):
+        self.parsers = parsers
+        patcher = mock.patch("products.services.get_parser", side_effect=lambda m: self.parsers[m])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_marketplaces_are_polled_concurrently(self):
+        self._use(**{m: SleepyParser(m, delay=0.3) for m in MARKETPLACES})
+        started = time.monotonic()
+        report = services.fetch_marketplace_report("phone", MARKETPLACES, total_timeout=5)
+        self.assertLess(time.monotonic() - started, 0.8)
+        self.assertEqual(list(report), MARKETPLACES)
+        self.assertEqual({r["status"] for r in report.values()}, {"ok"})
+
+    def test_per_marketplace_deadline(self):
+        self._use(
+            amazon=SleepyParser("amazon"),
+            wildberries=SleepyParser("wildberries"),
+            ozon=SleepyParser("ozon", delay=1.0),
+        )
+        report = services.fetch_marketplace_report(
+            "phone", MARKETPLACES, timeouts={"ozon": 0.2}, total_timeout=5
+        )
+        self.assertEqual(report["ozon"]["status"], "timeout")
+        self.assertEqual(report["ozon"]["offers"], [])
+        self.assertEqual(report["amazon"]["status"], "ok")
+        self.assertEqual(len(report["wildberries"]["offers"]), 1)
+
+    def test_results_arrive_in_completion_order(self):
+        self._use(
+            amazon=SleepyParser("amazon", delay=0.4),
+            wildberries=SleepyParser("wildberries"),
+            ozon=SleepyParser("ozon", delay=0.2),
+        )
+
+        async def collect():
+            return [r["marketplace"] async for r in services.iter_marketplace_results("phone", MARKETPLACES)]
+
+        self.assertEqual(services.run_sync(collect()), ["wildberries", "ozon", "amazon"])
+
+    def test_global_deadline_miss_does_not_trip_breaker(self):
+        self._use(ozon=SleepyParser("ozon", delay=0.5))
+        for _ in range(6):
+            report = services.fetch_marketplace_report("phone", ["ozon"], total_timeout=0.05)
+            self.assertEqual(report["ozon"]["status"], "timeout")
+        self.assertEqual(get_breaker("ozon")._load()["failures"], 0)
+
+    def test_parser_exception_is_reported(self):
+        self._use(amazon=SleepyParser("amazon", error=RuntimeError("boom")))
+        report = services.fetch_marketplace_report("phone", ["amazon", "unknown"], total_timeout=5)
+        self.assertEqual(list(report), ["amazon"])
+        self.assertEqual(report["amazon"]["status"], "error")
+
+
+class ParserRegistryTests(SimpleTestCase):
+    def setUp(self):
+        services._parsers.clear()
+        self.addCleanup(services._parsers.clear)
+        # конструктор без аргументов, как у настоящих парсеров
+        registry = {"amazon": lambda: StubParser("amazon")}
+        patcher = mock.patch.dict(services.PARSER_REGISTRY, registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(PARSER_CACHE={"ENABLED": False})
+    def test_parser_instance_is_reused(self):
+        parser = services.get_parser("amazon")
+        self.assertIsInstance(parser, StubParser)
+        self.assertIs(services.get_parser("amazon"), parser)
+
+    @override_settings(PARSER_CACHE={"ENABLED": True})
+    def test_parser_is_wrapped_in_cache(self):
+        parser = services.get_parser("amazon")
+        self.assertIsInstance(parser, CachedParser)
+        self.assertEqual(parser.marketplace, "amazon")
+
+
+@override_settings(
+    CACHES=_CACHES,
+    CIRCUIT_BREAKER={"FAILURE_THRESHOLD": 2, "RECOVERY_TIMEOUT": 60, "CACHE_ALIAS": "shared"},
+)
+class BreakerAndCacheTests(SimpleTestCase):
+    def setUp(self):
+        caches["shared"].clear()
+        self.upstream = SleepyParser("ozon")
+        self.parser = CachedParser(self.upstream, "ozon", SearchCache(backend=MemoryBackend()))
+        patcher = mock.patch("products.services.get_parser", return_value=self.parser)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _fetch(self, query="phone"):
+        return services.fetch_marketplace_report(query, ["ozon"], total_timeout=5)["ozon"]
+
+    def test_open_breaker_still_serves_cached_results(self):
+        self._fetch()
+        for _ in range(2):
+            get_breaker("ozon").record_failure()
+        self.assertEqual(get_breaker("ozon").state, OPEN)
+        result = self._fetch()
+        self.assertEqual(result["status"], "ok")
+        self.assertTrue(result["cached"])
+        self.assertEqual(len(result["offers"]), 1)
+        self.assertEqual(self.upstream.calls, 1)
+        # без кэша маркетплейс с открытым breaker пропускается
+        self.assertEqual(self._fetch("other")["status"], "degraded")
+        self.assertEqual(self.upstream.calls, 1)
+
+    def test_cache_hits_do_not_reset_failures(self):
+        self._fetch()
+        get_breaker("ozon").record_failure()
+        self._fetch()
+        self.assertEqual(get_breaker("ozon")._load()["failures"], 1)
+
+    def test_upstream_failures_drive_the_breaker(self):
+        self.upstream.failure = "blocked"
+        self.assertEqual(self._fetch("a")["status"], "error")
+        self._fetch("b")
+        self.assertEqual(get_breaker("ozon").state, OPEN)
+
+    def test_empty_answer_is_not_a_failure(self):
+        get_breaker("ozon").record_failure()
+        self.upstream.offers = []
+        for query in ("a", "b", "c"):
+            result = self._fetch(query)
+            self.assertEqual(result["status"], "ok")
+            self.assertEqual(result["offers"], [])
+        self.assertEqual(get_breaker("ozon")._load()["failures"], 0)
+
+    def test_upstream_success_resets_failures(self):
+        get_breaker("ozon").record_failure()
+        self._fetch()
+        self.assertEqual(get_breaker("ozon")._load()["failures"], 0)
+
+
+@override_settings(CACHES=_CACHES, SINGLE_FLIGHT={"CACHE_ALIAS": "shared", "POLL_INTERVAL": 0.02})
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        caches["shared"].clear()
+
+    def _concurrently(self, flight, key, fn, n=8):
+        results, errors = [], []
+
+        def call():
+            try:
+                results.append(flight.do(key, fn))
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=call) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results, errors
+
+    def test_identical_calls_run_once(self):
+        calls = []
+
+        def work():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"query_id": 7}
+
+        results, errors = self._concurrently(SingleFlight(), "search:phone", work)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"query_id": 7}] * 8)
+        self.assertEqual(errors, [])
+
+    def test_leader_error_reaches_followers(self):
+        def work():
+            time.sleep(0.1)
+            raise RuntimeError("parser down")
+
+        results, errors = self._concurrently(SingleFlight(), "search:phone", work, n=4)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 4)
+
+    def test_different_keys_do_not_wait_for_each_other(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do("a", lambda: 1), 1)
+        self.assertEqual(flight.do("b", lambda: 2), 2)
+
+    def test_follower_in_another_process_reads_published_result(self):
+        leader, follower = SingleFlight(), SingleFlight()
+        calls = []
+
+        def work():
+            calls.append(1)
+            time.sleep(0.2)
+            return 42
+
+        thread = threading.Thread(target=leader.do, args=("search:tv", work))
+        thread.start()
+        time.sleep(0.05)
+        # отдельный экземпляр — как другой воркер: общий только кэш
+        self.assertEqual(follower.do("search:tv", work), 42)
+        thread.join()
+        self.assertEqual(len(calls), 1)
+
+    @override_settings(SINGLE_FLIGHT={"CACHE_ALIAS": "shared", "POLL_INTERVAL": 0.02, "WAIT_TIMEOUT": 0.2})
+    def test_follower_runs_itself_when_leader_hangs(self):
+        flight = SingleFlight()
+        digest = hashlib.md5(b"search:tv").hexdigest()
+        caches["shared"].add(f"singleflight:lock:{digest}", "other-worker", timeout=60)
+        self.assertEqual(flight.do("search:tv", lambda: "own"), "own")
+
+
+@override_settings(
+    CACHES=_CACHES,
+    SEARCH_STREAMING=False,
+    OFFER_FRESHNESS_TTL={"default": 3600},
+)
+class StaleWhileRevalidateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username="swr", password="swr-pass")
+        cls.query = ProductQuery.objects.create(name="kettle", category="electronics", created_by=cls.user)
+        Offer.objects.bulk_create(
+            [
+                Offer(query=cls.query, marketplace=m, title="kettle", price=100, currency="RUB")
+                for m in MARKETPLACES
+            ]
+        )
+
+    def setUp(self):
+        caches["shared"].clear()
+        self.client.force_login(self.user)
+        self.get_parser = mock.patch("products.services.get_parser", side_effect=StubParser).start()
+        self.background = mock.patch("products.views.run_in_background").start()
+        self.addCleanup(mock.patch.stopall)
+        self.url = reverse("search_results") + "?q=kettle&category=electronics"
+
+    def test_fresh_offers_are_served_without_parsing(self):
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.context["results"]), 3)
+        self.get_parser.assert_not_called()
+        self.background.assert_not_called()
+
+    def test_stale_marketplaces_are_refreshed_in_background(self):
+        Offer.objects.filter(marketplace="ozon").update(parsed_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(services.stale_marketplaces(self.query, MARKETPLACES), ["ozon"])
+        response = self.client.get(self.url)
+        # устаревшие офферы отдаются сразу, обновление — в фоне
+        self.assertEqual(len(response.context["results"]), 3)
+        self.get_parser.assert_not_called()
+        self.assertEqual(self.background.call_count, 1)
+
+    def test_missing_marketplace_counts_as_stale(self):
+        Offer.objects.filter(marketplace="amazon").delete()
+        self.assertEqual(services.stale_marketplaces(self.query, MARKETPLACES), ["amazon"])
+
+
+class CountingStubParser(StubParser):
+    calls = []
+
+    def search_product(self, product_name):
+        type(self).calls.append(self.marketplace)
+        time.sleep(0.2)
+        return super().search_product(product_name)
+
+
+def _sse_events(body):
+    events = []
+    for block in body.decode("utf-8").split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if "event" in lines:
+            events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+@override_settings(
+    CACHES=_CACHES,
+    SEARCH_STREAMING=True,
+    SINGLE_FLIGHT={"CACHE_ALIAS": "shared", "POLL_INTERVAL": 0.02},
+)
+class SearchStreamTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username="stream", password="stream-pass")
+        # курс есть в БД — сервис курсов не пойдёт в сеть
+        CurrencyRate.objects.create(code="USD", rate=Decimal("90"))
+
+    def setUp(self):
+        caches["shared"].clear()
+        CountingStubParser.calls = []
+        patcher = mock.patch("products.services.get_parser", side_effect=CountingStubParser)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+
+    def test_page_title_is_plain_text(self):
+        response = self.client.get(reverse("search_results") + "?q=lamp&category=electronics")
+        content = response.content.decode("utf-8")
+        self.assertIn("<title>Результаты поиска - PriceTracker</title>", content)
+        self.assertEqual(content.count("new EventSource("), 1)
+        self.assertEqual(CountingStubParser.calls, [])
+
+    async def _stream(self, query):
+        response = await self.async_client.get(
+            reverse("search_results_stream") + f"?q={query}&category=electronics"
+        )
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        return _sse_events(body)
+
+    async def test_stream_sends_offers_per_marketplace(self):
+        events = await self._stream("lamp")
+        offers = [data for name, data in events if name == "offers"]
+        self.assertEqual(sorted(e["marketplace"] for e in offers), sorted(MARKETPLACES))
+        done = events[-1]
+        self.assertEqual(done[0], "done")
+        self.assertEqual(done[1]["count"], 15)
+        self.assertEqual(await Offer.objects.filter(query__name="lamp").acount(), 15)
+
+    async def test_identical_streams_fetch_once(self):
+        first, second = await asyncio.gather(self._stream("desk lamp"), self._stream("Desk  lamp"))
+        # каждый маркетплейс опрошен один раз, второй поток получил сохранённые офферы
+        self.assertEqual(sorted(CountingStubParser.calls), sorted(MARKETPLACES))
+        for events in (first, second):
+            self.assertEqual(events[-1][1]["count"], 15)
+        self.assertEqual(await OfferHistory.objects.acount(), 15)
+
+
+def _stub_offers(product_name, marketplaces=MARKETPLACES):
+    return [
+        {
+            "title": product_name,
+            "price": 100 + len(product_name),
+            "currency": "RUB",
+            "marketplace": marketplace,
+            "url": f"https://{marketplace}.example/{product_name}",
+        }
+        for marketplace in marketplaces
+    ]
+
+
+class RefreshTestMixin:
+    """Stubbed marketplace fetch and a temporary checkpoint file for refresh tests."""
+
+    fetch_delay = 0.0
+    # для этих названий маркетплейсы ничего не отдают
+    empty_names = ()
+
+    def setUp(self):
+        super().setUp()
+        caches["shared"].clear()
+        self.fetched = []
+        self.fetch_lock = threading.Lock()
+
+        def fetch(product_name, marketplaces):
+            with self.fetch_lock:
+                self.fetched.append(product_name)
+            time.sleep(self.fetch_delay)
+            return [] if product_name in self.empty_names else _stub_offers(product_name, marketplaces)
+
+        patcher = mock.patch("products.refresh.fetch_offers_from_marketplaces", side_effect=fetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.checkpoint_file = os.path.join(tmp.name, "checkpoint.json")
+        settings_patch = override_settings(REFRESH_CHECKPOINT_FILE=self.checkpoint_file)
+        settings_patch.enable()
+        self.addCleanup(settings_patch.disable)
+
+    def _call(self, *args):
+        out = io.StringIO()
+        call_command("refresh_prices", *args, stdout=out, stderr=out)
+        return out.getvalue()
+
+
+@override_settings(CACHES=_CACHES)
+class ShardedRefreshTests(RefreshTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CurrencyRate.objects.create(code="USD", rate=Decimal("90"))
+        ProductQuery.objects.bulk_create([ProductQuery(name=f"item {i}") for i in range(30)])
+
+    def test_shards_partition_the_queries(self):
+        self._call("--shard", "0/3")
+        first = set(self.fetched)
+        self._call("--shard", "1/3")
+        self._call("--shard", "2/3")
+        self.assertEqual(len(self.fetched), 30)
+        self.assertEqual(set(self.fetched), {f"item {i}" for i in range(30)})
+        self.assertTrue(0 < len(first) < 30)
+        self.assertEqual(Offer.objects.values("query").distinct().count(), 30)
+
+    def test_invalid_shard_is_rejected(self):
+        for shard in ("3/3", "x", "1/0"):
+            with self.assertRaises(CommandError):
+                self._call("--shard", shard)
+
+    def test_workers_fetch_in_parallel(self):
+        self.fetch_delay = 0.1
+        groups = refresh.group_queries(ProductQuery.objects.all()[:8])
+        started = time.monotonic()
+        stats = refresh.refresh_groups(groups, workers=8)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(stats["refreshed"], 8)
+        self.assertEqual(stats["write"].offers_created, 24)
+
+
+@override_settings(CACHES=_CACHES)
+class CrossChunkDuplicateTests(RefreshTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CurrencyRate.objects.create(code="USD", rate=Decimal("90"))
+        names = ["Phone"] + [f"item {i}" for i in range(10)] + ["phone "]
+        ProductQuery.objects.bulk_create([ProductQuery(name=name) for name in names])
+
+    def test_duplicates_in_later_chunks_are_fetched_once(self):
+        output = self._call("--chunk-size", "5")
+        self.assertEqual(self.fetched.count("Phone"), 1)
+        self.assertNotIn("phone ", self.fetched)
+        self.assertIn("1 duplicate groups reused", output)
+        last = ProductQuery.objects.get(name="phone ")
+        self.assertEqual(last.offers.count(), 3)
+        self.assertEqual(last.offers.get(marketplace="ozon").price, Decimal("105.00"))
+
+    def test_resume_keeps_seen_keys(self):
+        first = ProductQuery.objects.get(name="Phone")
+        refresh.persist_offers([(first, _stub_offers("Phone"))])
+        refresh.Checkpoint("refresh_prices:0/1").save(first.id, [("phone", first.id)])
+        self._call("--resume", "--chunk-size", "5")
+        self.assertNotIn("phone ", self.fetched)
+        self.assertEqual(len(self.fetched), 10)
+        self.assertEqual(ProductQuery.objects.get(name="phone ").offers.count(), 3)
+        self.assertEqual(refresh.Checkpoint("refresh_prices:0/1").load(), None)
+
+    def test_fresh_run_drops_stale_seen_keys(self):
+        refresh.Checkpoint("refresh_prices:0/1").save(1, [("phone", None)])
+        self._call("--chunk-size", "5")
+        self.assertEqual(self.fetched.count("Phone"), 1)
+        self.assertIsNone(refresh.Checkpoint("refresh_prices:0/1").load())
+
+
+@override_settings(
+    REFRESH_SCHEDULE={"MIN_INTERVAL": 900, "BASE_INTERVAL": 7200, "MAX_INTERVAL": 86400}
+)
+class SchedulerTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+
+    def _interval(self, volatility=0.005, has_alert=False, viewed_days_ago=5):
+        viewed = None if viewed_days_ago is None else self.now - timedelta(days=viewed_days_ago)
+        return scheduler.compute_interval(volatility, has_alert, viewed, self.now)
+
+    def test_base_interval_for_ordinary_query(self):
+        self.assertEqual(self._interval(), 7200)
+
+    def test_volatile_prices_are_refreshed_sooner(self):
+        self.assertEqual(self._interval(volatility=0.02), 3600)
+        self.assertEqual(self._interval(volatility=0.1), 1800)
+        self.assertEqual(self._interval(volatility=0.0), 14400)
+
+    def test_alerts_and_recent_views_shorten_the_interval(self):
+        self.assertEqual(self._interval(has_alert=True), 3600)
+        self.assertEqual(self._interval(viewed_days_ago=0), 3600)
+        self.assertEqual(self._interval(has_alert=True, viewed_days_ago=0, volatility=0.1), 900)
+
+    def test_abandoned_queries_are_clamped_to_max(self):
+        self.assertEqual(self._interval(viewed_days_ago=60), 28800)
+        self.assertEqual(self._interval(volatility=0.0, viewed_days_ago=None), 57600)
+        never_viewed = scheduler.compute_interval(0.0, False, None, self.now, base_interval=20000)
+        self.assertEqual(never_viewed, 86400)
+
+    def test_reschedule_uses_history_and_alerts(self):
+        calm, volatile, alerted = ProductQuery.objects.bulk_create(
+            [ProductQuery(name=name, last_viewed_at=self.now - timedelta(days=5)) for name in "abc"]
+        )
+        PriceAlert.objects.create(query=alerted, target_price=Decimal("10"))
+        OfferHistory.objects.bulk_create(
+            [
+                OfferHistory(query=q, marketplace="ozon", title="x", price=price, currency="RUB")
+                for q, prices in ((calm, [100, 100]), (volatile, [100, 150]), (alerted, [100, 101]))
+                for price in prices
+            ]
+        )
+        scheduler.reschedule([calm, volatile, alerted])
+        intervals = {
+            q.name: (q.next_refresh_at - q.last_refreshed_at).total_seconds()
+            for q in ProductQuery.objects.all()
+        }
+        self.assertEqual(intervals, {"a": 14400, "b": 1800, "c": 3600})
+
+    def test_refresh_queue_orders_by_due_time(self):
+        later, never, sooner, future = ProductQuery.objects.bulk_create(
+            [
+                ProductQuery(name="later", next_refresh_at=self.now - timedelta(minutes=1)),
+                ProductQuery(name="never"),
+                ProductQuery(name="sooner", next_refresh_at=self.now - timedelta(hours=1)),
+                ProductQuery(name="future", next_refresh_at=self.now + timedelta(hours=1)),
+            ]
+        )
+        queue = scheduler.RefreshQueue()
+        self.assertEqual(queue.refill(), 3)
+        self.assertEqual(queue.refill(), 0)
+        self.assertEqual([q.name for q in queue.pop_many(10)], ["never", "sooner", "later"])
+        self.assertEqual(scheduler.next_due_at(), sooner.next_refresh_at)
+
+
+@override_settings(HISTORY_ROLLUPS={"RAW_DAYS": 14, "MAX_DAYS": 365, "RUN_STEP": 3600})
+class PriceRunTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.query = ProductQuery.objects.create(name="kettle")
+
+    def _point(self, marketplace, price, collected_hours_ago, until_hours_ago=None):
+        point = OfferHistory.objects.create(
+            query=self.query, marketplace=marketplace, title="kettle", price=price, currency="RUB"
+        )
+        point.collected_at = self.now - timedelta(hours=collected_hours_ago)
+        point.seen_until = None if until_hours_ago is None else self.now - timedelta(hours=until_hours_ago)
+        point.save(update_fields=["collected_at", "seen_until"])
+
+    def test_expand_runs_repeats_the_price_until_seen_until(self):
+        start = self.now - timedelta(hours=3)
+        points = rollups.expand_runs(
+            [
+                {"price": 1, "collected_at": start, "seen_until": start + timedelta(minutes=150)},
+                {"price": 2, "collected_at": start + timedelta(minutes=30), "seen_until": None},
+            ]
+        )
+        offsets = [(p["collected_at"] - start).total_seconds() / 60 for p in points]
+        self.assertEqual(offsets, [0, 30, 60, 120, 150])
+        self.assertEqual([p["price"] for p in points], [1, 2, 1, 1, 1])
+        self.assertTrue(all("seen_until" not in p for p in points))
+
+    def test_stable_price_yields_a_point_per_step(self):
+        # одна строка истории на двое суток без смены цены
+        self._point("ozon", Decimal("1000"), collected_hours_ago=48, until_hours_ago=0)
+        series = rollups.price_series(self.query.id)
+        self.assertEqual(len(series), 49)
+        self.assertEqual({p["rub"] for p in series}, {1000.0})
+        self.assertEqual(series[-1]["collected_at"], self.now)
+
+    def test_runs_of_marketplaces_interleave_in_time(self):
+        self._point("ozon", Decimal("1000"), collected_hours_ago=5, until_hours_ago=1)
+        self._point("wildberries", Decimal("900"), collected_hours_ago=3)
+        series = rollups.price_series(self.query.id)
+        self.assertEqual(
+            [p["marketplace"] for p in series], ["ozon", "ozon", "ozon", "wildberries", "ozon", "ozon"]
+        )
+        times = [p["collected_at"] for p in series]
+        self.assertEqual(times, sorted(times))
+
+
+class OfferWriteTests(TestCase):
+    def setUp(self):
+        self.query = ProductQuery.objects.create(name="kettle")
+
+    def _offers(self, **prices):
+        return [
+            {
+                "title": f"kettle {mp}",
+                "price": price,
+                "currency": "RUB",
+                "marketplace": mp,
+                "url": f"https://{mp}.example/1",
+            }
+            for mp, price in prices.items()
+        ]
+
+    def test_unchanged_price_extends_the_last_point(self):
+        first = pipeline.WriteStats()
+        pipeline.upsert_offers(self.query, self._offers(ozon=100, wildberries=200), stats=first)
+        self.assertEqual((first.offers_created, first.history_created), (2, 2))
+
+        second = pipeline.WriteStats()
+        pipeline.upsert_offers(self.query, self._offers(ozon=100, wildberries=200), stats=second)
+        self.assertEqual((second.offers_created, second.offers_updated), (0, 2))
+        self.assertEqual((second.history_created, second.history_extended), (0, 2))
+        self.assertEqual(OfferHistory.objects.count(), 2)
+        for point in OfferHistory.objects.all():
+            self.assertGreater(point.seen_until, point.collected_at)
+
+    def test_price_change_adds_a_point(self):
+        pipeline.upsert_offers(self.query, self._offers(ozon=100))
+        stats = pipeline.WriteStats()
+        pipeline.upsert_offers(self.query, self._offers(ozon=90), stats=stats)
+        self.assertEqual((stats.offers_updated, stats.history_created), (1, 1))
+        history = list(OfferHistory.objects.order_by("collected_at").values_list("price", flat=True))
+        self.assertEqual(history, [Decimal("100.00"), Decimal("90.00")])
+        self.assertEqual(self.query.offers.get().price, Decimal("90.00"))
+        self.assertEqual(self.query.offers.get().price_rub_kop, 9000)
+
+    @override_settings(OFFER_HISTORY_HEARTBEAT=0)
+    def test_heartbeat_writes_a_new_point(self):
+        pipeline.upsert_offers(self.query, self._offers(ozon=100))
+        pipeline.upsert_offers(self.query, self._offers(ozon=100))
+        self.assertEqual(OfferHistory.objects.count(), 2)
+
+    def test_only_answered_marketplaces_are_touched(self):
+        pipeline.upsert_offers(self.query, self._offers(ozon=100, wildberries=200))
+        stale = {"title": "old", "price": 150, "currency": "RUB", "marketplace": "ozon", "url": "https://ozon.example/2"}
+        pipeline.upsert_offers(self.query, [stale])
+        stats = pipeline.WriteStats()
+        pipeline.upsert_offers(self.query, self._offers(ozon=100), stats=stats)
+        self.assertEqual(stats.offers_deleted, 1)
+        self.assertEqual(
+            sorted(self.query.offers.values_list("marketplace", "price")),
+            [("ozon", Decimal("100.00")), ("wildberries", Decimal("200.00"))],
+        )
+
+    def test_offers_without_price_are_skipped(self):
+        offers = self._offers(ozon=0) + [{"title": "x", "price": None, "marketplace": "wildberries"}]
+        self.assertEqual(pipeline.upsert_offers(self.query, offers), [])
+        self.assertFalse(Offer.objects.exists())
+
+    @override_settings(OFFER_REFRESH_MODE="replace")
+    def test_replace_mode_recreates_offers(self):
+        pipeline.upsert_offers(self.query, self._offers(ozon=100))
+        stats = pipeline.WriteStats()
+        pipeline.upsert_offers(self.query, self._offers(ozon=100), stats=stats)
+        self.assertEqual((stats.offers_deleted, stats.offers_created, stats.history_created), (1, 1, 1))
+        self.assertEqual(OfferHistory.objects.count(), 2)
+
+    def test_persist_offers_counts_rows(self):
+        other = ProductQuery.objects.create(name="toaster")
+        stats = pipeline.persist_offers(
+            [(self.query, self._offers(ozon=100)), (other, self._offers(ozon=50, wildberries=60))]
+        )
+        self.assertEqual(stats.queries, 2)
+        self.assertEqual(stats.rows, 6)
+        self.assertEqual(stats.as_dict()["offers_created"], 3)
+        self.assertIn("6 rows for 2 queries", str(stats))
+        self.assertEqual(other.offers.count(), 2)
+
+
+@override_settings(
+    REFRESH_JOBS={
+        "LEASE": 300,
+        "HEARTBEAT": 60,
+        "MAX_ATTEMPTS": 3,
+        "RETRY_BASE_DELAY": 60,
+        "RETRY_MAX_DELAY": 100,
+    }
+)
+class RefreshJobTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.due = ProductQuery.objects.create(name="due")
+        self.later = ProductQuery.objects.create(name="later", next_refresh_at=self.now + timedelta(hours=1))
+        jobs.sync_jobs()
+
+    def test_sync_creates_one_job_per_query(self):
+        self.assertEqual(RefreshJob.objects.count(), 2)
+        self.assertEqual(jobs.sync_jobs(), 0)
+
+    def test_claim_takes_only_due_jobs_once(self):
+        claimed = jobs.claim_jobs("w1", 10)
+        self.assertEqual([job.query.name for job in claimed], ["due"])
+        self.assertEqual((claimed[0].status, claimed[0].attempts), (RefreshJob.RUNNING, 1))
+        self.assertEqual(jobs.claim_jobs("w2", 10), [])
+
+    def test_expired_lease_is_claimed_again(self):
+        jobs.claim_jobs("w1", 10)
+        RefreshJob.objects.filter(locked_by="w1").update(locked_until=self.now - timedelta(seconds=1))
+        self.assertEqual(jobs.heartbeat("w2", RefreshJob.objects.values_list("id", flat=True)), 0)
+        claimed = jobs.claim_jobs("w2", 10)
+        self.assertEqual([(job.locked_by, job.attempts) for job in claimed], [("w2", 2)])
+
+    def test_failures_back_off_then_go_dead(self):
+        self.assertEqual([jobs.retry_delay(n) for n in (1, 2, 3)], [60, 100, 100])
+        for attempt in range(1, 4):
+            RefreshJob.objects.update(run_after=None)
+            claimed = jobs.claim_jobs("w1", 10)
+            jobs.fail_jobs("w1", claimed, "boom")
+            job = RefreshJob.objects.get(query=self.due)
+            self.assertEqual(job.attempts, attempt)
+        self.assertEqual((job.status, job.last_error, job.locked_by), (RefreshJob.DEAD, "boom", ""))
+        self.assertEqual(jobs.claim_jobs("w1", 10), [])
+        self.assertEqual(jobs.requeue_dead(), 1)
+        self.assertEqual(len(jobs.claim_jobs("w1", 10)), 1)
+
+    def test_failed_job_waits_for_backoff(self):
+        jobs.fail_jobs("w1", jobs.claim_jobs("w1", 10), "boom")
+        job = RefreshJob.objects.get(query=self.due)
+        self.assertEqual(job.status, RefreshJob.PENDING)
+        self.assertAlmostEqual((job.run_after - self.now).total_seconds(), 60, delta=5)
+        self.assertEqual(jobs.claim_jobs("w1", 10), [])
+
+    def test_complete_resets_the_job(self):
+        claimed = jobs.claim_jobs("w1", 10)
+        self.assertEqual(jobs.complete_jobs("w2", [job.id for job in claimed]), 0)
+        self.assertEqual(jobs.complete_jobs("w1", [job.id for job in claimed]), 1)
+        job = RefreshJob.objects.get(query=self.due)
+        self.assertEqual((job.status, job.attempts, job.locked_by), (RefreshJob.PENDING, 0, ""))
+
+
+@override_settings(CACHES=_CACHES)
+class RefreshWorkerTests(RefreshTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CurrencyRate.objects.create(code="USD", rate=Decimal("90"))
+        ProductQuery.objects.bulk_create([ProductQuery(name=name) for name in ("found", "nothing")])
+
+    empty_names = ("nothing",)
+
+    def test_empty_fetch_fails_the_job(self):
+        out = io.StringIO()
+        call_command("run_refresh_worker", "--once", "--worker-id", "w1", stdout=out, stderr=out)
+        found = RefreshJob.objects.get(query__name="found")
+        nothing = RefreshJob.objects.get(query__name="nothing")
+        self.assertEqual((found.status, found.attempts), (RefreshJob.PENDING, 0))
+        self.assertIsNotNone(ProductQuery.objects.get(name="found").next_refresh_at)
+        self.assertEqual(
+            (nothing.status, nothing.attempts, nothing.last_error), (RefreshJob.PENDING, 1, "fetch failed")
+        )
+        self.assertIsNotNone(nothing.run_after)
+        self.assertIn("nothing: no offers from any marketplace", out.getvalue())
+        self.assertIn("1/2 jobs done", out.getvalue())
+
+
+@override_settings(CACHES=_CACHES)
+class ResumableRefreshTests(RefreshTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CurrencyRate.objects.create(code="USD", rate=Decimal("90"))
+        ProductQuery.objects.bulk_create([ProductQuery(name=f"item {i}") for i in range(12)])
+
+    def test_iter_query_chunks_pages_by_id(self):
+        ids = list(ProductQuery.objects.order_by("id").values_list("id", flat=True))
+        chunks = list(refresh.iter_query_chunks(chunk_size=5))
+        self.assertEqual([len(chunk) for chunk in chunks], [5, 5, 2])
+        self.assertEqual([q.id for chunk in chunks for q in chunk], ids)
+        self.assertEqual(len(list(refresh.iter_query_chunks(after_id=ids[9], chunk_size=5))), 1)
+
+    def test_checkpoint_round_trip(self):
+        checkpoint = refresh.Checkpoint("run:a")
+        other = refresh.Checkpoint("run:b")
+        self.assertIsNone(checkpoint.load())
+        checkpoint.save(10, [("tv", 3)])
+        checkpoint.save(15, [("radio", None)])
+        other.save(20)
+        self.assertEqual(checkpoint.load(), 15)
+        self.assertEqual(dict(checkpoint.load_seen()), {"tv": 3, "radio": None})
+        self.assertEqual(dict(other.load_seen()), {})
+        checkpoint.clear()
+        self.assertIsNone(checkpoint.load())
+        self.assertEqual(dict(checkpoint.load_seen()), {})
+        self.assertEqual(other.load(), 20)
+
+    def test_checkpoint_appends_only_new_keys(self):
+        checkpoint = refresh.Checkpoint("run:a")
+        seen = refresh.SeenKeys()
+        for chunk in range(3):
+            for i in range(4):
+                seen[f"item {chunk}-{i}"] = None
+                seen[f"item {chunk}-{i}"] = chunk * 10 + i
+            checkpoint.save(chunk, seen.drain())
+        with open(checkpoint.seen_path, encoding="utf-8") as fh:
+            self.assertEqual(len(fh.readlines()), 12)
+        self.assertEqual(checkpoint.load_seen()["item 2-3"], 23)
+
+    def test_seen_keys_are_bounded(self):
+        seen = refresh.SeenKeys(maxsize=3)
+        for i in range(5):
+            seen[f"item {i}"] = i
+        self.assertEqual(list(seen), ["item 2", "item 3", "item 4"])
+        self.assertEqual(len(seen.drain()), 5)
+        self.assertEqual(seen.drain(), [])
+
+    def test_broken_checkpoint_file_is_ignored(self):
+        with open(self.checkpoint_file, "w", encoding="utf-8") as fh:
+            fh.write("{not json")
+        with mock.patch("builtins.print"):
+            self.assertIsNone(refresh.Checkpoint("run:a").load())
+
+    def test_interrupted_run_resumes_after_the_last_chunk(self):
+        ids = list(ProductQuery.objects.order_by("id").values_list("id", flat=True))
+        real_refresh = refresh.refresh_groups
+        calls = []
+
+        def crash_on_second_chunk(groups, **kwargs):
+            calls.append(groups)
+            if len(calls) == 2:
+                raise RuntimeError("worker killed")
+            return real_refresh(groups, **kwargs)
+
+        with mock.patch(
+            "products.management.commands.refresh_prices.refresh_groups", side_effect=crash_on_second_chunk
+        ):
+            with self.assertRaises(RuntimeError):
+                self._call("--chunk-size", "5")
+        checkpoint = refresh.Checkpoint("refresh_prices:0/1")
+        self.assertEqual(checkpoint.load(), ids[4])
+
+        self.fetched.clear()
+        output = self._call("--resume", "--chunk-size", "5")
+        self.assertIn(f"Resuming after query id {ids[4]}", output)
+        self.assertEqual(sorted(self.fetched), sorted(f"item {i}" for i in range(5, 12)))
+        self.assertIsNone(checkpoint.load())
+
+    def test_run_without_resume_starts_over(self):
+        refresh.Checkpoint("refresh_prices:0/1").save(ProductQuery.objects.order_by("id").last().id)
+        self._call()
+        self.assertEqual(len(self.fetched), 12)
+
+
+class ProductListTrendTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username="trend", password="pass")
+        cls.query = ProductQuery.objects.create(name="kettle", created_by=cls.user)
+        earlier = timezone.now() - timedelta(days=1)
+        prices = (("ozon", "90", "100"), ("wildberries", "120", "100"), ("amazon", None, "10"))
+        for marketplace, old, new in prices:
+            Offer.objects.create(
+                query=cls.query, marketplace=marketplace, title="kettle", price=Decimal(new), currency="RUB"
+            )
+            if old is not None:
+                point = OfferHistory.objects.create(
+                    query=cls.query, marketplace=marketplace, title="kettle", price=Decimal(old), currency="RUB"
+                )
+                OfferHistory.objects.filter(pk=point.pk).update(collected_at=earlier)
+        # точка того же обхода (collected_at после parsed_at) не считается предыдущей ценой
+        OfferHistory.objects.create(
+            query=cls.query, marketplace="ozon", title="kettle", price=Decimal("100"), currency="RUB"
+        )
+        other = ProductQuery.objects.create(name="toaster")
+        Offer.objects.create(query=other, marketplace="ozon", title="toaster", price=Decimal("5"))
+
+    def test_trend_and_difference_per_offer(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("product_list"))
+        offers = {offer.marketplace: offer for offer in response.context["offers"]}
+        self.assertEqual(set(offers), {"ozon", "wildberries", "amazon"})
+        self.assertEqual((offers["ozon"].trend, offers["ozon"].diff_abs), ("up", Decimal("10")))
+        self.assertEqual((offers["wildberries"].trend, offers["wildberries"].diff_abs), ("down", Decimal("20")))
+        self.assertEqual((offers["amazon"].trend, offers["amazon"].diff_abs), ("flat", Decimal("0")))
+        self.assertLessEqual(len(queries), QUERY_BUDGETS["product_list"])
+
+    def test_anonymous_user_is_redirected(self):
+        response = self.client.get(reverse("product_list"))
+        self.assertRedirects(response, reverse("login"), fetch_redirect_response=False)
+
+
+@override_settings(
+    HISTORY_ROLLUPS={"RETENTION_DAYS": 90, "RAW_DAYS": 14, "MAX_DAYS": 365, "RUN_STEP": 7200}
+)
+class RollupTests(TestCase):
+    def setUp(self):
+        self.query = ProductQuery.objects.create(name="kettle")
+        noon = timezone.localtime().replace(hour=12, minute=0, second=0, microsecond=0)
+        self.old_noon = noon - timedelta(days=100)
+
+    def _old_point(self, price, minutes, marketplace="ozon", day_offset=0):
+        point = OfferHistory.objects.create(
+            query=self.query, marketplace=marketplace, title="kettle", price=Decimal(price), currency="RUB"
+        )
+        at = self.old_noon + timedelta(days=day_offset, minutes=minutes)
+        OfferHistory.objects.filter(pk=point.pk).update(collected_at=at)
+        return at
+
+    def test_observations_update_todays_bar(self):
+        offer = {"title": "kettle", "currency": "RUB", "marketplace": "ozon", "url": "https://ozon.example/1"}
+        for price in (100, 80, 120, 90):
+            pipeline.upsert_offers(self.query, [{**offer, "price": price}])
+        bar = OfferHistoryDaily.objects.get()
+        self.assertEqual(bar.day, timezone.localdate())
+        self.assertEqual(
+            (bar.open, bar.high, bar.low, bar.close, bar.count, bar.total),
+            (Decimal("100"), Decimal("120"), Decimal("80"), Decimal("90"), 4, Decimal("390")),
+        )
+
+    def test_compaction_merges_a_day_split_across_chunks(self):
+        self._old_point("100", 0)
+        self._old_point("130", 60)
+        self._old_point("70", 30)
+        self._old_point("50", 0, marketplace="wildberries")
+        recent = OfferHistory.objects.create(
+            query=self.query, marketplace="ozon", title="kettle", price=Decimal("1"), currency="RUB"
+        )
+        stats = rollups.compact_history(chunk_size=1)
+        self.assertEqual(stats, {"points": 4, "bars": 2})
+        self.assertEqual(list(OfferHistory.objects.values_list("pk", flat=True)), [recent.pk])
+        bar = OfferHistoryDaily.objects.get(marketplace="ozon", day=self.old_noon.date())
+        self.assertEqual(
+            (bar.open, bar.high, bar.low, bar.close, bar.count),
+            (Decimal("100"), Decimal("130"), Decimal("70"), Decimal("130"), 3),
+        )
+
+    def test_days_with_bars_are_only_deleted(self):
+        at = self._old_point("100", 0)
+        OfferHistoryDaily.objects.create(
+            query=self.query, marketplace="ozon", day=at.date(), currency="RUB", open=Decimal("100"),
+            high=Decimal("100"), low=Decimal("100"), close=Decimal("100"), total=Decimal("500"), count=5,
+            first_at=at, last_at=at,
+        )
+        self.assertEqual(rollups.compact_history(), {"points": 1, "bars": 0})
+        self.assertEqual(OfferHistoryDaily.objects.get().count, 5)
+        self.assertFalse(OfferHistory.objects.exists())
+
+    def test_backfill_keeps_raw_points(self):
+        self._old_point("100", 0)
+        self.assertEqual(rollups.compact_history(0, delete=False), {"points": 1, "bars": 1})
+        self.assertEqual(OfferHistory.objects.count(), 1)
+        # повторный прогон не удваивает уже построенные бары
+        rollups.compact_history(0, delete=False)
+        self.assertEqual(OfferHistoryDaily.objects.get().count, 1)
+
+    def test_price_series_reads_bars_then_raw_points(self):
+        self._old_point("100", 0)
+        self._old_point("200", 60)
+        self._old_point("300", 0, day_offset=-300)
+        rollups.compact_history()
+        OfferHistory.objects.create(
+            query=self.query, marketplace="ozon", title="kettle", price=Decimal("120"), currency="RUB",
+            price_rub_kop=12000,
+        )
+        series = rollups.price_series(self.query.id)
+        self.assertEqual([p["rub"] for p in series], [150.0, 120.0])
+        self.assertEqual(len(rollups.price_series(self.query.id, max_days=500)), 3)
+
+
+class FreshRatesMixin:
+    """
+    A fresh RateService and empty caches: rates come only from this test's rows.
+    Background refreshes are recorded instead of starting threads.
+    """
+
+    def setUp(self):
+        super().setUp()
+        caches["shared"].clear()
+        for patcher in (
+            mock.patch.object(currency, "_service", currency.RateService()),
+            mock.patch.object(currency.RateService, "refresh_in_background"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.refresh_in_background = currency.RateService.refresh_in_background
+
+    def _timeline(self, code, *points):
+        CurrencyRateHistory.objects.bulk_create(
+            [CurrencyRateHistory(code=code, rate=Decimal(rate), valid_from=at) for at, rate in points]
+        )
+
+
+@override_settings(CACHES=_CACHES)
+class RubPriceTests(FreshRatesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        CurrencyRate.objects.create(code="USD", rate=Decimal("90.5"))
+        self.query = ProductQuery.objects.create(name="kettle")
+
+    def test_to_rub_kopecks_rounds_half_up(self):
+        self.assertEqual(currency.to_rub_kopecks(Decimal("10.05"), "USD"), (90953, Decimal("90.500000")))
+        self.assertEqual(currency.to_rub_kopecks(Decimal("199.99"), "RUB"), (19999, Decimal("1.000000")))
+        self.assertEqual(currency.to_rub_kopecks(Decimal("1"), None), (100, Decimal("1.000000")))
+
+    def test_pipeline_stores_rub_kopecks(self):
+        offers = [
+            {"title": "a", "price": "10.05", "currency": "USD", "marketplace": "amazon", "url": "https://a/1"},
+            {"title": "b", "price": "900", "currency": "RUB", "marketplace": "ozon", "url": "https://o/1"},
+        ]
+        pipeline.upsert_offers(self.query, offers)
+        stored = dict(Offer.objects.values_list("marketplace", "price_rub_kop"))
+        self.assertEqual(stored, {"amazon": 90953, "ozon": 90000})
+        self.assertEqual(
+            dict(OfferHistory.objects.values_list("marketplace", "rub_rate")),
+            {"amazon": Decimal("90.500000"), "ozon": Decimal("1.000000")},
+        )
+        # выдача сортируется по рублям, а не по числу в разных валютах; порядок модели — прежний
+        self.assertEqual([o.marketplace for o in Offer.objects.order_by(*Offer.CHEAPEST_FIRST)], ["ozon", "amazon"])
+        self.assertEqual([o.marketplace for o in Offer.objects.all()], ["amazon", "ozon"])
+
+    def test_fallback_rate_is_not_stored(self):
+        CurrencyRate.objects.filter(code="USD").delete()
+        offer = {"title": "a", "price": "10", "currency": "USD", "marketplace": "amazon", "url": "https://a/1"}
+        pipeline.upsert_offers(self.query, [offer])
+        self.assertEqual(currency.get_rate("USD"), 90.0)
+        self.assertEqual(list(Offer.objects.values_list("price_rub_kop", "rub_rate")), [(None, None)])
+        self.assertEqual(list(OfferHistory.objects.values_list("price_rub_kop", flat=True)), [None])
+
+        out = io.StringIO()
+        call_command("backfill_rub_prices", stdout=out)
+        self.assertIn("Offer: 0 rows backfilled", out.getvalue())
+        # курс появился — бэкфилл дозаполняет строки, записанные по запасному курсу
+        CurrencyRate.objects.create(code="USD", rate=Decimal("98"))
+        currency.get_rate_service().clear()
+        call_command("backfill_rub_prices", stdout=out)
+        self.assertEqual(Offer.objects.get().price_rub_kop, 98000)
+        self.assertEqual(OfferHistory.objects.get().rub_rate, Decimal("98.000000"))
+
+    @override_settings(CACHES=_CACHES)
+    def test_search_page_lists_cheapest_rub_first(self):
+        user = get_user_model().objects.create_user(username="rub", password="rub-pass")
+        self.client.force_login(user)
+        self.query.category = "electronics"
+        self.query.save(update_fields=["category"])
+        pipeline.upsert_offers(
+            self.query,
+            [
+                {"title": "a", "price": "10.05", "currency": "USD", "marketplace": "amazon", "url": "https://a/1"},
+                {"title": "b", "price": "900", "currency": "RUB", "marketplace": "ozon", "url": "https://o/1"},
+            ],
+        )
+        with mock.patch("products.views.stale_marketplaces", return_value=[]), mock.patch(
+            "products.views.advanced_predict", return_value={}
+        ) as predict, mock.patch("products.views.PricePredictor"):
+            response = self.client.get(reverse("search_results"), {"q": "kettle", "category": "electronics"})
+        self.assertEqual([o.marketplace for o in response.context["results"]], ["ozon", "amazon"])
+        # прогноз по-прежнему берёт маркетплейс оффера с наименьшей ценой
+        self.assertEqual(predict.call_args.args[2], "amazon")
+
+    def test_backfill_uses_the_rate_of_each_moment(self):
+        now = timezone.now()
+        self._timeline("USD", (now - timedelta(days=10), "80"), (now - timedelta(days=5), "100"))
+        old, new = (
+            OfferHistory.objects.create(query=self.query, marketplace="amazon", title="a", price=Decimal("2"))
+            for _ in range(2)
+        )
+        OfferHistory.objects.filter(pk=old.pk).update(collected_at=now - timedelta(days=7))
+        rub = OfferHistory.objects.create(
+            query=self.query, marketplace="ozon", title="b", price=Decimal("3.33"), currency="RUB"
+        )
+        offer = Offer.objects.create(query=self.query, marketplace="amazon", title="a", price=Decimal("1.5"))
+
+        out = io.StringIO()
+        call_command("backfill_rub_prices", "--chunk-size", "1", stdout=out)
+        kopecks = dict(OfferHistory.objects.values_list("pk", "price_rub_kop"))
+        self.assertEqual(kopecks, {old.pk: 16000, new.pk: 20000, rub.pk: 333})
+        offer.refresh_from_db()
+        self.assertEqual((offer.price_rub_kop, offer.rub_rate), (15000, Decimal("100.000000")))
+        self.assertIn("OfferHistory: 3 rows backfilled", out.getvalue())
+
+        call_command("backfill_rub_prices", stdout=out)
+        self.assertIn("Offer: 0 rows backfilled", out.getvalue())
+
+    def test_backfill_visits_each_currency_once(self):
+        for price in ("1", "2", "3"):
+            Offer.objects.create(query=self.query, marketplace="amazon", title=price, price=Decimal(price))
+            OfferHistory.objects.create(query=self.query, marketplace="amazon", title=price, price=Decimal(price))
+        Offer.objects.create(query=self.query, marketplace="ozon", title="b", price=Decimal("5"), currency="RUB")
+        command = backfill_rub_prices.Command(stdout=io.StringIO())
+        with mock.patch.object(command, "_segments", wraps=command._segments) as segments:
+            command.handle(chunk_size=10)
+        self.assertEqual(sorted(call.args[0] for call in segments.call_args_list), ["RUB", "USD", "USD"])
+
+
+@override_settings(CACHES=_CACHES, CURRENCY_RATES={"TTL": 3600, "CACHE_ALIAS": "shared"})
+class RateServiceTests(FreshRatesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.service = currency.get_rate_service()
+
+    def test_rate_is_read_from_db_once(self):
+        CurrencyRate.objects.create(code="USD", rate=Decimal("91"))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.service.get_rate("usd"), 91.0)
+            self.assertEqual(self.service.get_rate("USD"), 91.0)
+        self.assertEqual(self.service.get_rate("RUB"), 1.0)
+
+    def test_other_workers_read_the_shared_cache(self):
+        CurrencyRate.objects.create(code="EUR", rate=Decimal("99"))
+        self.service.get_rate("EUR")
+        with self.assertNumQueries(0):
+            self.assertEqual(currency.RateService().get_rate("EUR"), 99.0)
+
+    def test_expired_rate_is_served_and_refreshed_in_background(self):
+        CurrencyRate.objects.create(code="USD", rate=Decimal("91"))
+        self.service.get_rate("USD")
+        self.service._local["USD"] = (91.0, time.monotonic() - 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.service.get_rate("USD"), 91.0)
+        self.refresh_in_background.assert_called_once()
+
+    def test_unknown_rate_falls_back_without_network(self):
+        with mock.patch.object(currency, "fetch_cbr_rates") as fetch:
+            self.assertEqual(self.service.get_rate("USD"), 90.0)
+            self.assertEqual(self.service.get_rate("XYZ"), 100.0)
+        fetch.assert_not_called()
+        self.refresh_in_background.assert_called()
+        # запасной курс не выдаётся за настоящий, пока его не заменит обновление
+        self.assertIsNone(self.service.known_rate("USD"))
+        self.assertEqual(self.service.known_rate("RUB"), 1.0)
+        CurrencyRate.objects.create(code="USD", rate=Decimal("91"))
+        self.service.refresh()
+        self.assertEqual(self.service.known_rate("USD"), 91.0)
+
+    def test_refresh_publishes_db_rates(self):
+        CurrencyRate.objects.create(code="USD", rate=Decimal("91"))
+        self.service.get_rate("USD")
+        CurrencyRate.objects.filter(code="USD").update(rate=Decimal("95"))
+        self.assertEqual(self.service.refresh(), {"USD": 95.0})
+        self.assertEqual(self.service.get_rate("USD"), 95.0)
+        self.assertEqual(caches["shared"].get("currency:rate:USD"), 95.0)
+
+    def test_refresh_of_empty_table_loads_the_feed(self):
+        with mock.patch.object(currency, "fetch_cbr_rates", return_value={"USD": 92.0}):
+            self.assertEqual(self.service.refresh(), {"USD": 92.0})
+        self.assertEqual(CurrencyRate.objects.get().rate, Decimal("92"))
+
+    def test_to_rub_many_looks_up_each_currency_once(self):
+        rates = {"USD": 90.0, "RUB": 1.0}
+        with mock.patch.object(currency, "get_rate", side_effect=rates.get) as rate:
+            result = currency.to_rub_many([1, 2, 3, "4.5"], ["USD", "usd", None, "RUB"])
+        self.assertEqual([float(x) for x in result], [90.0, 180.0, 3.0, 4.5])
+        self.assertEqual(sorted(call.args[0] for call in rate.call_args_list), ["RUB", "USD"])
+
+
+@override_settings(CACHES=_CACHES, CURRENCY_RATES={"TTL": 3600, "CACHE_ALIAS": "shared"})
+class RateTimelineTests(FreshRatesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = timezone.now()
+        CurrencyRate.objects.create(code="USD", rate=Decimal("95"))
+
+    def test_rate_index_binary_search(self):
+        index = currency.RateIndex([10.0, 20.0, 30.0], [1.0, 2.0, 3.0], default=9.0)
+        self.assertEqual([index.rate_at(ts) for ts in (5, 10, 15, 20, 35)], [1.0, 1.0, 1.0, 2.0, 3.0])
+        self.assertEqual([float(r) for r in index.rates_at([5, 25, 30])], [1.0, 2.0, 3.0])
+        empty = currency.RateIndex([], [], default=9.0)
+        self.assertEqual((empty.rate_at(self.now), list(empty.rates_at([1, 2]))), (9.0, [9.0, 9.0]))
+
+    def test_empty_timeline_uses_the_current_rate(self):
+        self.assertEqual(currency.rate_at("USD", self.now - timedelta(days=100)), 95.0)
+        self.assertEqual(currency.rate_at("RUB", self.now), 1.0)
+
+    def test_to_rub_at_many_converts_at_each_moment(self):
+        self._timeline("USD", (self.now - timedelta(days=10), "80"), (self.now - timedelta(days=5), "100"))
+        self._timeline("EUR", (self.now - timedelta(days=10), "110"))
+        before_timeline = (self.now - timedelta(days=20)).timestamp()
+        moments = [self.now - timedelta(days=7), self.now, before_timeline, self.now]
+        # на валюту: лента и текущий курс (запасной, если лента пуста)
+        with self.assertNumQueries(4):
+            result = currency.to_rub_at_many([1, 1, 1, 2], ["USD", "usd", "EUR", "RUB"], moments)
+        self.assertEqual([float(x) for x in result], [80.0, 100.0, 110.0, 2.0])
+        # индекс ленты загружен один раз на валюту
+        with self.assertNumQueries(0):
+            currency.to_rub_at_many([1], ["USD"], [self.now])
+
+    def test_update_currency_rates_appends_to_the_timeline(self):
+        response = mock.Mock()
+        response.json.return_value = {
+            "date": "2026-10-01T11:30:00+03:00",
+            "rates": {"USD": 0.01, "EUR": 0.008},
+        }
+        with mock.patch("products.currency.requests.get", return_value=response):
+            call_command("update_currency_rates", stdout=io.StringIO())
+            call_command("update_currency_rates", stdout=io.StringIO())
+        self.assertEqual(
+            sorted(CurrencyRateHistory.objects.values_list("code", "rate")),
+            [("EUR", Decimal("125")), ("USD", Decimal("100"))],
+        )
+        self.assertEqual(CurrencyRate.objects.get(code="USD").rate, Decimal("100"))
+        # refresh() сбросил индекс: новая точка ленты видна сразу
+        self.assertEqual(currency.rate_at("USD", self.now), 100.0)
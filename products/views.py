@@ -1,8 +1,20 @@
-from datetime import timedelta
+import asyncio
+import json
+import logging
+import threading
+import time
 from decimal import Decimal
+from typing import List, Optional
+from urllib.parse import urlencode
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Case, DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Abs, Coalesce
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.http import JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import redirect, render
 from django.urls import reverse
 from django.utils import timezone
@@ -12,13 +24,27 @@ from analysis.seasonal_analyzer import SeasonalAnalyzer
 from analysis.predictor import PricePredictor
 from analysis.advanced_predictor import advanced_predict
 from .models import Offer, ProductQuery, OfferHistory, PriceAlert
-from .services import fetch_offers_from_marketplaces, generate_demo_offers
-from .currency import to_rub
+from parsers.cache import normalize_query
+from .services import (
+    fetch_marketplace_report,
+    generate_demo_offers,
+    iter_marketplace_results,
+    open_breakers,
+    run_in_background,
+    stale_marketplaces,
+)
+from .pipeline import WriteStats, upsert_offers
+from .scheduler import reschedule
+from .singleflight import get_single_flight
+
+MARKETPLACES = ["amazon", "wildberries", "ozon"]
+
+logger = logging.getLogger(__name__)
 
 
 def home_view(request):
     recent_queries = ProductQuery.objects.order_by("-created_at")[:5]
-    recent_offers = Offer.objects.select_related("query").order_by("price")[:6]
+    recent_offers = Offer.objects.select_related("query").order_by(*Offer.CHEAPEST_FIRST)[:6]
     return render(
         request,
         "pages/home.html",
@@ -30,31 +56,34 @@ def product_list(request):
     if not request.user.is_authenticated:
         messages.error(request, "Авторизуйтесь, чтобы видеть историю предложений.")
         return redirect("login")
+    # тренд по истории считается в том же SQL-запросе, без запроса на каждый оффер
+    prev_price = (
+        OfferHistory.objects.filter(
+            query=OuterRef("query"),
+            marketplace=OuterRef("marketplace"),
+            collected_at__lt=OuterRef("parsed_at"),
+        )
+        .order_by("-collected_at")
+        .values("price")[:1]
+    )
+    money = DecimalField(max_digits=12, decimal_places=2)
+    diff = ExpressionWrapper(F("price") - F("prev_price"), output_field=money)
     offers = (
         Offer.objects.select_related("query")
         .filter(query__created_by=request.user)
+        .annotate(prev_price=Subquery(prev_price))
+        .annotate(
+            diff_value=Coalesce(diff, Value(Decimal(0)), output_field=money),
+            trend=Case(
+                When(prev_price__isnull=True, then=Value("flat")),
+                When(price__gt=F("prev_price"), then=Value("up")),
+                When(price__lt=F("prev_price"), then=Value("down")),
+                default=Value("flat"),
+            ),
+        )
+        .annotate(diff_abs=Abs("diff_value", output_field=money))
         .order_by("-parsed_at")[:50]
     )
-    # вычисляем тренд по истории
-    for offer in offers:
-        prev = (
-            OfferHistory.objects.filter(
-                query=offer.query,
-                marketplace=offer.marketplace,
-                collected_at__lt=offer.parsed_at,
-            )
-            .order_by("-collected_at")
-            .first()
-        )
-        if prev:
-            diff = offer.price - prev.price
-            offer.trend = "up" if diff > 0 else "down" if diff < 0 else "flat"
-            offer.diff_value = diff
-            offer.diff_abs = abs(diff)
-        else:
-            offer.trend = "flat"
-            offer.diff_value = 0
-            offer.diff_abs = 0
     return render(request, "products/list.html", {"offers": offers})
 
 
@@ -71,90 +100,129 @@ def product_search(request):
     return render(request, "pages/product_search.html")
 
 
-@login_required
-def search_results(request):
-    search_query = request.GET.get("q", "").strip()
-    category = request.GET.get("category", "").strip() or "electronics"
-    if not search_query:
-        messages.error(request, "Введите запрос для поиска.")
-        return redirect("product_search")
-
-    existing_query = ProductQuery.objects.filter(
+def _find_query(search_query: str, category: str):
+    return ProductQuery.objects.filter(
         name__iexact=search_query, category=category
     ).order_by("-created_at").first()
 
-    # если есть свежие офферы (<= 1 час) и не демо — отдаём их, иначе парсим заново
-    reuse = False
-    force_refresh = request.GET.get("refresh") == "1"
-    if existing_query:
-        offers_qs = existing_query.offers.order_by("-parsed_at")
-        if offers_qs.exists():
-            latest = offers_qs.first().parsed_at
-            if not force_refresh and latest >= timezone.now() - timedelta(hours=1):
-                reuse = True
-                query_obj = existing_query
-                offers = list(offers_qs)
-    if not reuse:
-        query_obj = existing_query or ProductQuery.objects.create(
-            name=search_query,
-            category=category,
-            created_by=request.user if request.user.is_authenticated else None,
-        )
-        # очистить старые офферы перед новым парсингом
-        query_obj.offers.all().delete()
 
-    raw_offers = fetch_offers_from_marketplaces(
+def _get_or_create_query(search_query: str, category: str, user):
+    # запрос ищем заново: его мог только что создать другой процесс
+    return _find_query(search_query, category) or ProductQuery.objects.create(
+        name=search_query,
+        category=category,
+        created_by=user if user.is_authenticated else None,
+    )
+
+
+def _flight_key(search_query: str, category: str) -> str:
+    # общий ключ для обычного и потокового поиска: одинаковые запросы парсятся один раз
+    return f"search:{normalize_query(search_query)}:{category}"
+
+
+def _store_offers(
+    query_obj, raw_offers: List[dict], search_query: str, stats: Optional[WriteStats] = None
+) -> List[Offer]:
+    # обновляем офферы только тех маркетплейсов, что ответили; остальные остаются до следующего раза
+    return upsert_offers(query_obj, raw_offers, default_title=search_query, stats=stats)
+
+
+def _refresh_search_offers(
+    search_query: str,
+    category: str,
+    user,
+    marketplaces: List[str],
+    total_timeout: Optional[float] = None,
+) -> dict:
+    query_obj = _get_or_create_query(search_query, category, user)
+    report = fetch_marketplace_report(
         product_name=search_query,
-        marketplaces=["amazon", "wildberries", "ozon"],
+        marketplaces=marketplaces,
+        total_timeout=total_timeout,
     )
-    used_demo = False
-    offers = []
-    if reuse:
-        used_demo = False
-    else:
-        if not raw_offers:
-            raw_offers = []
-            used_demo = False
-        for raw in raw_offers:
-            if raw.get("price") in (None, "", 0):
-                continue
-            marketplace = raw.get("marketplace", "amazon")
-            raw_price = float(raw.get("price", 0))
-            if marketplace == "amazon":
-                price = raw_price
-                currency = "USD"
-            else:
-                price = to_rub(raw_price, raw.get("currency", "RUB"))
-                currency = "RUB"
-            offer = Offer.objects.create(
-                query=query_obj,
-                marketplace=marketplace,
-                title=raw.get("title", search_query),
-                price=Decimal(str(price)) if price else 0,
-                currency=currency,
-                rating=raw.get("rating"),
-                url=raw.get("url", ""),
-                image_url=raw.get("image_url", ""),
-            )
-            OfferHistory.objects.create(
-                query=query_obj,
-                marketplace=offer.marketplace,
-                title=offer.title,
-                price=offer.price,
-                currency=offer.currency,
-            )
-            offers.append(offer)
+    raw_offers = [offer for result in report.values() for offer in result["offers"]]
+    stats = WriteStats()
+    _store_offers(query_obj, raw_offers, search_query, stats)
+    logger.debug("Search '%s': stored %s", search_query, stats)
+    reschedule([query_obj])
+    return {
+        "query_id": query_obj.id,
+        # маркетплейсы, пропущенные circuit breaker'ом или не уложившиеся в дедлайн
+        "degraded": [
+            marketplace for marketplace, result in report.items() if result["status"] != "ok"
+        ],
+    }
+
 
+def _build_forecast(query_obj, category: str, offers: List[Offer]):
     forecast = None
     forecast_confidence_pct = None
     if offers:
+        # маркетплейс прогноза — оффер с наименьшей ценой (порядок Offer.Meta), а не порядок выдачи
+        marketplace = min(offers, key=lambda offer: offer.price).marketplace
         # сначала пытаемся продвинутый прогноз
-        forecast = advanced_predict(query_obj.id, category, offers[0].marketplace)
+        forecast = advanced_predict(query_obj.id, category, marketplace)
         # если не удалось — fallback
         if not forecast:
             forecast = PricePredictor().predict(query_obj.id, category)
         if forecast and forecast.get("confidence") is not None:
             forecast_confidence_pct = round(forecast["confidence"] * 100, 1)
+    return forecast, forecast_confidence_pct
+
+
+@login_required
+def search_results(request):
+    search_query = request.GET.get("q", "").strip()
+    category = request.GET.get("category", "").strip() or "electronics"
+    if not search_query:
+        messages.error(request, "Введите запрос для поиска.")
+        return redirect("product_search")
+
+    existing_query = _find_query(search_query, category)
+    force_refresh = request.GET.get("refresh") == "1"
+    flight_key = _flight_key(search_query, category)
+    used_demo = False
+    stream_url = None
+
+    # stale-while-revalidate: свежие офферы отдаём без сети, устаревшие — тоже сразу,
+    # но обновляем в фоне; блокируемся только на холодном запросе (и недолго)
+    if existing_query and not force_refresh and existing_query.offers.exists():
+        query_obj = existing_query
+        stale = stale_marketplaces(query_obj, MARKETPLACES)
+        if stale:
+            run_in_background(
+                get_single_flight().do,
+                flight_key,
+                lambda: _refresh_search_offers(search_query, category, request.user, stale),
+            )
+        offers = list(query_obj.offers.order_by(*Offer.CHEAPEST_FIRST))
+        degraded_marketplaces = open_breakers(MARKETPLACES)
+    elif getattr(settings, "SEARCH_STREAMING", False):
+        # страница отдаётся сразу, офферы приходят по SSE по мере ответа маркетплейсов
+        query_obj = _get_or_create_query(search_query, category, request.user)
+        offers = []
+        degraded_marketplaces = []
+        stream_url = f"{reverse('search_results_stream')}?{urlencode({'q': search_query, 'category': category})}"
+    else:
+        # одинаковые одновременные поиски парсятся и записываются один раз,
+        # остальные запросы ждут результата лидера и читают офферы из БД
+        outcome = get_single_flight().do(
+            flight_key,
+            lambda: _refresh_search_offers(
+                search_query,
+                category,
+                request.user,
+                MARKETPLACES,
+                total_timeout=getattr(settings, "OFFER_COLD_DEADLINE", None),
+            ),
+        )
+        query_obj = ProductQuery.objects.get(pk=outcome["query_id"])
+        offers = list(query_obj.offers.order_by(*Offer.CHEAPEST_FIRST))
+        degraded_marketplaces = outcome["degraded"]
+
+    # время последнего просмотра влияет на частоту автообновления
+    ProductQuery.objects.filter(pk=query_obj.pk).update(last_viewed_at=timezone.now())
+    forecast, forecast_confidence_pct = _build_forecast(query_obj, category, offers)
 
     return render(
         request,
@@ -164,14 +232,176 @@ def search_results(request):
             "category": category,
             "results": offers,
             "results_count": len(offers),
-            "used_demo": used_demo if 'used_demo' in locals() else False,
+            "used_demo": used_demo,
             "forecast": forecast,
             "forecast_confidence_pct": forecast_confidence_pct,
             "forecast_trend": forecast.get("trend") if forecast else None,
+            "degraded_marketplaces": degraded_marketplaces,
+            "stream_url": stream_url,
+        },
+    )
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False)}\n\n"
+
+
+def _offer_payload(offer: Offer) -> dict:
+    return {
+        "title": offer.title,
+        "price": offer.price,
+        "currency": offer.currency,
+        "marketplace": offer.marketplace,
+        "marketplace_display": offer.get_marketplace_display(),
+        "rating": offer.rating,
+        "url": offer.url,
+        "image_url": offer.image_url,
+    }
+
+
+async def _join_flight(flight_key: str, leading: asyncio.Event, finished: threading.Event, outcome: dict):
+    """
+    Enter the single-flight for ``flight_key`` from a helper thread. Returns None
+    once this stream becomes the leader (``leading`` is set; the flight is held
+    until ``finished``), otherwise the leader's outcome.
+    """
+    loop = asyncio.get_running_loop()
+    flight = loop.create_future()
+
+    def resolve(result=None, error=None):
+        if flight.done():
+            return
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            flight.set_result(result)
+
+    def lead():
+        # выполняется, только если этот поток стал лидером: держим ключ, пока лидер пишет поток
+        loop.call_soon_threadsafe(leading.set)
+        finished.wait(getattr(settings, "SINGLE_FLIGHT", {}).get("LOCK_TIMEOUT", 60))
+        return dict(outcome)
+
+    def run():
+        try:
+            result = get_single_flight().do(flight_key, lead)
+            loop.call_soon_threadsafe(resolve, result)
+        except Exception as exc:
+            loop.call_soon_threadsafe(resolve, None, exc)
+        finally:
+            connections.close_all()
+
+    threading.Thread(target=run, name="search-flight", daemon=True).start()
+    became_leader = asyncio.ensure_future(leading.wait())
+    await asyncio.wait({became_leader, flight}, return_when=asyncio.FIRST_COMPLETED)
+    if leading.is_set():
+        return None
+    became_leader.cancel()
+    return flight.result()
+
+
+async def _fetched_offers(query_obj, search_query: str, outcome: dict):
+    """Leader: poll marketplaces, store and yield (marketplace, offers) as each one answers."""
+    write_stats = WriteStats()
+    async for result in iter_marketplace_results(
+        search_query, MARKETPLACES, total_timeout=getattr(settings, "MARKETPLACE_TOTAL_TIMEOUT", None)
+    ):
+        if result["status"] != "ok":
+            outcome["degraded"].append(result["marketplace"])
+        offers = await sync_to_async(_store_offers)(
+            query_obj, result["offers"], search_query, write_stats
+        )
+        if offers:
+            yield result["marketplace"], offers
+    await sync_to_async(reschedule)([query_obj])
+    logger.debug("Search stream '%s': stored %s", search_query, write_stats)
+
+
+async def _stored_offers(query_obj):
+    """Follower: offers the leader has just stored, one batch per marketplace."""
+    offers = await sync_to_async(list)(query_obj.offers.order_by(*Offer.CHEAPEST_FIRST))
+    for marketplace in MARKETPLACES:
+        batch = [offer for offer in offers if offer.marketplace == marketplace]
+        if batch:
+            yield marketplace, batch
+
+
+async def _offer_events(query_obj, search_query: str, category: str):
+    """
+    SSE-поток: событие "offers" на каждый ответивший маркетплейс (обычно первым
+    приходит Wildberries), затем "forecast" и "done" с метрикой time-to-first-offer.
+    Одинаковые одновременные поиски (тот же ключ single-flight, что и у
+    search_results) парсит и пишет в БД только лидер; остальные ждут его и
+    получают уже сохранённые офферы.
+    """
+    started = time.monotonic()
+    first_offer_at = None
+    stored: List[Offer] = []
+    outcome = {"query_id": query_obj.id, "degraded": []}
+    leading, finished = asyncio.Event(), threading.Event()
+    try:
+        try:
+            leader_outcome = await _join_flight(_flight_key(search_query, category), leading, finished, outcome)
+        except Exception as exc:
+            logger.warning("Search stream '%s': single-flight leader failed: %s", search_query, exc)
+            leader_outcome = outcome
+        if leader_outcome is None:
+            source = _fetched_offers(query_obj, search_query, outcome)
+        else:
+            outcome = leader_outcome
+            if outcome["query_id"] != query_obj.id:
+                query_obj = await sync_to_async(ProductQuery.objects.get)(pk=outcome["query_id"])
+            source = _stored_offers(query_obj)
+
+        async for marketplace, offers in source:
+            if first_offer_at is None:
+                first_offer_at = time.monotonic() - started
+            stored.extend(offers)
+            yield _sse("offers", {"marketplace": marketplace, "offers": [_offer_payload(o) for o in offers]})
+    finally:
+        # отпускаем ведомых, даже если клиент закрыл поток раньше времени
+        finished.set()
+
+    forecast, confidence_pct = await sync_to_async(_build_forecast)(query_obj, category, stored)
+    if forecast:
+        yield _sse("forecast", {**forecast, "confidence_pct": confidence_pct})
+    total = time.monotonic() - started
+    logger.debug(
+        "Search stream '%s': %s, first offer %s, total %.2fs",
+        search_query,
+        "leader" if leading.is_set() else "follower",
+        "%.2fs" % first_offer_at if first_offer_at is not None else "n/a",
+        total,
+    )
+    yield _sse(
+        "done",
+        {
+            "count": len(stored),
+            "degraded": outcome["degraded"],
+            "time_to_first_offer": round(first_offer_at, 3) if first_offer_at is not None else None,
+            "elapsed": round(total, 3),
         },
     )
 
 
+@login_required
+async def search_results_stream(request):
+    search_query = request.GET.get("q", "").strip()
+    category = request.GET.get("category", "").strip() or "electronics"
+    if not search_query:
+        return HttpResponseBadRequest("Empty query")
+    user = await request.auser()
+    query_obj = await sync_to_async(_get_or_create_query)(search_query, category, user)
+    response = StreamingHttpResponse(
+        _offer_events(query_obj, search_query, category),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    # не даём nginx буферизовать поток
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
 @login_required
 def create_price_alert(request):
     if request.method != "POST":